@@ -4,7 +4,7 @@ from tkinter import messagebox
 
 from FreeMark.UI.file_selector import FileSelector
 from FreeMark.UI.options_pane import OptionsPane
-from FreeMark.UI.preview_window import PreviewWindow
+from FreeMark.UI.thumbnail_strip import ThumbnailStrip
 from FreeMark.UI.worker import Worker
 
 
@@ -17,19 +17,20 @@ class FreeMarkApp(Frame):
     def __init__(self, master=None):
         Frame.__init__(self, master)
         self.master = master
+        # 预览窗口在第一次需要时才创建
         self.preview_window = None
         self.last_update = 0
         
         self.create_widgets()
         
-        # 创建预览窗口
-        self.create_preview_window()
-        
         # Bind window close event
         self.master.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def create_preview_window(self):
         """创建预览窗口"""
+        # PIL and ImageTk are only needed once there's something to preview
+        from FreeMark.UI.preview_window import PreviewWindow
+
         try:
             # 直接创建预览窗口实例，让PreviewWindow类自己创建Toplevel窗口
             self.preview_window = PreviewWindow(self.master, "", "", {})
@@ -47,6 +48,30 @@ class FreeMarkApp(Frame):
             self.preview_window.window.protocol("WM_DELETE_WINDOW", self.on_preview_close)
         except Exception as e:
             print(f"创建预览窗口时出错: {e}")
+            self.preview_window = None
+
+    def get_preview_window(self):
+        """
+        Get the preview window, creating it if it doesn't exist yet
+        :return: PreviewWindow object or None if it couldn't be created
+        """
+        if not self.preview_window or not self.preview_window.window.winfo_exists():
+            self.create_preview_window()
+        return self.preview_window
+
+    def show_preview(self, image_path, watermark_path, options):
+        """
+        Show a preview in the preview window
+        :param image_path: path to the image to preview
+        :param watermark_path: path to the watermark
+        :param options: dict of watermark options
+        """
+        preview_window = self.get_preview_window()
+        if not preview_window:
+            return
+        preview_window.update_preview(image_path, watermark_path, options)
+        # 确保预览窗口可见
+        preview_window.window.deiconify()
     
     def on_preview_close(self):
         """处理预览窗口关闭事件"""
@@ -67,10 +92,6 @@ class FreeMarkApp(Frame):
             return
             
         self.last_update = current_time
-        
-        # 检查预览窗口是否存在
-        if not self.preview_window or not self.preview_window.window.winfo_exists():
-            self.create_preview_window()
             
         try:
             # 获取当前选择的文件
@@ -93,14 +114,22 @@ class FreeMarkApp(Frame):
             }
             
             # 更新预览
-            self.preview_window.update_preview(selected_file, watermark_path, options)
-            
-            # 确保预览窗口可见
-            self.preview_window.window.deiconify()
+            self.show_preview(selected_file, watermark_path, options)
             
         except Exception as e:
             print(f"更新预览时出错: {e}")
 
+    def on_file_select(self, *args):
+        """Keep the thumbnail strip in sync with the list, then preview"""
+        selected = self.file_selector.files_view.curselection()
+        if selected:
+            self.thumbnail_strip.select(selected[0])
+        self.update_preview(*args)
+
+    def refresh_thumbnails(self, *args):
+        """Show thumbnails for the files currently in the list"""
+        self.thumbnail_strip.show(self.file_selector.get_file_paths())
+
     def create_widgets(self):
         """Create the GUI elements"""
         # Label(self.master, text='FreeMark', font=16).pack(pady=pad_y)
@@ -112,17 +141,24 @@ class FreeMarkApp(Frame):
 
         # Set file_selector to options_pane
         self.options_pane.set_file_selector(self.file_selector)
+        self.options_pane.set_preview_handler(self.show_preview)
         
         # 绑定所有选项变化到预览更新
         self.options_pane.bind_all_options(self.update_preview)
         
         # 绑定文件选择变化到预览更新
-        self.file_selector.files_view.bind('<<ListboxSelect>>', self.update_preview)
+        self.file_selector.files_view.bind('<<ListboxSelect>>', self.on_file_select)
         
         self.file_selector.pack(side=LEFT, padx=(2, 5))
         self.options_pane.pack(side=RIGHT, fill=Y, pady=10)
 
         options_frame.pack()
 
+        # Thumbnails of the files in the list, click one to preview it
+        self.thumbnail_strip = ThumbnailStrip(self.master,
+                                              on_select=self.file_selector.select_index)
+        self.file_selector.bind("<<FilesChanged>>", self.refresh_thumbnails)
+        self.thumbnail_strip.pack(fill=X, padx=5)
+
         worker = Worker(self.file_selector, self.options_pane)
         worker.pack()
\ No newline at end of file
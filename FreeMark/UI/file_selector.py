@@ -3,6 +3,8 @@ from tkinter import filedialog
 from tkinter import messagebox
 import os
 
+from FreeMark.tools.help import is_image_file
+
 
 class FileSelector(Frame):
     """
@@ -18,7 +20,9 @@ class FileSelector(Frame):
         self.button_frame = Frame(self)
         self.folder_frame = Frame(self)
 
-        self.files_view = Listbox(self, width=35, height=20)
+        # Several files can be selected, e.g. to have them marked first
+        self.files_view = Listbox(self, width=35, height=20,
+                                  selectmode=EXTENDED)
         self.folder_entry = Entry(self.folder_frame, width=27,
                                   textvariable=self.base_dir)
 
@@ -58,6 +62,7 @@ class FileSelector(Frame):
         """
         self.files_view.delete(ANCHOR)
         self.files = self.files_view.get(0, END)
+        self.event_generate("<<FilesChanged>>")
 
     def prompt_directory(self):
         """Prompt the user for a base dir"""
@@ -67,6 +72,7 @@ class FileSelector(Frame):
         self.files_view.delete(0, END)
         for _file in self.files:
             self.files_view.insert(END, _file)
+        self.event_generate("<<FilesChanged>>")
 
     def clear_files(self):
         self.files = []
@@ -76,15 +82,11 @@ class FileSelector(Frame):
     def refresh_files(self):
         """Update files list"""
         self.files = []
-        types = ['.PNG', '.JPG', 'JPEG', '.BMP', '.TIFF', '.png', '.jpg', '.jpeg', '.bmp', '.tiff']
         try:
             for _file in os.listdir(self.base_dir.get()):
                 if os.path.isfile(os.path.join(self.base_dir.get(), _file)):
-                    for _type in types:
-                        if _file.endswith(_type) and _file not in self.files:
-                            self.files.append(_file)
-                            # Stop when correct format is found.
-                            break
+                    if is_image_file(_file) and _file not in self.files:
+                        self.files.append(_file)
         except FileNotFoundError:
             messagebox.showerror("Error", "Directory not found")
             return
@@ -105,6 +107,21 @@ class FileSelector(Frame):
         return [os.path.join(self.base_dir.get(), file) for file
                 in self.get_files()]
                 
+    def select_index(self, index):
+        """
+        Select a file in the list, as if the user clicked it
+        :param index: index of the file in the list
+        """
+        self.files_view.selection_clear(0, END)
+        self.files_view.selection_set(index)
+        self.files_view.see(index)
+        self.files_view.event_generate("<<ListboxSelect>>")
+
+    def get_selected_file_paths(self):
+        """Return the paths of every selected file"""
+        return [os.path.join(self.base_dir.get(), self.files_view.get(index))
+                for index in self.files_view.curselection()]
+
     def get_current_file_path(self):
         """Return the path of the currently selected file, or empty string if none selected"""
         selected = self.files_view.curselection()
@@ -4,7 +4,6 @@ from tkinter import messagebox
 from FreeMark.UI.output_selector import OutputSelector
 from FreeMark.UI.watermark_selector import WatermarkSelector
 from FreeMark.UI.watermark_options import WatermarkOptions
-from FreeMark.UI.preview_window import PreviewWindow
 
 
 class OptionsPane(Frame):
@@ -14,11 +13,9 @@ class OptionsPane(Frame):
     """
     def __init__(self, master=None):
         super().__init__(master)
-        # 初始化时创建预览窗口但保持隐藏
-        self.preview_window = PreviewWindow(self, None, None, {})
-        self.preview_window.window.withdraw()  # 初始隐藏窗口
-        
         self.file_selector = None
+        # Callback showing the preview, the preview window is owned by the app
+        self.preview_handler = None
         self.output_selector = OutputSelector(self)
         self.watermark_selector = WatermarkSelector(self)
         self.watermark_options = WatermarkOptions(self)
@@ -31,6 +28,13 @@ class OptionsPane(Frame):
         """
         self.file_selector = file_selector
 
+    def set_preview_handler(self, handler):
+        """
+        Set the callback used to show a preview
+        :param handler: function taking (image_path, watermark_path, options)
+        """
+        self.preview_handler = handler
+
     def create_widgets(self):
         """Create the graphical element"""
         pady = 5
@@ -60,7 +64,12 @@ class OptionsPane(Frame):
                (int(self.watermark_options.pady.get()), self.watermark_options.unit_y.get())
 
     def get_opacity(self):
+        if self.watermark_options.adaptive_opacity.get():
+            return "auto"
         return self.watermark_options.opacity.get()/100
+
+    def get_blend(self):
+        return self.watermark_options.blend.get()
         
     def bind_all_options(self, callback):
         """Bind all option changes to the given callback"""
@@ -73,6 +82,7 @@ class OptionsPane(Frame):
         self.watermark_options.pady.trace_add('write', callback)
         self.watermark_options.unit_x.trace_add('write', callback)
         self.watermark_options.unit_y.trace_add('write', callback)
+        self.watermark_options.blend.trace_add('write', callback)
         
         # Output selector
         self.output_selector.output_dir.trace_add('write', callback)
@@ -103,10 +113,11 @@ class OptionsPane(Frame):
             "pos": self.get_watermark_pos(),
             "padding": self.get_padding(),
             "opacity": self.get_opacity(),
+            "blend": self.get_blend(),
             "scale_x": self.watermark_options.scale_x.get(),
             "scale_y": self.watermark_options.scale_y.get()
         }
         
         # 更新现有预览窗口内容
-        self.preview_window.update_preview(image_path, watermark_path, options)
-        self.preview_window.window.deiconify()  # 显示窗口
\ No newline at end of file
+        if self.preview_handler:
+            self.preview_handler(image_path, watermark_path, options)
\ No newline at end of file
@@ -5,10 +5,7 @@ import os
 import re
 
 from ..tools.errors import BadOptionError
-
-NONE = 0
-PRE = 1
-SUFFIX = 2
+from ..tools.help import NONE, PRE, SUFFIX, rename_file
 
 
 class OutputSelector(Frame):
@@ -20,6 +17,9 @@ class OutputSelector(Frame):
 
         self.fix = StringVar()
         self.fix_position = IntVar()
+        # Max long edge (2048) or box (1920x1080) of the output, empty keeps
+        # the original size
+        self.max_size = StringVar()
         self.output_dir = StringVar()
         self.output_dir.set("Choose output folder")
 
@@ -28,6 +28,7 @@ class OutputSelector(Frame):
         self.entry_frame = Frame(self)
         self.fix_frame = Frame(self)
         self.radio_frame = Frame(self.fix_frame)
+        self.size_frame = Frame(self)
         self.create_widgets()
 
     def create_widgets(self):
@@ -60,6 +61,14 @@ class OutputSelector(Frame):
         self.radio_frame.pack(anchor=CENTER)
         self.fix_frame.pack(fill=X)
 
+        Label(self.size_frame, text="Max size: ").pack(side=LEFT)
+        Entry(self.size_frame, width=12,
+              textvariable=self.max_size).pack(side=LEFT, padx=5)
+        Label(self.size_frame,
+              text="px, e.g. 2048 or 1920x1080, empty keeps the original "
+                   "size").pack(side=LEFT)
+        self.size_frame.pack(fill=X, pady=5)
+
     def lock(self):
         """
         Lock down the output selector so the user doesn't mess with it
@@ -67,7 +76,8 @@ class OutputSelector(Frame):
         """
         for child in (self.fix_frame.winfo_children()
                       + self.radio_frame.winfo_children()
-                      + self.entry_frame.winfo_children()):
+                      + self.entry_frame.winfo_children()
+                      + self.size_frame.winfo_children()):
             try:
                 child.config(state=DISABLED)
             except TclError:
@@ -79,7 +89,8 @@ class OutputSelector(Frame):
         """
         for child in (self.fix_frame.winfo_children()
                       + self.radio_frame.winfo_children()
-                      + self.entry_frame.winfo_children()):
+                      + self.entry_frame.winfo_children()
+                      + self.size_frame.winfo_children()):
             try:
                 child.config(state=NORMAL)
             except TclError:
@@ -127,6 +138,17 @@ class OutputSelector(Frame):
         else:
             raise BadOptionError("Output location doesn't exist.")
 
+    def get_output_size(self):
+        """
+        Returns the max output size, None to keep the original size
+        """
+        from FreeMark.tools.help import parse_size
+
+        max_size = self.max_size.get().strip()
+        if not max_size:
+            return None
+        return parse_size(max_size)
+
     def rename_file(self, filename, abs_path=False):
         """
         extract file name and apply suffix or prefix
@@ -136,14 +158,7 @@ class OutputSelector(Frame):
         """
         if abs_path:
             filename = os.path.split(filename)[-1]
-
-        if self.fix_position.get() == NONE:
-            return filename
-        elif self.fix_position.get() == PRE:
-            return "{}_{}".format(self.fix.get(), filename)
-        elif self.fix_position.get() == SUFFIX:
-            filename = filename.rsplit('.', maxsplit=1)
-            return "{}_{}.{}".format(filename[0], self.fix.get(), filename[1])
+        return rename_file(filename, self.fix.get(), self.fix_position.get())
 
     def get_output_path(self, input_path, output_path):
         """
@@ -4,38 +4,71 @@ from PIL import Image, ImageTk
 import os
 
 from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.config import Config
+from FreeMark.tools.decode_cache import DecodeCache
 from FreeMark.tools.errors import BadOptionError
 
 
 class PreviewWindow:
     """
-    预览窗口，显示带有水印的图像预览
+    预览窗口，显示带有水印的图像预览.
+    Can zoom and pan, only the part of the image that's visible is
+    rendered, so even huge images move smoothly at 100%.
     """
+    min_zoom = 0.01
+    max_zoom = 8.0
+    zoom_step = 1.25
+
     def __init__(self, master, image_path, watermark_path, options):
         self.parent = master  # 保存原始的master引用
-        
+
         # 创建一个新的Toplevel窗口
         self.window = Toplevel(master)
         self.window.title("Preview")
         self.window.geometry("800x600")
         self.window.minsize(800, 600)
-        
+
         self.image_path = image_path
         self.watermark_path = watermark_path
         self.options = options
-        
-        self.preview_image = None
+        try:
+            self.decode_cache = DecodeCache.from_config(
+                Config('options.ini').get_config())
+        except OSError as e:
+            print("Not using the decode cache\n", e)
+            self.decode_cache = None
+
+        # Decoded image, kept while the same file is previewed
+        self.source = None
+        self.source_key = None
+        # Copies of the source reduced by whole factors, by factor
+        self.levels = {}
+        self.watermarker = None
+        self.watermarker_key = None
+        # Free_mark at full size and its position, then reduced to the levels
+        self.placed = None
+        self.placed_levels = {}
+
+        # None fits the image to the window, otherwise screen px pr. image px
+        self.zoom = None
+        # Image coordinates of the top left corner of the view
+        self.view_x = 0.0
+        self.view_y = 0.0
+        self.drag_start = None
+
         self.photo = None
-        
+        self.render_pending = None
+        self.zoom_text = StringVar()
+
         self.create_widgets()
-        
+
         # 如果提供了有效的图像路径和水印路径，则生成预览
         if self.image_path and self.watermark_path and os.path.exists(self.image_path) and os.path.exists(self.watermark_path):
             self.generate_preview()
-        
+
         # 使窗口居中，但等待窗口完全创建后再执行
         self.window.after_idle(self.center_window)
-    
+
     def center_window(self):
         """将窗口居中显示"""
         self.window.update_idletasks()
@@ -44,84 +77,280 @@ class PreviewWindow:
         x = (self.window.winfo_screenwidth() // 2) - (width // 2)
         y = (self.window.winfo_screenheight() // 2) - (height // 2)
         self.window.geometry('{}x{}+{}+{}'.format(width, height, x, y))
-        
+
     def create_widgets(self):
         """创建预览窗口的GUI元素"""
+        # Zoom controls
+        toolbar = Frame(self.window)
+        Button(toolbar, text="Fit", width=5,
+               command=self.zoom_fit).pack(side=LEFT, padx=(0, 5))
+        Button(toolbar, text="100%", width=5,
+               command=lambda: self.set_zoom(1.0)).pack(side=LEFT, padx=(0, 5))
+        Button(toolbar, text="-", width=3,
+               command=lambda: self.set_zoom(
+                   self.get_zoom() / self.zoom_step)).pack(side=LEFT)
+        Button(toolbar, text="+", width=3,
+               command=lambda: self.set_zoom(
+                   self.get_zoom() * self.zoom_step)).pack(side=LEFT)
+        Label(toolbar, textvariable=self.zoom_text).pack(side=LEFT, padx=10)
+        toolbar.pack(anchor=W, padx=10, pady=(10, 0))
+
         # 创建一个框架来容纳图像
         self.image_frame = Frame(self.window)
         self.image_frame.pack(fill=BOTH, expand=True, padx=10, pady=10)
-        
-        # 创建一个标签来显示图像
-        self.image_label = Label(self.image_frame)
-        self.image_label.pack(fill=BOTH, expand=True)
-        
+
+        # Canvas showing the visible part of the image
+        self.canvas = Canvas(self.image_frame, highlightthickness=0,
+                             cursor="fleur")
+        self.canvas.pack(fill=BOTH, expand=True)
+        self.canvas_image = self.canvas.create_image(0, 0, anchor=NW)
+
+        self.canvas.bind("<Configure>", lambda e: self.schedule_render())
+        self.canvas.bind("<ButtonPress-1>", self.on_drag_start)
+        self.canvas.bind("<B1-Motion>", self.on_drag)
+        # Windows/Mac send MouseWheel, X11 sends buttons 4 and 5
+        self.canvas.bind("<MouseWheel>",
+                         lambda e: self.on_wheel(e, e.delta > 0))
+        self.canvas.bind("<Button-4>", lambda e: self.on_wheel(e, True))
+        self.canvas.bind("<Button-5>", lambda e: self.on_wheel(e, False))
+
     def update_preview(self, image_path, watermark_path, options):
         """更新预览图像"""
         # 更新路径和选项
         self.image_path = image_path
         self.watermark_path = watermark_path
         self.options = options
-        
+
         # 如果提供了有效的图像路径和水印路径，则生成预览
         if self.image_path and self.watermark_path and os.path.exists(self.image_path) and os.path.exists(self.watermark_path):
             self.generate_preview()
-        
+
     def generate_preview(self):
         """生成预览图像"""
         try:
-            # 创建一个临时的WaterMarker实例
-            watermarker = WaterMarker(self.watermark_path)
-            
-            # 应用水印到图像，但不保存
-            preview_img = watermarker.apply_watermark_preview(
-                self.image_path,
+            self.load_source()
+            watermarker = self.get_watermarker()
+
+            # Only the free_mark and its position are worked out,
+            # it's pasted onto the visible part when rendering
+            self.placed = watermarker.place_watermark(
+                self.source,
                 pos=self.options.get("pos"),
                 padding=self.options.get("padding"),
                 opacity=self.options.get("opacity"),
                 scale_x=self.options.get("scale_x", 1.0),
                 scale_y=self.options.get("scale_y", 1.0)
             )
-            
-            # 调整图像大小以适应窗口
-            self.display_image(preview_img)
-            
+            self.placed_levels = {}
+
+            self.render()
+
         except BadOptionError as e:
             messagebox.showerror("预览错误", str(e))
             self.window.withdraw()
         except Exception as e:
             messagebox.showerror("预览错误", f"生成预览时出错: {str(e)}")
             self.window.withdraw()
-    
-    def display_image(self, img):
-        """在窗口中显示图像"""
-        # 获取窗口大小
-        self.window.update_idletasks()
-        window_width = self.image_frame.winfo_width()
-        window_height = self.image_frame.winfo_height()
-        
+
+    def load_source(self):
+        """
+        Decode the image being previewed, unless it's already loaded
+        """
+        key = (self.image_path, os.path.getmtime(self.image_path))
+        if key == self.source_key:
+            return
+        try:
+            if self.decode_cache:
+                image, _ = self.decode_cache.open_image(self.image_path)
+            else:
+                image, _ = WaterMarker.open_image(self.image_path)
+        except FileNotFoundError:
+            raise BadOptionError("找不到输入图像文件")
+        except OSError:
+            raise BadOptionError("输入图像格式不兼容")
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands()
+                                  or "transparency" in image.info else "RGB")
+        image.load()
+
+        new_image = self.source is None or self.source.size != image.size
+        self.source = image
+        self.source_key = key
+        self.levels = {1: image}
+        if new_image:
+            self.zoom = None
+            self.view_x = self.view_y = 0.0
+
+    def get_watermarker(self):
+        """
+        Get a WaterMarker for the current watermark, it keeps its scaled
+        free_marks between previews
+        """
+        key = (self.watermark_path, os.path.getmtime(self.watermark_path))
+        if key != self.watermarker_key:
+            self.watermarker = WaterMarker(self.watermark_path)
+            self.watermarker_key = key
+        return self.watermarker
+
+    def get_view_size(self):
+        """Size of the canvas in pixels"""
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
         # 如果窗口尚未完全初始化，使用默认大小
-        if window_width <= 1 or window_height <= 1:
-            window_width = 780
-            window_height = 540
-        
-        # 计算缩放比例
-        img_width, img_height = img.size
-        scale_width = window_width / img_width
-        scale_height = window_height / img_height
-        scale = min(scale_width, scale_height)
-        
+        if width <= 1 or height <= 1:
+            return 780, 540
+        return width, height
+
+    def get_zoom(self):
+        """
+        Current zoom, screen pixels pr. image pixel
+        """
+        if self.zoom is not None or self.source is None:
+            return self.zoom or 1.0
+        view_width, view_height = self.get_view_size()
         # 如果图像小于窗口，不需要缩放
-        if scale >= 1:
-            resized_img = img
+        return min(view_width / self.source.size[0],
+                   view_height / self.source.size[1], 1.0)
+
+    def get_level(self, zoom):
+        """
+        Get the source reduced by the biggest whole factor that still has a
+        pixel for every screen pixel, so zoomed out views don't resample the
+        full image
+        :param zoom: screen pixels pr. image pixel
+        :return: (factor, PIL image object)
+        """
+        factor = max(1, int(1 / zoom))
+        if factor not in self.levels:
+            # Only keep the full image and one reduced copy
+            self.levels = {1: self.source,
+                           factor: self.source.reduce(factor)}
+        return factor, self.levels[factor]
+
+    def get_placed_level(self, factor):
+        """
+        Get the free_mark and its position for a reduced level
+        :param factor: reduction factor of the level
+        :return: (PIL image object, (x, y))
+        """
+        if factor not in self.placed_levels:
+            watermark, (x, y) = self.placed
+            if factor > 1:
+                watermark = watermark.resize(
+                    (max(1, round(watermark.size[0] / factor)),
+                     max(1, round(watermark.size[1] / factor))), Image.BILINEAR)
+            self.placed_levels[factor] = (watermark,
+                                          (round(x / factor), round(y / factor)))
+        return self.placed_levels[factor]
+
+    def clamp_view(self, zoom):
+        """Keep the view inside the image, centring images smaller than it"""
+        view_width, view_height = self.get_view_size()
+        visible_width = view_width / zoom
+        visible_height = view_height / zoom
+        width, height = self.source.size
+        if visible_width >= width:
+            self.view_x = (width - visible_width) / 2
         else:
-            # 缩放图像
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # 转换为PhotoImage并显示
-        self.photo = ImageTk.PhotoImage(resized_img)
-        self.image_label.config(image=self.photo)
-        
-        # 保存对图像的引用，防止被垃圾回收
-        self.preview_image = resized_img
\ No newline at end of file
+            self.view_x = min(max(self.view_x, 0), width - visible_width)
+        if visible_height >= height:
+            self.view_y = (height - visible_height) / 2
+        else:
+            self.view_y = min(max(self.view_y, 0), height - visible_height)
+
+    def render_view(self):
+        """
+        Render the visible part of the marked image
+        :return: (PIL image object at screen size, (x, y) on the canvas)
+        """
+        zoom = self.get_zoom()
+        self.clamp_view(zoom)
+        factor, level = self.get_level(zoom)
+        # Level pixels to screen pixels
+        scale = zoom * factor
+        view_width, view_height = self.get_view_size()
+
+        # Visible box in level pixels
+        left = max(int(self.view_x / factor), 0)
+        top = max(int(self.view_y / factor), 0)
+        right = min(int((self.view_x + view_width / zoom) / factor) + 1,
+                    level.size[0])
+        bottom = min(int((self.view_y + view_height / zoom) / factor) + 1,
+                     level.size[1])
+        crop = level.crop((left, top, right, bottom))
+
+        # Paste the free_mark, paste clips whatever falls outside the crop
+        watermark, (x, y) = self.get_placed_level(factor)
+        if (x < right and left < x + watermark.size[0]
+                and y < bottom and top < y + watermark.size[1]):
+            WaterMarker.paste_watermark(crop, watermark, (x - left, y - top),
+                                        self.options.get("blend", "normal"))
+
+        if scale != 1:
+            # Nearest neighbour shows the actual pixels when zoomed in
+            crop = crop.resize((max(1, round(crop.size[0] * scale)),
+                                max(1, round(crop.size[1] * scale))),
+                               Image.NEAREST if scale > 1 else Image.BILINEAR)
+        position = (round((left * factor - self.view_x) * zoom),
+                    round((top * factor - self.view_y) * zoom))
+        return crop, position
+
+    def render(self):
+        """在窗口中显示图像"""
+        self.render_pending = None
+        if self.source is None or self.placed is None:
+            return
+        crop, position = self.render_view()
+
+        # 转换为PhotoImage并显示, 保存对图像的引用，防止被垃圾回收
+        self.photo = ImageTk.PhotoImage(crop)
+        self.canvas.itemconfig(self.canvas_image, image=self.photo)
+        self.canvas.coords(self.canvas_image, *position)
+        self.zoom_text.set("{:.0f}%".format(self.get_zoom() * 100))
+
+    def schedule_render(self):
+        """Render once the event queue is empty, dragging sends many events"""
+        if self.render_pending is None:
+            self.render_pending = self.window.after_idle(self.render)
+
+    def set_zoom(self, zoom, anchor=None):
+        """
+        Zoom, keeping the image point under anchor in place
+        :param zoom: screen pixels pr. image pixel
+        :param anchor: (x, y) on the canvas, the centre by default
+        """
+        if self.source is None:
+            return
+        old_zoom = self.get_zoom()
+        zoom = min(max(zoom, self.min_zoom), self.max_zoom)
+        if anchor is None:
+            view_width, view_height = self.get_view_size()
+            anchor = (view_width / 2, view_height / 2)
+        image_x = self.view_x + anchor[0] / old_zoom
+        image_y = self.view_y + anchor[1] / old_zoom
+        self.zoom = zoom
+        self.view_x = image_x - anchor[0] / zoom
+        self.view_y = image_y - anchor[1] / zoom
+        self.schedule_render()
+
+    def zoom_fit(self):
+        self.zoom = None
+        self.schedule_render()
+
+    def on_wheel(self, event, zoom_in):
+        factor = self.zoom_step if zoom_in else 1 / self.zoom_step
+        self.set_zoom(self.get_zoom() * factor, anchor=(event.x, event.y))
+
+    def on_drag_start(self, event):
+        self.drag_start = (event.x, event.y)
+
+    def on_drag(self, event):
+        if self.drag_start is None or self.source is None:
+            return
+        zoom = self.get_zoom()
+        # Dragging fixes the current zoom, so a fitted view can be moved
+        self.zoom = zoom
+        self.view_x -= (event.x - self.drag_start[0]) / zoom
+        self.view_y -= (event.y - self.drag_start[1]) / zoom
+        self.drag_start = (event.x, event.y)
+        self.schedule_render()
@@ -30,19 +30,31 @@ class RemainingTime(Frame):
         """
         self.pacer.set_max(_max)
 
+    def set_prior(self, seconds_per_step, weight=None):
+        """
+        Set the expected time pr. step, used until real steps are measured
+        :param seconds_per_step: expected seconds pr. step
+        :param weight: amount of steps the prior counts as
+        """
+        self.pacer.set_prior(seconds_per_step, weight)
+
     def start(self):
         """
         Show the element and start the timer, start updating label.
         """
         self.pacer.start()
-        self.remaining_time.set(0)  # Set it to 0 till we have the first step
+        if self.pacer.prior:
+            self.update()
+        else:
+            self.remaining_time.set(0)  # Set it to 0 till we have the first step
         threading.Thread(target=self._updater).start()
 
-    def step(self):
+    def step(self, amount=1):
         """
-        Take a step, adds one to progress.
+        Take a step, adds to progress.
+        :param amount: size of the step, defaults to one
         """
-        self.pacer.step()
+        self.pacer.step(amount)
 
     def update(self):
         """
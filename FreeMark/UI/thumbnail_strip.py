@@ -0,0 +1,164 @@
+from tkinter import *
+import queue
+
+
+class ThumbnailStrip(Frame):
+    """
+    Horizontal strip of thumbnails for the files in the file selector,
+    thumbnails are made on a background thread and only the visible ones
+    are turned into PhotoImages
+    """
+    def __init__(self, master=None, on_select=None, tile_size=96):
+        """
+        :param master: Parent frame
+        :param on_select: callback taking the index of a clicked thumbnail
+        :param tile_size: max width and height of a thumbnail
+        """
+        super().__init__(master)
+        self.on_select = on_select
+        self.tile_size = tile_size
+        self.tile_width = tile_size + 8
+
+        self.loader = None
+        self.results = queue.Queue()
+        self.count = 0
+        self.thumbnails = {}  # index -> PIL image
+        self.photos = {}      # index -> PhotoImage, only for visible tiles
+        self.selected = None
+
+        self.canvas = Canvas(self, height=tile_size + 8, highlightthickness=0)
+        self.scrollbar = Scrollbar(self, orient=HORIZONTAL,
+                                   command=self.on_scroll)
+        self.canvas.config(xscrollcommand=self.scrollbar.set)
+        self.create_widgets()
+
+    def create_widgets(self):
+        """Create GUI elements"""
+        self.canvas.pack(fill=X, expand=True)
+        self.scrollbar.pack(fill=X)
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Configure>", lambda e: self.draw_visible())
+
+    def show(self, paths):
+        """
+        Show thumbnails for a list of images
+        :param paths: list of paths to images on disk
+        """
+        # PIL is only loaded once there's something to show
+        if self.loader is None:
+            from FreeMark.tools.thumbnails import ThumbnailCache, ThumbnailLoader
+            size = (self.tile_size, self.tile_size)
+            self.loader = ThumbnailLoader(ThumbnailCache(size=size))
+
+        self.clear()
+        self.count = len(paths)
+        self.canvas.config(scrollregion=(0, 0, self.count * self.tile_width,
+                                         self.tile_size + 8))
+        if self.count:
+            self.loader.load(paths)
+            self.results = self.loader.results
+            self.after(20, self.poll)
+
+    def clear(self):
+        """
+        Remove every thumbnail and abandon loading
+        """
+        if self.loader:
+            self.loader.cancel()
+        self.results = queue.Queue()
+        self.thumbnails = {}
+        self.photos = {}
+        self.selected = None
+        self.count = 0
+        self.canvas.delete(ALL)
+        self.canvas.config(scrollregion=(0, 0, 0, 0))
+
+    def poll(self):
+        """
+        Pick up thumbnails from the loader thread, Tk may only be used from
+        the GUI thread so the loader can't draw them itself
+        """
+        results = self.results
+        got_any = False
+        try:
+            # Take a batch at a time so the GUI stays responsive
+            for _ in range(64):
+                index, thumbnail = results.get_nowait()
+                self.thumbnails[index] = thumbnail
+                got_any = True
+        except queue.Empty:
+            pass
+        if got_any:
+            self.draw_visible()
+
+        loading = self.loader.thread and self.loader.thread.is_alive()
+        if results is self.results and (loading or not results.empty()):
+            self.after(50, self.poll)
+
+    def get_visible_range(self):
+        """
+        Get the indexes of the tiles currently scrolled into view
+        :return: range of indexes
+        """
+        first, last = self.canvas.xview()
+        total = self.count * self.tile_width
+        start = max(0, int(first * total) // self.tile_width - 1)
+        end = min(self.count, int(last * total) // self.tile_width + 2)
+        return range(start, end)
+
+    def draw_visible(self):
+        """
+        Draw the visible thumbnails and drop PhotoImages scrolled out of view
+        """
+        from PIL import ImageTk
+
+        visible = self.get_visible_range()
+        for index in list(self.photos):
+            if index not in visible:
+                del self.photos[index]
+                self.canvas.delete("tile{}".format(index))
+
+        for index in visible:
+            if index in self.photos or index not in self.thumbnails:
+                continue
+            photo = ImageTk.PhotoImage(self.thumbnails[index])
+            self.photos[index] = photo
+            x = index * self.tile_width + self.tile_width // 2
+            self.canvas.create_image(x, self.tile_size // 2 + 4, image=photo,
+                                     tags=("tile{}".format(index), ))
+        self.draw_selection()
+
+    def draw_selection(self):
+        """
+        Draw a frame around the selected thumbnail
+        """
+        self.canvas.delete("selection")
+        if self.selected is None:
+            return
+        x = self.selected * self.tile_width
+        self.canvas.create_rectangle(x + 1, 1, x + self.tile_width - 1,
+                                     self.tile_size + 7, outline="#3478f6",
+                                     width=2, tags=("selection", ))
+
+    def select(self, index):
+        """
+        Mark a thumbnail as selected and scroll it into view
+        :param index: index of the file
+        """
+        if not 0 <= index < self.count:
+            return
+        self.selected = index
+        if index not in self.get_visible_range():
+            self.canvas.xview_moveto(index / self.count)
+        self.draw_visible()
+
+    def on_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.draw_visible()
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasx(event.x)) // self.tile_width
+        if index < self.count:
+            self.select(index)
+            if self.on_select:
+                self.on_select(index)
@@ -2,6 +2,8 @@ from tkinter import *
 # tkinter OptionMenu is hella ugly so use ttk
 from tkinter.ttk import OptionMenu
 
+from FreeMark.tools.help import BLEND_MODES
+
 
 class WatermarkOptions(Frame):
 
@@ -35,6 +37,12 @@ class WatermarkOptions(Frame):
 
         self.opacity = IntVar()
         self.opacity.set(100)
+        # Pick the opacity pr. image from what the watermark covers
+        self.adaptive_opacity = BooleanVar()
+        self.adaptive_opacity.set(False)
+        # How the watermark is mixed with the image under it
+        self.blend = StringVar()
+        self.blend.set("normal")
 
         self.create_widgets()
 
@@ -85,6 +93,11 @@ class WatermarkOptions(Frame):
         Radiobutton(pos_frame, text="Bottom right", variable=self.position,
                     value="SE").grid(column=1, row=1,
                                      padx=radio_pad, pady=radio_pad)
+
+        # Picks the corner covering the least detail, pr. image
+        Radiobutton(pos_frame, text="Auto", variable=self.position,
+                    value="AUTO").grid(column=0, row=2, sticky=W,
+                                       padx=radio_pad, pady=radio_pad)
         pos_frame.pack(side=LEFT, padx=30)
 
         pos_options.pack(anchor=W)
@@ -108,8 +121,18 @@ class WatermarkOptions(Frame):
                                                              anchor=S, pady=3)
 
         Label(opacity_frame, text="%").pack(side=LEFT, anchor=S, pady=3)
+        Checkbutton(opacity_frame, text="Auto", variable=self.adaptive_opacity,
+                    command=self.update_adaptive_opacity,
+                    onvalue=True, offvalue=False).pack(side=LEFT, anchor=S)
         opacity_frame.pack(anchor=W, fill=X)
 
+        blend_frame = Frame(self)
+        Label(blend_frame, text="Blend").pack(side=LEFT)
+        # First option is the blank one ttk shows before anything is picked
+        OptionMenu(blend_frame, self.blend, "", *BLEND_MODES).pack(side=LEFT,
+                                                                    padx=5)
+        blend_frame.pack(anchor=W)
+
         # ----------- Size options -----------
         # 保持横纵比例一致的复选框和预览按钮
         aspect_ratio_frame = Frame(self)
@@ -179,6 +202,12 @@ class WatermarkOptions(Frame):
             self.scale_y.set(self.scale_x.get())
             self.scale_y_label.config(text=f"{self.scale_y.get():.2f}x")
             
+    def update_adaptive_opacity(self):
+        """自动透明度时禁用滑块"""
+        state = "disabled" if self.adaptive_opacity.get() else "normal"
+        self.opacity_slider.config(state=state)
+        self.trigger_preview()
+
     def on_opacity_change(self, value):
         """处理透明度滑块的变化，带防抖功能"""
         if self.preview_timeout:
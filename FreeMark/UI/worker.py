@@ -5,8 +5,9 @@ import threading
 import queue
 import os
 
+from ..tools.config import Config
 from ..tools.errors import BadOptionError
-from FreeMark.tools.watermarker import WaterMarker
+from ..tools.work_queue import PriorityWorkQueue
 from FreeMark.UI.remaining_time import RemainingTime
 
 
@@ -15,16 +16,27 @@ class Worker(Frame):
     Worker gui elements, does all the actual work to the images with the
     watermarker class and contains progressbar and startbutton
     """
+    # Batches at least this big get a sampled cost estimate before starting
+    estimate_threshold = 100
+    # Most worker processes, each marks one image at a time. How many of
+    # them are used is tuned while working, see FreeMark.tools.autotune
+    max_workers = os.cpu_count() or 1
+
     def __init__(self, file_selector, options_pane, master=None):
         super().__init__(master)
 
         self.running = False
 
-        self.image_que = queue.Queue()
+        self.image_que = PriorityWorkQueue()
+        # Decoded pixels of each queued file, progress is timed in pixels so
+        # the remaining time holds up when files are bumped ahead
+        self.pixels = {}
 
         self.file_selector = file_selector
         self.option_pane = options_pane
-        self.watermarker = WaterMarker
+        self.watermarker = None
+        self.pool = None
+        self.config = Config('options.ini')
 
         self.progress_var = IntVar()
         self.file_count = IntVar()
@@ -32,6 +44,7 @@ class Worker(Frame):
         self.progress_bar = Progressbar(self, orient="horizontal",
                                         mode="determinate", length=600)
         self.time_tracker = RemainingTime(self.counter_frame)
+        self.estimate_text = StringVar()
 
         self.button_frame = Frame(self)
         self.start_button = Button(self.button_frame, text="Start",
@@ -40,6 +53,9 @@ class Worker(Frame):
                                   command=self.stop_work, width=10)
 
         self.create_widgets()
+        # Selecting files while working has them marked next
+        self.file_selector.files_view.bind("<<ListboxSelect>>",
+                                           self.on_file_select, add="+")
 
     def create_widgets(self):
         """Create GUI"""
@@ -50,23 +66,68 @@ class Worker(Frame):
         Label(self.counter_frame, textvariable=self.file_count).pack(side=LEFT)
 
         self.progress_bar.pack()
+        Label(self, textvariable=self.estimate_text).pack()
 
         self.stop_button.config(state=DISABLED)
         self.start_button.pack(side=LEFT, padx=15)
         self.stop_button.pack(side=LEFT)
         self.button_frame.pack(pady=10)
 
-    def fill_que(self):
+    def fill_que(self, infos):
         """
-        Fill the worker que from the files in file selector,
+        Fill the worker que, largest images first,
         and prepare te progress bar
+        :param infos: ImageInfo objects of the readable files
         """
-        files = self.file_selector.get_file_paths()
-        self.file_count.set(len(files))
-        self.progress_bar.configure(maximum=len(files))
-        self.time_tracker.set_max(len(files))
-        for file in files:
-            self.image_que.put(file)
+        from FreeMark.tools.batch import largest_first
+
+        self.file_count.set(len(infos))
+        self.progress_bar.configure(maximum=len(infos))
+        self.pixels = {info.path: info.pixels for info in infos}
+        self.time_tracker.set_max(sum(self.pixels.values()))
+        for info in largest_first(infos):
+            self.image_que.put(info.path)
+
+    def bump(self, paths):
+        """
+        Mark some files before the rest of the queue, without restarting
+        :param paths: paths of the files, in the order they should be done
+        :return: amount of files moved, the others are done, being worked
+                 on or aren't in this batch
+        """
+        return self.image_que.bump(paths)
+
+    def on_file_select(self, event=None):
+        if self.running:
+            moved = self.bump(self.file_selector.get_selected_file_paths())
+            if moved:
+                print("Moved {} files to the front of the queue".format(moved))
+
+    def get_image_timeout(self):
+        """
+        Seconds a single image may take before it's given up on,
+        set with image_timeout in options.ini, 0 for no limit
+        :return: seconds or None
+        """
+        try:
+            timeout = self.config.get_config().getfloat("image_timeout",
+                                                        fallback=300)
+        except ValueError:
+            print("Bad image_timeout in options.ini, using 300 s")
+            timeout = 300
+        return timeout if timeout > 0 else None
+
+    def get_decode_cache(self):
+        """
+        Get the decode cache set up in options.ini, if it's turned on
+        :return: DecodeCache object or None
+        """
+        from FreeMark.tools.decode_cache import DecodeCache
+        try:
+            return DecodeCache.from_config(self.config.get_config())
+        except OSError as e:
+            raise BadOptionError("Can't use the decode cache folder: "
+                                 "{}".format(e))
 
     def is_existing_files(self):
         """
@@ -99,6 +160,8 @@ class Worker(Frame):
             # Shouldn't matter since there's no files.
             overwrite = False
 
+        # Imported here so PIL isn't loaded before the window is shown
+        from FreeMark.tools.watermarker import WaterMarker
         try:
             self.watermarker = WaterMarker(self.option_pane.get_watermark_path(),
                                            overwrite=overwrite)
@@ -108,7 +171,6 @@ class Worker(Frame):
 
         self.stop_button.config(state=NORMAL)
         self.start_button.config(state=DISABLED)
-        self.fill_que()
         self.start_work()
 
     def start_work(self):
@@ -121,30 +183,97 @@ class Worker(Frame):
             kwargs = {"pos": self.option_pane.get_watermark_pos(),
                       "padding": self.option_pane.get_padding(),
                       "opacity": self.option_pane.get_opacity(),
+                      "blend": self.option_pane.get_blend(),
                       "scale_x": self.option_pane.watermark_options.scale_x.get(),
-                      "scale_y": self.option_pane.watermark_options.scale_y.get()}
+                      "scale_y": self.option_pane.watermark_options.scale_y.get(),
+                      "output_size": self.option_pane.output_selector.get_output_size()}
             output = self.option_pane.get_output_path()
             print(output)
+            decode_cache = self.get_decode_cache()
         except BadOptionError as e:
             self.handle_error(e)
             return
+        if decode_cache:
+            kwargs["decode_cache"] = decode_cache
         self.running = True
         self.option_pane.output_selector.lock()
-        thread = threading.Thread(target=self.work,
+        thread = threading.Thread(target=self.estimate_and_work,
                                   kwargs=kwargs, args=(output, ))
-        self.time_tracker.start()
         thread.start()
 
+    def estimate_and_work(self, outpath, **kwargs):
+        """
+        Read the headers of every file, skipping the unreadable ones,
+        estimate the cost of big batches to seed the remaining time,
+        then start working
+        """
+        from FreeMark.tools.probe import probe_images
+
+        files = self.file_selector.get_file_paths()
+        self.estimate_text.set("Reading {} files...".format(len(files)))
+        infos = probe_images(files)
+        readable = [info for info in infos if not info.corrupt]
+        for info in infos:
+            if info.corrupt:
+                print("Skipping unreadable file\n", info.path, info.error)
+        skipped = len(infos) - len(readable)
+        if not readable:
+            # Nothing to time or mark, give the controls back
+            self.reset()
+            self.running = False
+            self.estimate_text.set("All {} files are unreadable"
+                                   .format(skipped))
+            return
+        self.estimate_text.set("Skipping {} unreadable files".format(skipped)
+                               if skipped else "")
+        self.fill_que(readable)
+
+        from FreeMark.tools.autotune import ConcurrencyTuner
+
+        # Starts from what was fastest for this output folder last time
+        tuner = ConcurrencyTuner.remembered(self.config, outpath,
+                                            kinds=("processes", ),
+                                            max_workers=self.max_workers)
+
+        if len(readable) >= self.estimate_threshold:
+            from FreeMark.tools.estimator import estimate_batch
+
+            self.estimate_text.set("Estimating...")
+            try:
+                estimate = estimate_batch(self.option_pane.get_watermark_path(),
+                                          [info.path for info in readable],
+                                          workers=tuner.get_config()[1],
+                                          infos=readable, **kwargs)
+            except Exception as e:
+                print("Couldn't estimate batch\n", e)
+                self.estimate_text.set("")
+            else:
+                print("Estimate:", estimate)
+                self.estimate_text.set("Estimated output: {:.0f} MB".format(
+                    estimate.output_bytes / 2**20))
+                # The tracker counts pixels, so a few average images worth
+                average = sum(self.pixels.values()) / len(self.pixels)
+                self.time_tracker.set_prior(estimate.seconds_per_image / average,
+                                            weight=5 * average)
+        # Stop might have been pressed while estimating
+        if not self.running:
+            self.reset()
+            return
+        self.time_tracker.start()
+        self.work(outpath, tuner, **kwargs)
+
     def reset(self):
         """
         Reset the worker, emptying queue, resetting vars and buttons and stuff.
         """
-        self.image_que = queue.Queue()
-        self.watermarker = WaterMarker
+        self.image_que = PriorityWorkQueue()
+        self.pixels = {}
+        self.watermarker = None
         self.progress_var.set(0)
         self.progress_bar.stop()
         self.time_tracker.stop()
         self.file_count.set(0)
+        self.estimate_text.set("")
         self.start_button.config(state=NORMAL)
         self.stop_button.config(state=DISABLED)
         self.option_pane.output_selector.unlock()
@@ -158,39 +287,78 @@ class Worker(Frame):
         self.reset()
         messagebox.showerror("Error", str(e))
 
-    def work(self, outpath, **kwargs):
+    def jobs(self, outpath):
         """
-        Work instructions for the child workers
-        keep grabbing a new image path and then apply free_mark with
-        the watermarker, using option pane to create paths.
-        Controls progress bar and timer_tracker as well
+        Hand out jobs from the que until it's empty or the worker is stopped
+        :param outpath: output folder
+        :return: generator of Job objects
         """
+        from FreeMark.tools.batch import Job
+
         while self.running:
             try:
                 input_path = self.image_que.get(block=False)
             except queue.Empty:
-                self.start_button.config(state=NORMAL)
-                self.stop_button.config(state=DISABLED)
-                self.option_pane.output_selector.unlock()
-                self.progress_var.set(0)
-                self.file_count.set(0)
-                self.running = False
                 return
-            try:
-                self.watermarker.apply_watermark(input_path,
-                                                 self.option_pane.create_output_path(input_path, outpath),
-                                                 **kwargs)
-            except BadOptionError as e:
-                self.handle_error(e)
-                print("Bad config, stopping\n", e)
-                return
-            except Exception as e:
-                print("Error!\n", type(e), "\n", e)
-            self.progress_bar.step(amount=1)
-            self.time_tracker.step()
-            self.progress_var.set(self.progress_var.get()+1)
+            yield Job(input_path,
+                      self.option_pane.create_output_path(input_path, outpath))
 
-        self.reset()
+    def work(self, outpath, tuner, **kwargs):
+        """
+        Work instructions for the child workers
+        keep grabbing a new image path and then apply free_mark with
+        the watermarker, using option pane to create paths.
+        Controls progress bar and timer_tracker as well
+        :param outpath: output folder
+        :param tuner: ConcurrencyTuner picking the amount of workers
+        """
+        from concurrent.futures import CancelledError
+        from FreeMark.tools.batch import FAILED
+        from FreeMark.tools.pool import RecyclingPool
+
+        # Processes so a hung image can be killed, and so stop doesn't
+        # have to wait for the images being worked on
+        self.pool = RecyclingPool(tuner.max_workers,
+                                  timeout=self.get_image_timeout())
+        # Unordered so bumped files show up as soon as they're done
+        results = self.watermarker.apply_many(self.jobs(outpath),
+                                              ordered=False,
+                                              executor=self.pool,
+                                              tuner=tuner, **kwargs)
+        try:
+            for result in results:
+                if result.status == FAILED:
+                    if isinstance(result.error, BadOptionError):
+                        results.close()
+                        self.handle_error(result.error)
+                        print("Bad config, stopping\n", result.error)
+                        return
+                    if not isinstance(result.error, CancelledError):
+                        print("Error!\n", type(result.error), "\n",
+                              result.error)
+                self.progress_bar.step(amount=1)
+                self.time_tracker.step(self.pixels.get(result.input_path, 1))
+                self.progress_var.set(self.progress_var.get()+1)
+        finally:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            print("Workers:", tuner)
+            tuner.remember(self.config, outpath)
+
+        if not self.running:
+            # Stopped before the que was empty
+            self.reset()
+            return
+        self.start_button.config(state=NORMAL)
+        self.stop_button.config(state=DISABLED)
+        self.option_pane.output_selector.unlock()
+        self.progress_var.set(0)
+        self.file_count.set(0)
+        self.running = False
 
     def stop_work(self):
-        self.running = False
\ No newline at end of file
+        self.running = False
+        pool = self.pool
+        if pool:
+            # Kills the workers of the images being marked right away
+            pool.cancel()
\ No newline at end of file
@@ -1,11 +1,15 @@
-from tkinter import Tk
-from FreeMark.FreeMark_app import FreeMarkApp
+import argparse
+import multiprocessing
+import time
 
 
-def main():
+def start_gui(args=None):
     """
-    Main method, starts TK and loads Watermark
+    Starts TK and loads Watermark
     """
+    from tkinter import Tk
+    from FreeMark.FreeMark_app import FreeMarkApp
+
     root = Tk()
     root.title('FreeMark')
     root.iconbitmap('logo.ico')
@@ -13,5 +17,413 @@ def main():
     watermark = FreeMarkApp(master=root)
     watermark.mainloop()
 
+
+def opacity_argument(value):
+    """Parse --opacity, a number or 'auto'"""
+    if value.lower() == "auto":
+        return "auto"
+    return float(value)
+
+
+def size_argument(value):
+    """Parse --max-size, a long edge like 2048 or a box like 1920x1080"""
+    from FreeMark.tools.errors import BadOptionError
+    from FreeMark.tools.help import parse_size
+
+    try:
+        return parse_size(value)
+    except BadOptionError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_watermark_arguments(parser):
+    """
+    Add the options shared by every mode which applies a watermark
+    :param parser: argparse parser
+    """
+    from FreeMark.tools.help import BLEND_MODES
+
+    parser.add_argument("--watermark", required=True,
+                        help="path to the watermark image")
+    parser.add_argument("--pos", default="SE",
+                        help="corner, first char N/S and second E/W, "
+                             "or AUTO for the corner with the least detail")
+    parser.add_argument("--padx", type=int, default=20)
+    parser.add_argument("--pady", type=int, default=5)
+    parser.add_argument("--unit-x", default="px", choices=["px", "%"])
+    parser.add_argument("--unit-y", default="px", choices=["px", "%"])
+    parser.add_argument("--opacity", type=opacity_argument, default=1.0,
+                        help="watermark opacity between 0 and 1, or 'auto' "
+                             "to pick it from the area under the watermark")
+    parser.add_argument("--opacity-curve", default=None,
+                        help="difficulty:opacity points for --opacity auto, "
+                             "e.g. 0:0.3,1:0.9")
+    parser.add_argument("--opacity-variants", action="store_true",
+                        help="let --opacity auto use light or dark copies "
+                             "of the watermark")
+    parser.add_argument("--blend", default="normal", choices=BLEND_MODES,
+                        help="how the watermark is mixed with the image")
+    parser.add_argument("--scale-x", type=float, default=1.0)
+    parser.add_argument("--scale-y", type=float, default=1.0)
+    parser.add_argument("--max-size", type=size_argument,
+                        help="shrink images to a max long edge (2048) or to "
+                             "fit a box (1920x1080) before marking them")
+    parser.add_argument("--layers", metavar="JSON_FILE",
+                        help="JSON list of watermark layers, e.g. "
+                             "[{\"watermark\": \"logo.png\", \"pos\": \"NW\"}], "
+                             "applied instead of the single watermark")
+
+
+def watermark_kwargs(args):
+    """
+    Turn parsed watermark arguments into apply_watermark kwargs
+    :param args: argparse namespace
+    :return: dict of kwargs
+    """
+    kwargs = {"pos": args.pos,
+              "padding": ((args.padx, args.unit_x), (args.pady, args.unit_y)),
+              "opacity": args.opacity,
+              "scale_x": args.scale_x,
+              "scale_y": args.scale_y,
+              "blend": args.blend}
+    if args.opacity == "auto":
+        from FreeMark.tools.adaptive import AdaptiveOpacity, DEFAULT_CURVE
+        kwargs["opacity"] = AdaptiveOpacity(args.opacity_curve or DEFAULT_CURVE,
+                                            variants=args.opacity_variants)
+    if args.max_size:
+        kwargs["output_size"] = args.max_size
+    if args.layers:
+        import json
+        with open(args.layers) as layers_file:
+            kwargs["layers"] = json.load(layers_file)
+    if getattr(args, "variants", None):
+        import json
+        from FreeMark.tools.variants import get_variants
+        with open(args.variants) as variants_file:
+            kwargs["variants"] = get_variants(json.load(variants_file))
+    return kwargs
+
+
+def add_metrics_arguments(parser, port=True):
+    """
+    Add the options for exporting Prometheus metrics
+    :param parser: argparse parser
+    :param port: also offer serving the metrics over HTTP
+    """
+    parser.add_argument("--metrics-file",
+                        help="write Prometheus metrics to this file, "
+                             "e.g. for node_exporter's textfile collector")
+    parser.add_argument("--metrics-interval", type=float, default=15,
+                        help="seconds between writes of --metrics-file")
+    if port:
+        parser.add_argument("--metrics-port", type=int,
+                            help="serve Prometheus metrics on "
+                                 "http://127.0.0.1:PORT/metrics")
+
+
+def start_metrics(args):
+    """
+    Start exporting metrics as asked for by the arguments
+    :param args: argparse namespace
+    :return: function stopping the export
+    """
+    from FreeMark.tools.metrics import MetricsWriter, serve_metrics
+
+    writer = server = None
+    if args.metrics_file:
+        writer = MetricsWriter(args.metrics_file, args.metrics_interval)
+        writer.start()
+    if getattr(args, "metrics_port", None):
+        server = serve_metrics(port=args.metrics_port)
+        print("Metrics on http://127.0.0.1:{}/metrics".format(args.metrics_port))
+
+    def stop():
+        if writer:
+            writer.stop()
+        if server:
+            server.shutdown()
+            server.server_close()
+    return stop
+
+
+def watch(args):
+    """
+    Watch a folder and watermark images as they arrive, until interrupted
+    """
+    from FreeMark.tools.watcher import FolderWatcher
+
+    watcher = FolderWatcher(args.watch_dir, args.output_dir, args.watermark,
+                            workers=args.workers,
+                            poll_interval=args.poll_interval,
+                            settle_time=args.settle_time,
+                            overwrite=args.overwrite,
+                            **watermark_kwargs(args))
+    stop_metrics = start_metrics(args)
+    watcher.start()
+    print("Watching", args.watch_dir)
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            stats = watcher.get_stats()
+            print("processed: {processed} failed: {failed} "
+                  "backlog: {backlog} throughput: {throughput:.2f}/s "
+                  "latency: {mean_latency:.2f}s".format(**stats))
+    except KeyboardInterrupt:
+        print("Stopping")
+    watcher.stop()
+    stop_metrics()
+
+
+def serve(args):
+    """
+    Run the local watermarking HTTP service until interrupted
+    """
+    from FreeMark.tools.server import create_server
+
+    server = create_server(args.watermark, host=args.host, port=args.port,
+                           workers=args.workers, max_queued=args.max_queued)
+    stop_metrics = start_metrics(args)
+    print("Serving on http://{}:{}/watermark".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    server.server_close()
+    server.service.shutdown()
+    stop_metrics()
+
+
+def estimate(args):
+    """
+    Estimate how long watermarking a folder will take
+    """
+    import os
+    from FreeMark.tools.estimator import estimate_batch
+    from FreeMark.tools.help import is_image_file
+
+    paths = [os.path.join(args.input_dir, name)
+             for name in os.listdir(args.input_dir) if is_image_file(name)]
+    print(estimate_batch(args.watermark, paths, workers=args.workers,
+                         sample_size=args.samples, **watermark_kwargs(args)))
+
+
+def archive(args):
+    """
+    Watermark the images in a zip/tar archive into a new archive
+    """
+    import sys
+    from FreeMark.tools.archive import mark_archive
+
+    marked, failed = mark_archive(args.watermark, args.source,
+                                  args.destination,
+                                  archive_format=args.archive_format,
+                                  output_format=args.format,
+                                  workers=args.workers,
+                                  max_in_flight=args.max_in_flight,
+                                  **watermark_kwargs(args))
+    # stdout might be the archive itself
+    print("Marked {} images, {} failed".format(marked, len(failed)),
+          file=sys.stderr)
+    if failed:
+        print("Copied unmarked: " + ", ".join(name for name, _ in failed),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def distribute_submit(args):
+    """
+    Split a folder of images into shards in a shared queue folder
+    """
+    import os
+    from FreeMark.tools.distributed import submit_batch
+    from FreeMark.tools.help import is_image_file
+
+    # Stored as absolute paths, every node must mount the share at the
+    # same place
+    input_dir = os.path.abspath(args.input_dir)
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = ((os.path.join(input_dir, name), os.path.join(output_dir, name))
+            for name in sorted(os.listdir(input_dir)) if is_image_file(name))
+    shards = submit_batch(args.queue_dir, os.path.abspath(args.watermark),
+                          jobs, shard_size=args.shard_size,
+                          overwrite=args.overwrite, **watermark_kwargs(args))
+    print("Wrote {} shards to {}".format(shards, args.queue_dir))
+
+
+def distribute_work(args):
+    """
+    Work on the shards of a queue folder until they're all done
+    """
+    import threading
+    from FreeMark.tools.distributed import ShardWorker
+
+    worker = ShardWorker(args.queue_dir, worker_id=args.worker_id,
+                         workers=args.workers, executor=args.executor,
+                         lease_timeout=args.lease_timeout,
+                         timeout=args.image_timeout)
+    stop_metrics = start_metrics(args)
+    print("Working on", args.queue_dir, "as", worker.worker_id)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        # The images being marked are finished, the rest of the shard is
+        # put back for the other workers
+        print("Stopping")
+        worker.stop()
+        thread.join()
+    stop_metrics()
+    print("Marked {} images in {} shards".format(worker.images_done,
+                                                 worker.shards_done))
+
+
+def distribute_status(args):
+    """
+    Show the progress of a queue folder
+    """
+    from FreeMark.tools.distributed import get_status
+
+    status = get_status(args.queue_dir)
+    print("shards: {shards} pending: {pending} leased: {leased} "
+          "done: {done} failed images: {failed}".format(**status))
+    for worker_id, shards in sorted(status["workers"].items()):
+        print("  {}: {}".format(worker_id, ", ".join(sorted(shards))))
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments, no command starts the GUI
+    :param argv: list of arguments, defaults to sys.argv
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(prog="FreeMark",
+                                     description="Watermark images, easily")
+    parser.set_defaults(func=start_gui)
+    commands = parser.add_subparsers(title="commands")
+
+    watch_parser = commands.add_parser("watch",
+                                       help="watermark images as they "
+                                            "land in a folder")
+    watch_parser.add_argument("watch_dir")
+    watch_parser.add_argument("output_dir")
+    add_watermark_arguments(watch_parser)
+    watch_parser.add_argument("--workers", type=int, default=2)
+    watch_parser.add_argument("--poll-interval", type=float, default=0.2)
+    watch_parser.add_argument("--settle-time", type=float, default=0.3,
+                              help="seconds a file must be unchanged "
+                                   "before it's marked")
+    watch_parser.add_argument("--stats-interval", type=float, default=10)
+    watch_parser.add_argument("--overwrite", action="store_true")
+    watch_parser.add_argument("--variants", metavar="JSON_FILE",
+                              help="JSON list of output variants, e.g. "
+                                   "[{\"size\": 1600, \"subfolder\": \"web\", "
+                                   "\"profile\": \"web\"}], each written "
+                                   "from a single decode")
+    add_metrics_arguments(watch_parser)
+    watch_parser.set_defaults(func=watch)
+
+    serve_parser = commands.add_parser("serve",
+                                       help="run a local HTTP service "
+                                            "which watermarks uploaded images")
+    serve_parser.add_argument("--watermark", required=True,
+                              help="path to the watermark image")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--workers", type=int, default=4)
+    serve_parser.add_argument("--max-queued", type=int, default=8,
+                              help="images allowed to wait for a worker "
+                                   "before requests are rejected with 503")
+    # The service serves its own metrics at /metrics
+    add_metrics_arguments(serve_parser, port=False)
+    serve_parser.set_defaults(func=serve)
+
+    estimate_parser = commands.add_parser("estimate",
+                                          help="estimate time, output size "
+                                               "and memory of a batch")
+    estimate_parser.add_argument("input_dir")
+    add_watermark_arguments(estimate_parser)
+    estimate_parser.add_argument("--workers", type=int, default=1)
+    estimate_parser.add_argument("--samples", type=int, default=8,
+                                 help="amount of images actually marked")
+    estimate_parser.set_defaults(func=estimate)
+
+    archive_parser = commands.add_parser("archive",
+                                         help="watermark images straight "
+                                              "from one archive into another")
+    archive_parser.add_argument("source",
+                                help="zip or tar file, '-' for a tar on stdin")
+    archive_parser.add_argument("destination",
+                                help="zip or tar file, '-' for stdout")
+    add_watermark_arguments(archive_parser)
+    archive_parser.add_argument("--archive-format", choices=["zip", "tar"],
+                                help="output archive type, guessed from the "
+                                     "destination by default")
+    archive_parser.add_argument("--format",
+                                help="image format of the output, e.g. JPEG")
+    archive_parser.add_argument("--workers", type=int, default=2)
+    archive_parser.add_argument("--max-in-flight", type=int, default=8,
+                                help="max images held in memory at once")
+    archive_parser.set_defaults(func=archive)
+
+    distribute_parser = commands.add_parser("distribute",
+                                            help="split a batch over several "
+                                                 "machines through a shared "
+                                                 "folder")
+    distribute_commands = distribute_parser.add_subparsers(title="commands",
+                                                           required=True)
+    submit_parser = distribute_commands.add_parser(
+        "submit", help="write the images of a folder to a queue folder")
+    submit_parser.add_argument("queue_dir",
+                               help="new folder on a drive every node mounts")
+    submit_parser.add_argument("input_dir")
+    submit_parser.add_argument("output_dir")
+    add_watermark_arguments(submit_parser)
+    submit_parser.add_argument("--shard-size", type=int, default=50,
+                               help="images leased to a worker at a time")
+    submit_parser.add_argument("--overwrite", action="store_true")
+    submit_parser.add_argument("--variants", metavar="JSON_FILE",
+                               help="JSON list of output variants, see watch")
+    submit_parser.set_defaults(func=distribute_submit)
+
+    work_parser = distribute_commands.add_parser(
+        "work", help="mark shards of a queue folder, run one on every node")
+    work_parser.add_argument("queue_dir")
+    work_parser.add_argument("--workers", type=int, default=None,
+                             help="images marked at once, defaults to the "
+                                  "amount of CPUs")
+    work_parser.add_argument("--executor", default="processes",
+                             choices=["serial", "threads", "processes"])
+    work_parser.add_argument("--lease-timeout", type=float, default=60,
+                             help="seconds without a heartbeat before a "
+                                  "worker's shard is taken back")
+    work_parser.add_argument("--image-timeout", type=float, default=None,
+                             help="seconds an image may take")
+    work_parser.add_argument("--worker-id",
+                             help="name in the lease files, defaults to "
+                                  "host-pid")
+    add_metrics_arguments(work_parser)
+    work_parser.set_defaults(func=distribute_work)
+
+    status_parser = distribute_commands.add_parser(
+        "status", help="show the progress of a queue folder")
+    status_parser.add_argument("queue_dir")
+    status_parser.set_defaults(func=distribute_status)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Main method, runs the chosen command or the GUI
+    """
+    # Worker processes of frozen builds start by running this file again
+    multiprocessing.freeze_support()
+    args = parse_args(argv)
+    args.func(args)
+
+
 if __name__ == '__main__':
     main()
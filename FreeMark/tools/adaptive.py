@@ -0,0 +1,162 @@
+from PIL import Image, ImageStat
+
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import clamp
+
+AUTO = "auto"
+# (difficulty, opacity) points, see AdaptiveOpacity.get_difficulty
+DEFAULT_CURVE = ((0.0, 0.3), (1.0, 0.9))
+
+
+def parse_curve(value):
+    """
+    Parse a curve string like '0:0.3,0.5:0.5,1:0.9'
+    :param value: comma separated difficulty:opacity points
+    :return: tuple of (difficulty, opacity) sorted by difficulty
+    """
+    try:
+        points = [tuple(float(number) for number in point.split(":"))
+                  for point in value.split(",")]
+    except ValueError:
+        raise BadOptionError("Opacity curve points must look like 0.5:0.6")
+    if not points or any(len(point) != 2 for point in points):
+        raise BadOptionError("Opacity curve points must look like 0.5:0.6")
+    if not all(0 <= number <= 1 for point in points for number in point):
+        raise BadOptionError("Opacity curve values must be between 0 and 1.")
+    return tuple(sorted(points))
+
+
+def get_adaptive(opacity):
+    """
+    Get the AdaptiveOpacity settings an opacity option asks for
+    :param opacity: a number, 'auto' or an AdaptiveOpacity object
+    :return: AdaptiveOpacity object, or None for a fixed opacity
+    """
+    if isinstance(opacity, AdaptiveOpacity):
+        return opacity
+    if isinstance(opacity, str) and opacity.lower().strip() == AUTO:
+        return AdaptiveOpacity()
+    return None
+
+
+class AdaptiveOpacity:
+    """
+    Settings for picking the opacity of a watermark from the luminance and
+    contrast of the area it covers. Only holds settings so it can be passed
+    around as an option, the WaterMarker keeps the precomputed levels.
+    """
+    def __init__(self, curve=DEFAULT_CURVE, variants=False, levels=12):
+        """
+        :param curve: (difficulty, opacity) points, linearly interpolated
+        :param variants: also try solid light and dark copies of the
+                         watermark and use whichever stands out the most
+        :param levels: amount of opacities between the lowest and highest
+                       of the curve that are made up front and reused
+        """
+        if isinstance(curve, str):
+            curve = parse_curve(curve)
+        self.curve = tuple(sorted((float(x), float(y)) for x, y in curve))
+        if not self.curve:
+            raise BadOptionError("The opacity curve needs at least one point.")
+        self.variants = variants
+        self.levels = max(int(levels), 2)
+
+    @property
+    def key(self):
+        """Hashable summary of the settings, for caching"""
+        return self.curve, self.variants, self.levels
+
+    def __repr__(self):
+        return "AdaptiveOpacity({!r}, variants={!r}, levels={!r})".format(
+            self.curve, self.variants, self.levels)
+
+    def get_opacities(self):
+        """
+        :return: list of the opacity levels, lowest first
+        """
+        low = min(opacity for _, opacity in self.curve)
+        high = max(opacity for _, opacity in self.curve)
+        return [low + (high - low) * i / (self.levels - 1)
+                for i in range(self.levels)]
+
+    def get_opacity(self, difficulty):
+        """
+        Look up the curve
+        :param difficulty: number between 0 and 1
+        :return: opacity between 0 and 1
+        """
+        points = self.curve
+        if difficulty <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if difficulty <= x1:
+                if x1 == x0:
+                    return y1
+                return y0 + (y1 - y0) * (difficulty - x0) / (x1 - x0)
+        return points[-1][1]
+
+    @staticmethod
+    def get_difficulty(mark_luma, mean, stddev):
+        """
+        How hard a watermark is to see on a background, 0 when it stands
+        out clearly and 1 when it blends in. Low luminance contrast and
+        a lot of texture both make it harder to see.
+        :param mark_luma: average luminance of the watermark (0-255)
+        :param mean: average luminance of the background (0-255)
+        :param stddev: standard deviation of the background's luminance
+        :return: number between 0 and 1
+        """
+        contrast = abs(mark_luma - mean) / 255
+        texture = min(stddev / 128, 1.0)
+        return clamp(1 - contrast + texture / 2, 0.0, 1.0)
+
+    def make_levels(self, watermark):
+        """
+        Make every opacity level of a watermark, and of its light and dark
+        variants if they're used
+        :param watermark: scaled free_mark at full opacity, PIL image object
+        :return: list of (average luminance, list of level images)
+        """
+        from FreeMark.tools.watermarker import WaterMarker
+
+        watermark = watermark.convert("RGBA")
+        alpha = watermark.getchannel("A")
+        variants = [watermark]
+        if self.variants:
+            for color in ((255, 255, 255), (0, 0, 0)):
+                solid = Image.new("RGBA", watermark.size, color)
+                solid.putalpha(alpha)
+                variants.append(solid)
+
+        made = []
+        for variant in variants:
+            # Only the visible part of the watermark counts
+            luma = ImageStat.Stat(variant.convert("L"), mask=alpha).mean[0]
+            made.append((luma, [WaterMarker.change_opacity(variant, opacity)
+                                for opacity in self.get_opacities()]))
+        return made
+
+    def choose(self, levels, background):
+        """
+        Pick the variant and opacity level for a background
+        :param levels: what make_levels returned
+        :param background: the part of the image under the watermark
+        :return: PIL image object of the watermark to paste
+        """
+        # The stats don't need every pixel, a small proxy keeps them cheap
+        # even when the watermark covers a big area
+        if max(background.size) > 128:
+            scale = 128 / max(background.size)
+            background = background.resize(
+                (max(1, int(background.size[0] * scale)),
+                 max(1, int(background.size[1] * scale))), Image.NEAREST)
+        stat = ImageStat.Stat(background.convert("L"))
+        mean, stddev = stat.mean[0], stat.stddev[0]
+
+        luma, images = min(levels, key=lambda level: self.get_difficulty(
+            level[0], mean, stddev))
+        opacity = self.get_opacity(self.get_difficulty(luma, mean, stddev))
+        opacities = self.get_opacities()
+        nearest = min(range(len(opacities)),
+                      key=lambda i: abs(opacities[i] - opacity))
+        return images[nearest]
@@ -0,0 +1,200 @@
+import io
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import is_image_file
+from FreeMark.tools.reader import BufferPool, read_stream
+
+
+def is_zip(path):
+    return path.lower().endswith(".zip")
+
+
+def read_members(source, pool=None):
+    """
+    Read the files in an archive one after the other, in archive order
+    :param source: path to a zip or tar file (optionally compressed),
+                   or '-' for a tar stream on stdin
+    :param pool: optional BufferPool (see FreeMark.tools.reader), members
+                 are then read into recycled buffers and given as
+                 BufferStreams, which must be closed once they're used
+    :return: generator of (member path, bytes or BufferStream,
+             modification time)
+    """
+    def read(member_file, size, name):
+        if pool is None:
+            return member_file.read()
+        return read_stream(member_file, pool, size, name)
+
+    if source == "-":
+        # 'r|*' reads the stream strictly forwards, it never seeks
+        with tarfile.open(fileobj=sys.stdin.buffer, mode="r|*") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield (member.name, read(tar.extractfile(member),
+                                             member.size, member.name),
+                           member.mtime)
+    elif is_zip(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    mtime = time.mktime(member.date_time + (0, 0, -1))
+                    with archive.open(member) as member_file:
+                        data = read(member_file, member.file_size,
+                                    member.filename)
+                    yield member.filename, data, mtime
+    else:
+        with tarfile.open(source, mode="r|*") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield (member.name, read(tar.extractfile(member),
+                                             member.size, member.name),
+                           member.mtime)
+
+
+class ArchiveWriter:
+    """
+    Writes files into a zip or tar archive, without ever seeking,
+    so it can write to stdout as well
+    """
+    def __init__(self, destination, archive_format=None):
+        """
+        :param destination: path to the archive, or '-' for stdout
+        :param archive_format: 'zip' or 'tar', guessed from the path if None,
+                               stdout defaults to tar
+        """
+        if archive_format is None:
+            archive_format = "zip" if is_zip(destination) else "tar"
+        if archive_format not in ("zip", "tar"):
+            raise BadOptionError("Archive format must be zip or tar.")
+        self.archive_format = archive_format
+
+        fileobj = sys.stdout.buffer if destination == "-" else None
+        if archive_format == "zip":
+            # Images are already compressed, so store them as they are
+            self.archive = zipfile.ZipFile(fileobj or destination, "w",
+                                           compression=zipfile.ZIP_STORED)
+        else:
+            compression = ""
+            for extension, name in ((".gz", "gz"), (".tgz", "gz"),
+                                    (".bz2", "bz2"), (".xz", "xz")):
+                if destination.lower().endswith(extension):
+                    compression = name
+            self.archive = tarfile.open(destination if fileobj is None else None,
+                                        mode="w|" + compression,
+                                        fileobj=fileobj)
+
+    def add(self, name, data, mtime=None):
+        """
+        Add a file to the archive
+        :param name: path of the file inside the archive
+        :param data: content of the file as bytes
+        :param mtime: modification time, defaults to now
+        """
+        mtime = mtime or time.time()
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+def get_output_name(name, output_format=None):
+    """
+    Get the name of a marked member, only the extension changes and only
+    if a different output format was asked for
+    :param name: path of the member in the input archive
+    :param output_format: PIL format name or None
+    :return: path of the member in the output archive
+    """
+    if not output_format:
+        return name
+    extension = {"JPEG": ".jpg", "TIFF": ".tiff"}.get(output_format.upper(),
+                                                     "." + output_format.lower())
+    return os.path.splitext(name)[0] + extension
+
+
+def mark_archive(watermark_path, source, destination, archive_format=None,
+                 output_format=None, workers=2, max_in_flight=8, **kwargs):
+    """
+    Watermark every image in an archive straight into a new archive,
+    members are read and written in order so the job does one sequential
+    read and one sequential write, and at most max_in_flight members
+    are held in memory
+    :param watermark_path: path to the watermark image
+    :param source: path to a zip or tar file, or '-' for a tar on stdin
+    :param destination: path to the output archive, or '-' for stdout
+    :param archive_format: 'zip' or 'tar', guessed from destination if None
+    :param output_format: PIL format name, defaults to each image's format
+    :param workers: amount of images processed at the same time
+    :param max_in_flight: max amount of members read but not yet written
+    :param kwargs: options passed on to mark_image
+    :return: (amount of images marked, list of (member path, error)),
+             failed members are copied to the new archive unmarked
+    """
+    # Load the watermark once up front so a bad path fails immediately
+    WaterMarker(watermark_path)
+    local = threading.local()
+
+    def process(data):
+        if not hasattr(local, "watermarker"):
+            local.watermarker = WaterMarker(watermark_path)
+        return local.watermarker.apply_watermark_data(
+            data, output_format=output_format, **kwargs)
+
+    marked = 0
+    failed = []
+    in_flight = deque()
+    writer = ArchiveWriter(destination, archive_format)
+
+    def write_oldest():
+        nonlocal marked
+        name, future, data, mtime = in_flight.popleft()
+        try:
+            if future is None:
+                # Not an image, copied over as it is
+                writer.add(name, data.read(), mtime)
+                return
+            writer.add(get_output_name(name, output_format), future.result(), mtime)
+            marked += 1
+        except Exception as e:
+            print("Error!\n", name, type(e), "\n", e, file=sys.stderr)
+            failed.append((name, e))
+            # Kept as it was rather than left out of the archive
+            data.seek(0)
+            writer.add(name, data.read(), mtime)
+        finally:
+            # Its buffer goes to a member read later on
+            data.close()
+
+    # A buffer for every member in flight, plus the one being read
+    pool = BufferPool(max_buffers=max_in_flight + 1)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for name, data, mtime in read_members(source, pool):
+                if is_image_file(name):
+                    in_flight.append((name, executor.submit(process, data),
+                                      data, mtime))
+                else:
+                    in_flight.append((name, None, data, mtime))
+                while len(in_flight) >= max_in_flight:
+                    write_oldest()
+            while in_flight:
+                write_oldest()
+    finally:
+        writer.close()
+    return marked, failed
@@ -0,0 +1,245 @@
+import configparser
+import os
+import threading
+import time
+
+from FreeMark.tools.batch import DONE
+from FreeMark.tools.errors import BadOptionError
+
+KINDS = ("processes", "threads")
+# options.ini section holding the settings found for an output folder
+SECTION_PREFIX = "AUTOTUNE "
+
+
+class ConcurrencyTuner:
+    """
+    Picks the amount of workers, and whether they're threads or processes,
+    while a batch runs. Throughput is measured over a window of a few
+    seconds for each setting, then the amount is moved up as long as
+    that's faster, or down as long as that isn't slower (hill climbing).
+    When the amount stops paying off the other kind of worker is tried at
+    the best amount, after that the fastest setting is kept for the rest
+    of the batch.
+    Throughput is counted in bytes of input pr. second, so a few big
+    images in a window don't look like a slower setting. An image running
+    across the start of a window only counts with the part of its time
+    inside the window.
+    Memory is left to apply_many's memory_budget, when that holds jobs
+    back more workers simply aren't faster and the climb stops.
+    """
+    def __init__(self, kinds=KINDS, start=None, min_workers=1,
+                 max_workers=None, window=3.0, min_gain=0.05):
+        """
+        :param kinds: kinds of workers to try, 'processes' and/or 'threads'
+        :param start: (kind, workers) to start from, e.g. what was found
+                      for the same output folder last time
+        :param min_workers: fewest workers to try
+        :param max_workers: most workers to try, defaults to the amount of
+                            CPUs
+        :param window: min seconds each setting is measured for
+        :param min_gain: how much faster (0.05 = 5%) a setting must be to
+                         count as better, below that it's noise
+        """
+        for kind in kinds:
+            if kind not in KINDS:
+                raise BadOptionError("Workers must be one of {}."
+                                     .format(", ".join(KINDS)))
+        if not kinds:
+            raise BadOptionError("Give at least one kind of worker.")
+        self.kinds = tuple(kinds)
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers or os.cpu_count() or 1,
+                               self.min_workers)
+        self.window = window
+        self.min_gain = min_gain
+
+        kind, workers = start or (self.kinds[0], min(2, self.max_workers))
+        if kind not in self.kinds:
+            kind = self.kinds[0]
+        self.kind = kind
+        self.workers = min(max(int(workers), self.min_workers),
+                           self.max_workers)
+
+        self.lock = threading.Lock()
+        self.tried_kinds = {kind}
+        self.direction = 1
+        self.best = None            # (kind, workers, bytes pr. second)
+        self.local_best = None      # the best of the current kind
+        self.converged = False
+        self.history = []           # (kind, workers, bytes pr. second)
+        # The first window of a kind also pays for starting its workers
+        self.warming_up = True
+        self.start_window()
+
+    def __repr__(self):
+        return "ConcurrencyTuner({}, {} workers{})".format(
+            self.kind, self.workers, ", converged" if self.converged else "")
+
+    @classmethod
+    def remembered(cls, config, location, **kwargs):
+        """
+        Make a tuner starting from what was found for an output folder before
+        :param config: Config object (see FreeMark.tools.config)
+        :param location: the output folder
+        :param kwargs: other ConcurrencyTuner options
+        :return: ConcurrencyTuner object
+        """
+        return cls(start=load_tuning(config, location), **kwargs)
+
+    def remember(self, config, location):
+        """
+        Save the best setting found for an output folder, if there's one
+        :param config: Config object
+        :param location: the output folder
+        """
+        with self.lock:
+            best = self.best
+        if best:
+            save_tuning(config, location, best[0], best[1])
+
+    def get_config(self):
+        """
+        :return: (kind, workers) to run with right now
+        """
+        with self.lock:
+            return self.kind, self.workers
+
+    def start_window(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0.0
+        self.window_results = 0
+
+    def record(self, result):
+        """
+        Count a finished job, moves to the next setting when the window is over
+        :param result: batch Result object
+        """
+        now = time.monotonic()
+        size = 0
+        if result.status == DONE:
+            try:
+                size = os.path.getsize(result.input_path)
+            except OSError:
+                pass
+        with self.lock:
+            if self.converged:
+                return
+            in_window = now - self.window_start
+            if result.elapsed > in_window:
+                size *= in_window / result.elapsed
+            self.window_bytes += size
+            self.window_results += 1
+            if in_window < self.window \
+                    or self.window_results < 2 * self.workers:
+                return
+            # Only skipped or failed images says nothing about the setting
+            if self.window_bytes and not self.warming_up:
+                self.step(self.window_bytes / in_window)
+            self.warming_up = False
+            self.start_window()
+
+    def step(self, rate):
+        """
+        Pick the next setting from the throughput of the current one
+        :param rate: bytes pr. second measured for the current setting
+        """
+        self.history.append((self.kind, self.workers, rate))
+        local = self.local_best
+        if self.direction == 1:
+            better = local is None or rate > local[2] * (1 + self.min_gain)
+        else:
+            # Fewer workers at the same speed are better, they use less memory
+            better = rate >= local[2] * (1 - self.min_gain)
+        if better:
+            self.local_best = (self.kind, self.workers, rate)
+            if self.best is None or self.best[0] == self.kind \
+                    or rate > self.best[2]:
+                self.best = self.local_best
+            if self.move():
+                return
+        elif self.direction == 1 and local[1] > self.min_workers \
+                and not self.tried(self.kind, local[1] - 1):
+            # More didn't help, see if fewer does
+            self.direction = -1
+            self.workers = local[1]
+            if self.move():
+                return
+        self.next_kind()
+
+    def move(self):
+        """
+        Go on in the current direction, in steps that grow with the amount
+        of workers so big machines don't take forever to climb
+        :return: False if that's outside the limits
+        """
+        workers = self.workers + self.direction * max(1, self.workers // 4)
+        if not self.min_workers <= workers <= self.max_workers:
+            return False
+        self.workers = workers
+        return True
+
+    def next_kind(self):
+        """
+        Climb with the next kind of worker from the best amount so far, or
+        settle on the best setting once every kind has been tried
+        """
+        for kind in self.kinds:
+            if kind not in self.tried_kinds:
+                self.tried_kinds.add(kind)
+                self.kind = kind
+                self.workers = self.best[1]
+                self.direction = 1
+                self.local_best = None
+                self.warming_up = True
+                return
+        self.kind, self.workers = self.best[:2]
+        self.converged = True
+
+    def tried(self, kind, workers):
+        return any(entry[:2] == (kind, workers) for entry in self.history)
+
+
+def get_section(location):
+    return SECTION_PREFIX + os.path.abspath(location)
+
+
+def load_tuning(config, location):
+    """
+    Get the setting found for an output folder
+    :param config: Config object
+    :param location: the output folder
+    :return: (kind, workers), or None if there's none or it's broken
+    """
+    section = get_section(location)
+    if not config.config.has_section(section):
+        return None
+    try:
+        kind = config.config.get(section, "workers_kind")
+        workers = config.config.getint(section, "workers")
+    except (ValueError, configparser.Error):
+        # Broken or half written by hand, start from scratch instead
+        return None
+    if kind not in KINDS or workers < 1:
+        return None
+    return kind, workers
+
+
+def save_tuning(config, location, kind, workers):
+    """
+    Remember a setting for an output folder in the config file
+    :param config: Config object
+    :param location: the output folder
+    :param kind: 'processes' or 'threads'
+    :param workers: amount of workers
+    """
+    section = get_section(location)
+    # Other parts of the app save to the same file
+    config.reload()
+    if not config.config.has_section(section):
+        config.config.add_section(section)
+    config.config.set(section, "workers_kind", kind)
+    config.config.set(section, "workers", str(workers))
+    try:
+        config.save_config()
+    except OSError as e:
+        print("Couldn't save the worker setting\n", e)
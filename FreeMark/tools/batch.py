@@ -0,0 +1,408 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import (Executor, Future, ThreadPoolExecutor,
+                                ProcessPoolExecutor, wait, FIRST_COMPLETED)
+
+from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.errors import ImageTooLargeError
+from FreeMark.tools.metrics import record_result, set_in_flight
+from FreeMark.tools.pool import RecyclingPool
+from FreeMark.tools.probe import probe_image
+from FreeMark.tools.variants import get_variants
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# An image is held decoded, plus a rotated or converted copy while it's
+# marked, so it needs about twice its decoded size
+FOOTPRINT_FACTOR = 2
+
+
+class Job:
+    """
+    A single image to watermark
+    """
+    def __init__(self, input_path, output_path, options=None):
+        """
+        :param input_path: path to image on disk as a string
+        :param output_path: save destination (path) as a string
+        :param options: optional dict of apply_watermark options for just
+                        this image, they override the batch wide options
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.options = options or {}
+
+    def __repr__(self):
+        return "Job({!r}, {!r})".format(self.input_path, self.output_path)
+
+
+class Result:
+    """
+    Outcome of a Job
+    """
+    def __init__(self, job, index, status, error=None, timings=None,
+                 elapsed=0.0, position=None, cache_hits=0, cache_misses=0,
+                 bytes_out=None):
+        """
+        :param job: the Job this is the result of
+        :param index: position of the job in the input
+        :param status: DONE, SKIPPED (output already existed) or FAILED
+        :param error: the exception if the job failed
+        :param timings: dict of seconds spent in each stage
+        :param elapsed: total seconds spent on the job
+        :param position: corner the watermark went in, so runs using
+                         the 'AUTO' position can be reproduced
+        :param cache_hits: scaled watermarks the job took from the cache
+        :param cache_misses: watermarks the job had to scale
+        :param bytes_out: total size of the files written, every variant
+                          counts
+        """
+        self.job = job
+        self.index = index
+        self.status = status
+        self.error = error
+        self.timings = timings or {}
+        self.elapsed = elapsed
+        self.position = position
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
+        self.bytes_out = bytes_out
+
+    @property
+    def input_path(self):
+        return self.job.input_path
+
+    @property
+    def output_path(self):
+        return self.job.output_path
+
+    @property
+    def ok(self):
+        return self.status != FAILED
+
+    def __repr__(self):
+        return "Result({!r}, {}, {:.3f}s)".format(self.input_path, self.status,
+                                                   self.elapsed)
+
+
+def to_job(job):
+    """
+    Turn a (input_path, output_path[, options]) tuple into a Job
+    """
+    if isinstance(job, Job):
+        return job
+    return Job(*job)
+
+
+# WaterMarkers of the current thread (or process), by (path, overwrite)
+_local = threading.local()
+
+
+def get_watermarker(watermark_path, overwrite):
+    """
+    Get a WaterMarker for the current thread, they aren't thread safe
+    but are worth keeping for their cached free_marks
+    :param watermark_path: path to the watermark image
+    :param overwrite: overwrite existing files
+    :return: WaterMarker object
+    """
+    if not hasattr(_local, "watermarkers"):
+        _local.watermarkers = {}
+    key = (watermark_path, overwrite)
+    if key not in _local.watermarkers:
+        _local.watermarkers[key] = WaterMarker(watermark_path, overwrite=overwrite)
+    return _local.watermarkers[key]
+
+
+def run_job(watermark_path, overwrite, job, index, options, watermarker=None):
+    """
+    Run a single job, never raises, errors end up in the Result.
+    Module level so it can be sent to worker processes.
+    :return: Result object
+    """
+    start = time.perf_counter()
+    try:
+        if watermarker is None:
+            watermarker = get_watermarker(watermark_path, overwrite)
+        kwargs = dict(options, **job.options)
+        watermarker.last_position = None
+        hits, misses = watermarker.cache_hits, watermarker.cache_misses
+        written = watermarker.apply_watermark(job.input_path, job.output_path,
+                                              **kwargs)
+    except Exception as e:
+        return Result(job, index, FAILED, error=e,
+                      elapsed=time.perf_counter() - start)
+    elapsed = time.perf_counter() - start
+    bytes_out = None
+    if written:
+        bytes_out = 0
+        for path in watermarker.written:
+            try:
+                bytes_out += os.path.getsize(path)
+            except OSError:
+                pass
+    return Result(job, index, DONE if written else SKIPPED,
+                  timings=dict(watermarker.timings), elapsed=elapsed,
+                  position=watermarker.last_position if written else None,
+                  cache_hits=watermarker.cache_hits - hits,
+                  cache_misses=watermarker.cache_misses - misses,
+                  bytes_out=bytes_out)
+
+
+def largest_first(infos):
+    """
+    Order images so the biggest start first and don't end up running alone
+    at the end of a batch, with images of the same size next to each other
+    so they reuse the same scaled free_mark
+    :param infos: list of ImageInfo objects
+    :return: new list of ImageInfo objects
+    """
+    groups = {}
+    for info in infos:
+        groups.setdefault(info.oriented_size, []).append(info)
+    sizes = sorted(groups, key=lambda size: size[0] * size[1], reverse=True)
+    return [info for size in sizes for info in groups[size]]
+
+
+def get_footprint(job, max_pixels=None):
+    """
+    Estimate the memory needed to mark a job from its image header
+    :param job: Job object
+    :param max_pixels: reject images with more pixels than this
+    :return: bytes
+    :raises ImageTooLargeError: if the image is over max_pixels
+    :raises OSError: if the header can't be read
+    """
+    info = probe_image(job.input_path)
+    if info.error:
+        # Pillow's own decompression bomb check ends up here as well
+        raise OSError(info.error)
+    if max_pixels and info.pixels > max_pixels:
+        raise ImageTooLargeError("{} is {}x{}, over the limit of {} pixels"
+                                 .format(job.input_path, info.width,
+                                         info.height, max_pixels))
+    return info.decoded_size * FOOTPRINT_FACTOR
+
+
+def create_executor(executor, workers, timeout=None):
+    """
+    Create an executor by name
+    :param executor: 'threads' or 'processes'
+    :param workers: amount of workers
+    :param timeout: seconds an image may take, only processes can be
+                    stopped in the middle of an image
+    :return: concurrent.futures Executor
+    """
+    if timeout is not None and executor != "processes":
+        raise ValueError("timeout needs the 'processes' executor")
+    if executor == "threads":
+        return ThreadPoolExecutor(max_workers=workers)
+    if executor == "processes":
+        if timeout is not None:
+            return RecyclingPool(workers, timeout=timeout)
+        return ProcessPoolExecutor(max_workers=workers)
+    raise ValueError("executor must be 'serial', 'threads', 'processes' "
+                     "or an Executor")
+
+
+def apply_many(watermark_path, jobs, ordered=True, executor="serial",
+               workers=None, max_in_flight=None, overwrite=False,
+               watermarker=None, memory_budget=None, max_pixels=None,
+               timeout=None, tuner=None, **options):
+    """
+    Watermark a stream of images, results are yielded as they're ready.
+    Jobs are only pulled from the iterable while fewer than max_in_flight
+    are being worked on, so it can be a generator of any length.
+    Closing the generator early cancels the jobs that haven't started.
+    :param watermark_path: path to the watermark image
+    :param jobs: iterable of Job objects or (input_path, output_path) tuples
+    :param ordered: yield results in job order, otherwise as they complete
+    :param executor: 'serial', 'threads', 'processes' or an Executor object
+    :param workers: amount of workers for 'threads' and 'processes'
+    :param max_in_flight: max jobs submitted but not yet yielded,
+                          defaults to twice the amount of workers
+    :param overwrite: overwrite existing files
+    :param watermarker: WaterMarker to use for serial runs
+    :param memory_budget: max bytes of decoded images being worked on at
+                          once, estimated from their headers. An image over
+                          the budget on its own is run alone.
+    :param max_pixels: images with more pixels are failed with an
+                       ImageTooLargeError without being decoded
+    :param timeout: seconds an image may take before its worker process is
+                    killed and it's failed with an ImageTimeoutError, needs
+                    the 'processes' executor (or pass a RecyclingPool)
+    :param tuner: optional ConcurrencyTuner (see FreeMark.tools.autotune)
+                  picking the amount and kind of workers as the batch runs,
+                  it takes the place of max_in_flight. With an Executor
+                  object only the amount is tuned.
+    :param options: apply_watermark options for every image
+    :return: generator of Result objects
+    """
+    jobs = (to_job(job) for job in jobs)
+    # Headers are only read when something needs them
+    check = memory_budget is not None or max_pixels is not None
+
+    if executor == "serial":
+        if tuner is not None:
+            raise ValueError("tuner needs an executor with workers")
+        if timeout is not None:
+            raise ValueError("timeout needs the 'processes' executor")
+        watermarker = watermarker or WaterMarker(watermark_path,
+                                                 overwrite=overwrite)
+        for index, job in enumerate(jobs):
+            if max_pixels is not None:
+                try:
+                    get_footprint(job, max_pixels)
+                except Exception as e:
+                    result = Result(job, index, FAILED, error=e)
+                    record_result(result)
+                    yield result
+                    continue
+            set_in_flight(1, 0)
+            result = run_job(watermark_path, overwrite, job, index, options,
+                             watermarker=watermarker)
+            set_in_flight(0, 0)
+            record_result(result)
+            yield result
+        return
+
+    # Load the watermark once up front so a bad path fails immediately
+    WaterMarker(watermark_path)
+    # Executors made here, shut down when done
+    owned = []
+    # Executors by kind, a tuner may switch between threads and processes
+    executors = {}
+    if isinstance(executor, Executor):
+        executors = {kind: executor for kind in tuner.kinds} if tuner else {}
+    elif tuner is not None:
+        if timeout is not None and "threads" in tuner.kinds:
+            raise ValueError("timeout needs the 'processes' executor")
+        workers = tuner.max_workers
+    else:
+        workers = workers or 4
+        executor = create_executor(executor, workers, timeout)
+        owned.append(executor)
+    max_in_flight = max_in_flight or 2 * (workers or 4)
+
+    in_flight = deque() if ordered else set()
+    try:
+        for index, job in enumerate(jobs):
+            if tuner is not None:
+                kind, max_in_flight = tuner.get_config()
+                if kind not in executors:
+                    executors[kind] = create_executor(kind, workers, timeout)
+                    owned.append(executors[kind])
+                executor = executors[kind]
+            try:
+                footprint = get_footprint(job, max_pixels) if check else 0
+            except Exception as e:
+                # Already finished, but queued like the others so ordered
+                # results stay in order
+                footprint = 0
+                future = Future()
+                future.set_result(Result(job, index, FAILED, error=e))
+            else:
+                if memory_budget is not None:
+                    wait_for_memory(in_flight, footprint, memory_budget)
+                future = executor.submit(run_job, watermark_path, overwrite,
+                                         job, index, options)
+            future.job, future.index = job, index
+            future.variants = job.options.get("variants",
+                                              options.get("variants"))
+            future.footprint = footprint
+            if ordered:
+                in_flight.append(future)
+            else:
+                in_flight.add(future)
+            update_gauges(in_flight)
+
+            while len(in_flight) >= max_in_flight:
+                yield from take_results(in_flight, ordered, tuner)
+                if tuner is not None:
+                    max_in_flight = tuner.get_config()[1]
+        while in_flight:
+            yield from take_results(in_flight, ordered, tuner)
+    finally:
+        for future in in_flight:
+            future.cancel()
+        set_in_flight(0, 0)
+        for own in owned:
+            own.shutdown(wait=True, cancel_futures=True)
+
+
+def update_gauges(in_flight):
+    """
+    Report the amount and estimated memory of the jobs in flight
+    :param in_flight: futures with a footprint attribute
+    """
+    set_in_flight(len(in_flight), sum(future.footprint for future in in_flight
+                                      if not future.done()))
+
+
+def wait_for_memory(in_flight, footprint, memory_budget):
+    """
+    Block until a job fits in the memory budget next to the running jobs.
+    Finished jobs don't hold their image anymore, even if their results
+    haven't been taken yet.
+    :param in_flight: futures with a footprint attribute
+    :param footprint: estimated bytes needed by the job about to start
+    :param memory_budget: max bytes for all running jobs
+    """
+    while True:
+        running = [future for future in in_flight if not future.done()]
+        used = sum(future.footprint for future in running)
+        # With nothing running the job goes ahead even if it's over the
+        # budget on its own, it's the only one in memory then
+        if not running or used + footprint <= memory_budget:
+            return
+        wait(running, return_when=FIRST_COMPLETED)
+
+
+def take_results(in_flight, ordered, tuner=None):
+    """
+    Wait for and remove finished futures
+    :param in_flight: deque (ordered) or set of futures
+    :param ordered: only take the oldest future
+    :param tuner: optional ConcurrencyTuner told about every result
+    :return: generator of Result objects
+    """
+    if ordered:
+        futures = [in_flight.popleft()]
+    else:
+        futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        in_flight.difference_update(futures)
+
+    update_gauges(in_flight)
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            # The job itself never raises, so the worker died, was killed,
+            # or the result couldn't be sent back from a process
+            remove_part(future.job.output_path, future.variants)
+            result = Result(future.job, future.index, FAILED, error=e)
+        record_result(result)
+        if tuner is not None:
+            tuner.record(result)
+        yield result
+
+
+def remove_part(output_path, variants=None):
+    """
+    Remove the partly written output a killed worker leaves behind
+    :param output_path: save destination of the job
+    :param variants: the job's output variants, if it has any
+    """
+    paths = [output_path]
+    if variants:
+        paths = [variant.get_output_path(output_path)
+                 for variant in get_variants(variants)]
+    for path in paths:
+        try:
+            os.remove(path + ".part")
+        except OSError:
+            pass
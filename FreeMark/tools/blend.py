@@ -0,0 +1,44 @@
+from PIL import ImageChops
+
+from FreeMark.tools.help import check_blend
+
+# Per channel math on whole images, so nothing is done pixel by pixel in Python
+BLEND_FUNCTIONS = {"multiply": ImageChops.multiply,
+                   "screen": ImageChops.screen,
+                   "overlay": ImageChops.overlay,
+                   "soft_light": ImageChops.soft_light}
+
+
+def blend_watermark(image, watermark, position, blend="multiply"):
+    """
+    Combine a free_mark with the image under it using a blend mode. Only the
+    free_mark's bounding box is cropped out, blended and pasted back, with
+    the free_mark's alpha (which has the opacity in it) mixing the blended
+    pixels with the original ones.
+    :param image: PIL image object, is modified in place
+    :param watermark: PIL image object of the free_mark
+    :param position: (x, y) of the free_mark's top left corner, may be
+                     partly outside the image
+    :param blend: one of the BLEND_MODES other than normal
+    :return: the marked image
+    """
+    function = BLEND_FUNCTIONS[check_blend(blend)]
+    x, y = position
+    # The part of the free_mark that's on the image
+    left, top = max(x, 0), max(y, 0)
+    right = min(x + watermark.size[0], image.size[0])
+    bottom = min(y + watermark.size[1], image.size[1])
+    if left >= right or top >= bottom:
+        return image
+    box = (left, top, right, bottom)
+    if box != (x, y, x + watermark.size[0], y + watermark.size[1]):
+        watermark = watermark.crop((left - x, top - y, right - x, bottom - y))
+    if watermark.mode != "RGBA":
+        watermark = watermark.convert("RGBA")
+
+    background = image.crop(box)
+    if background.mode != "RGB":
+        background = background.convert("RGB")
+    blended = function(background, watermark.convert("RGB"))
+    image.paste(blended, box=box, mask=watermark.getchannel("A"))
+    return image
@@ -7,7 +7,24 @@ class Config:
         self.config = configparser.ConfigParser()
         self.config.read(self.config_location)
 
+    def reload(self):
+        """Read the file again, picking up what other Config objects saved"""
+        self.config.read(self.config_location)
+
     def save_config(self):
+        # Keep the sections other Config objects saved since this one was
+        # read, e.g. the worker settings remembered pr. output folder.
+        # No default section, so only a section's own keys are copied.
+        saved = configparser.ConfigParser(default_section="\0")
+        saved.read(self.config_location)
+        for section in saved.sections():
+            if section == self.config.default_section \
+                    or self.config.has_section(section):
+                continue
+            self.config.add_section(section)
+            for key, value in saved.items(section, raw=True):
+                self.config.set(section, key, value)
+
         with open(self.config_location, 'w') as config_file:
             self.config.write(config_file)
 
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from PIL import Image
+
+from FreeMark.tools.watermarker import WaterMarker
+
+MAGIC = b"FMDC"
+# Magic and the length of the JSON header in front of the pixels
+PREFIX = struct.Struct("<4sI")
+# Modes that survive a round trip through raw bytes
+MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "CMYK", "I", "I;16", "F")
+
+
+class DecodeCache:
+    """
+    Cache of decoded, upright images on disk, as uncompressed pixels which
+    are memory mapped instead of decoded when the same image is opened
+    again. Meant for running the same images over and over while trying
+    out settings. Entries are keyed by path, size and mtime of the file,
+    so an edited file is decoded again, and the least recently used
+    entries are removed when the cache grows over its cap.
+    Only holds its settings, so it can be sent to worker processes, and
+    several processes can share a folder.
+    """
+    def __init__(self, directory=None, max_bytes=2 * 2**30):
+        """
+        :param directory: folder for the cache, defaults to one in the
+                          system's temp folder
+        :param max_bytes: max total size of the cached pixels
+        """
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   "FreeMark-decoded")
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Make a cache from the decode_cache (folder, empty to turn the cache
+        off) and decode_cache_size (MB) options
+        :param config: config section
+        :return: DecodeCache object, or None if it's turned off
+        """
+        directory = config.get("decode_cache", fallback="").strip()
+        if not directory:
+            return None
+        try:
+            size = config.getfloat("decode_cache_size", fallback=2048)
+        except ValueError:
+            print("Bad decode_cache_size in options.ini, using 2048 MB")
+            size = 2048
+        return cls(directory, int(size * 2**20))
+
+    def __repr__(self):
+        return "DecodeCache({!r}, max_bytes={!r})".format(self.directory,
+                                                          self.max_bytes)
+
+    def get_path(self, path, output_size=None):
+        """
+        :param path: path of the encoded image
+        :param output_size: size the image is shrunk to while decoding
+        :return: path of the cache entry
+        """
+        stat = os.stat(path)
+        key = repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                    output_size))
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest() + ".raw")
+
+    def open_image(self, path, output_size=None):
+        """
+        Open an image like WaterMarker.open_image, from the cache if it's
+        in it, otherwise it's decoded and added to the cache
+        :param path: path of the image
+        :param output_size: max long edge or (width, height) box to shrink
+                            the image to while decoding it
+        :return: (PIL image object, raw EXIF data or None)
+        """
+        entry = self.get_path(path, output_size)
+        cached = self.load(entry)
+        if cached:
+            return cached
+
+        image, exif = WaterMarker.open_file(path, output_size)
+        if not getattr(image, "is_animated", False) and image.mode in MODES:
+            image.load()
+            try:
+                self.store(entry, image, exif)
+            except OSError as e:
+                print("Couldn't cache decoded image\n", path, e)
+        return image, exif
+
+    def load(self, entry):
+        """
+        Map a cache entry
+        :param entry: path of the entry
+        :return: (PIL image object, raw EXIF data or None), or None if
+                 there's no usable entry
+        """
+        try:
+            with open(entry, "rb") as entry_file:
+                mapped = mmap.mmap(entry_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            magic, length = PREFIX.unpack_from(mapped)
+            if magic != MAGIC:
+                raise ValueError("not a cache entry")
+            header = json.loads(mapped[PREFIX.size:PREFIX.size + length])
+            pixels = memoryview(mapped)[PREFIX.size + length:]
+            # Shares the mapped memory for modes Pillow stores the same way,
+            # copies are only made if the image is changed
+            image = Image.frombuffer(header["mode"], tuple(header["size"]),
+                                     pixels, "raw", header["mode"], 0, 1)
+        except (ValueError, KeyError, TypeError, struct.error):
+            mapped.close()
+            self.remove(entry)
+            return None
+
+        if not image.readonly:
+            # The pixels were copied, the mapping isn't needed anymore
+            pixels.release()
+            mapped.close()
+        if "palette" in header:
+            image.putpalette(header["palette"], header["palette_mode"])
+        transparency = header.get("transparency")
+        if transparency is not None:
+            image.info["transparency"] = bytes.fromhex(transparency[1]) \
+                if transparency[0] == "bytes" else transparency[1]
+        exif = bytes.fromhex(header["exif"]) if header.get("exif") else None
+        if exif:
+            image.info["exif"] = exif
+        image.format = header.get("format")
+
+        # Marks the entry as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return image, exif
+
+    def store(self, entry, image, exif=None):
+        """
+        Add a decoded image to the cache
+        :param entry: path of the entry
+        :param image: loaded PIL image object
+        :param exif: raw EXIF data or None
+        """
+        header = {"mode": image.mode, "size": image.size,
+                  "format": image.format}
+        if image.mode == "P":
+            header["palette_mode"] = image.palette.mode
+            header["palette"] = image.getpalette(image.palette.mode)
+        transparency = image.info.get("transparency")
+        if isinstance(transparency, bytes):
+            header["transparency"] = ("bytes", transparency.hex())
+        elif transparency is not None:
+            header["transparency"] = ("value", transparency)
+        if exif:
+            header["exif"] = exif.hex()
+        header = json.dumps(header).encode()
+
+        pixels = image.tobytes()
+        if len(pixels) > self.max_bytes:
+            return
+        # Written under a name of its own and renamed, so other processes
+        # never map half an entry
+        part = "{}.{}.part".format(entry, os.getpid())
+        try:
+            with open(part, "wb") as entry_file:
+                entry_file.write(PREFIX.pack(MAGIC, len(header)))
+                entry_file.write(header)
+                entry_file.write(pixels)
+            os.replace(part, entry)
+        except OSError:
+            self.remove(part)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under its cap
+        """
+        entries = []
+        with os.scandir(self.directory) as scanned:
+            for item in scanned:
+                if item.name.endswith(".raw"):
+                    try:
+                        stat = item.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        """Remove every entry"""
+        with os.scandir(self.directory) as scanned:
+            for item in scanned:
+                if item.name.endswith((".raw", ".part")):
+                    self.remove(item.path)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
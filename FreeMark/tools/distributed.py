@@ -0,0 +1,418 @@
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from FreeMark.tools.adaptive import AdaptiveOpacity
+from FreeMark.tools.batch import FAILED, apply_many, create_executor
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.variants import get_variants
+
+# A queue folder holds the manifest and a folder pr. state of the shards.
+# A shard moves pending -> leased -> done, each move is a single rename
+# so only one worker can win it, also on a shared network drive.
+MANIFEST = "manifest.json"
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+# Separates the shard from the worker holding it in a lease's file name
+LEASE_SEPARATOR = "@"
+
+
+def write_json(path, data):
+    """
+    Write a JSON file under a temporary name and rename it, so other
+    workers never read half a file
+    :param path: destination
+    :param data: JSON serializable data
+    """
+    part_path = "{}.{}.part".format(path, os.getpid())
+    with open(part_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file)
+    os.replace(part_path, path)
+
+
+def read_json(path):
+    with open(path, encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def dump_options(options):
+    """
+    Turn apply_watermark options into something JSON can hold
+    :param options: dict of apply_watermark options
+    :return: new dict
+    """
+    options = dict(options)
+    # Local to each node, workers bring their own
+    options.pop("decode_cache", None)
+    if isinstance(options.get("opacity"), AdaptiveOpacity):
+        options["opacity"] = vars(options["opacity"])
+    if options.get("variants"):
+        options["variants"] = [vars(variant) for variant
+                               in get_variants(options["variants"])]
+    return options
+
+
+def load_options(options):
+    """
+    Turn options from a manifest back into apply_watermark options
+    :param options: dict made by dump_options
+    :return: new dict
+    """
+    options = dict(options)
+    if isinstance(options.get("opacity"), dict):
+        options["opacity"] = AdaptiveOpacity(**options["opacity"])
+    if options.get("variants"):
+        options["variants"] = get_variants(options["variants"])
+    # JSON turns tuples into lists
+    if isinstance(options.get("output_size"), list):
+        options["output_size"] = tuple(options["output_size"])
+    if options.get("padding"):
+        options["padding"] = tuple(tuple(pad) for pad in options["padding"])
+    return options
+
+
+def submit_batch(queue_dir, watermark_path, jobs, shard_size=50,
+                 overwrite=False, **options):
+    """
+    Write a batch to a queue folder for workers to pick up. Paths are
+    stored as given, so they must point to the same files on every node.
+    :param queue_dir: empty or new folder on a drive every node can reach
+    :param watermark_path: path to the watermark image
+    :param jobs: iterable of (input_path, output_path) tuples
+    :param shard_size: amount of images in each shard, a shard is the
+                       unit a worker leases
+    :param overwrite: overwrite existing files
+    :param options: apply_watermark options for every image
+    :return: amount of shards written
+    """
+    if shard_size < 1:
+        raise BadOptionError("Shard size must be at least 1.")
+    if os.path.exists(os.path.join(queue_dir, MANIFEST)):
+        raise BadOptionError("{} already holds a batch.".format(queue_dir))
+    for folder in (PENDING, LEASED, DONE):
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+
+    shards = 0
+    shard = []
+    for input_path, output_path in jobs:
+        shard.append((input_path, output_path))
+        if len(shard) == shard_size:
+            write_shard(queue_dir, shards, shard)
+            shards += 1
+            shard = []
+    if shard:
+        write_shard(queue_dir, shards, shard)
+        shards += 1
+
+    # Written last, workers wait for it, so they never see a batch that's
+    # still being split up
+    write_json(os.path.join(queue_dir, MANIFEST),
+               {"watermark": watermark_path, "overwrite": overwrite,
+                "shards": shards, "options": dump_options(options),
+                "created": time.time()})
+    return shards
+
+
+def write_shard(queue_dir, number, jobs):
+    write_json(os.path.join(queue_dir, PENDING,
+                            "shard-{:06d}.json".format(number)),
+               {"jobs": jobs})
+
+
+def get_worker_id():
+    """
+    :return: id of this process, unique across the nodes
+    """
+    host = re.sub(r"[^A-Za-z0-9_.-]", "_", socket.gethostname())
+    return "{}-{}".format(host, os.getpid())
+
+
+def get_status(queue_dir):
+    """
+    :param queue_dir: queue folder
+    :return: dict with the amount of shards, pending, leased and done
+             shards, the leases by worker, and failed images
+    """
+    manifest = read_json(os.path.join(queue_dir, MANIFEST))
+    pending = [name for name in os.listdir(os.path.join(queue_dir, PENDING))
+               if name.endswith(".json")]
+    leases = {}
+    for name in os.listdir(os.path.join(queue_dir, LEASED)):
+        if LEASE_SEPARATOR in name:
+            shard, worker_id = name.split(LEASE_SEPARATOR, 1)
+            leases.setdefault(worker_id, []).append(shard)
+    done = [name for name in os.listdir(os.path.join(queue_dir, DONE))
+            if name.endswith(".json")]
+    failed = 0
+    for name in done:
+        try:
+            results = read_json(os.path.join(queue_dir, DONE, name))["results"]
+        except (OSError, ValueError, KeyError):
+            continue
+        failed += sum(1 for result in results if result[2] == FAILED)
+    return {"shards": manifest["shards"], "pending": len(pending),
+            "leased": sum(len(shards) for shards in leases.values()),
+            "done": len(done), "workers": leases, "failed": failed}
+
+
+class Lease:
+    """
+    A shard held by this worker. A thread touches the lease file every
+    heartbeat_interval, a lease which stops being touched is taken back by
+    the other workers, after which this one has lost it.
+    """
+    def __init__(self, path, heartbeat_interval):
+        """
+        :param path: path of the lease file
+        :param heartbeat_interval: seconds between touches
+        """
+        self.path = path
+        self.heartbeat_interval = heartbeat_interval
+        self.lost = threading.Event()
+        self.released = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        while not self.released.wait(self.heartbeat_interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                self.lost.set()
+                return
+            except OSError as e:
+                # A hiccup of the share, the next beat may get through
+                print("Couldn't renew lease\n", self.path, e)
+
+    def release(self):
+        """Stop the heartbeat and give up the lease file"""
+        self.released.set()
+        self.thread.join()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            self.lost.set()
+
+
+class ShardWorker:
+    """
+    Works through the shards of a queue folder together with any amount of
+    other workers on any node. Every worker also watches the leases of the
+    others, a lease that isn't renewed for lease_timeout seconds is put
+    back as pending for anyone to take. Time is measured on this node
+    only, from when the lease was last seen changing, so the clocks of
+    the nodes don't need to agree.
+    """
+    def __init__(self, queue_dir, worker_id=None, workers=None,
+                 executor="processes", lease_timeout=60,
+                 heartbeat_interval=None, poll_interval=1.0, timeout=None,
+                 decode_cache=None):
+        """
+        :param queue_dir: queue folder written by submit_batch
+        :param worker_id: id in the lease file names, defaults to host-pid
+        :param workers: amount of images marked at once on this node
+        :param executor: 'serial', 'threads' or 'processes'
+        :param lease_timeout: seconds without a heartbeat before a lease
+                              counts as dead
+        :param heartbeat_interval: seconds between heartbeats, defaults to a
+                                   quarter of lease_timeout
+        :param poll_interval: seconds between looks for work while other
+                              workers hold the remaining shards
+        :param timeout: seconds an image may take, see apply_many, needs the
+                        'processes' executor
+        :param decode_cache: optional DecodeCache of this node
+        """
+        if timeout is not None and executor != "processes":
+            raise ValueError("timeout needs the 'processes' executor")
+        self.queue_dir = queue_dir
+        self.worker_id = (worker_id or get_worker_id()).replace(
+            LEASE_SEPARATOR, "_")
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval or lease_timeout / 4
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.decode_cache = decode_cache
+        # lease name -> (mtime, time.monotonic() when that mtime was first seen)
+        self.seen = {}
+        self.stopped = threading.Event()
+        self.shards_done = 0
+        self.images_done = 0
+
+    def folder(self, name):
+        return os.path.join(self.queue_dir, name)
+
+    def wait_for_manifest(self):
+        """
+        :return: the manifest, once the batch has been submitted
+        """
+        path = self.folder(MANIFEST)
+        while not self.stopped.is_set():
+            try:
+                return read_json(path)
+            except FileNotFoundError:
+                self.stopped.wait(self.poll_interval)
+        return None
+
+    def run(self):
+        """
+        Take and mark shards until every shard is done or stop() is called
+        :return: amount of shards this worker finished
+        """
+        manifest = self.wait_for_manifest()
+        if manifest is None:
+            return self.shards_done
+        options = load_options(manifest["options"])
+        if self.decode_cache:
+            options["decode_cache"] = self.decode_cache
+
+        executor = self.executor
+        if executor != "serial":
+            # Kept for every shard, starting processes isn't free
+            executor = create_executor(executor, self.workers, self.timeout)
+        try:
+            while not self.stopped.is_set():
+                self.reap()
+                shard = self.claim()
+                if shard:
+                    self.work(shard, manifest, options, executor)
+                elif self.is_finished():
+                    break
+                else:
+                    self.stopped.wait(self.poll_interval)
+        finally:
+            if executor != self.executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+        return self.shards_done
+
+    def stop(self):
+        """Stop after the current shard, or right away when idle"""
+        self.stopped.set()
+
+    def is_finished(self):
+        return not any(name.endswith(".json")
+                       for name in os.listdir(self.folder(PENDING))) \
+            and not any(LEASE_SEPARATOR in name
+                        for name in os.listdir(self.folder(LEASED)))
+
+    def claim(self):
+        """
+        Lease a pending shard
+        :return: name of the shard, or None if there's none to take
+        """
+        for name in sorted(os.listdir(self.folder(PENDING))):
+            if not name.endswith(".json"):
+                continue
+            pending = os.path.join(self.folder(PENDING), name)
+            if os.path.exists(os.path.join(self.folder(DONE), name)):
+                # Finished by a worker that was thought dead
+                try:
+                    os.remove(pending)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                os.rename(pending, self.get_lease_path(name))
+            except FileNotFoundError:
+                # Another worker got it first
+                continue
+            return name
+        return None
+
+    def get_lease_path(self, shard):
+        return os.path.join(self.folder(LEASED),
+                            shard + LEASE_SEPARATOR + self.worker_id)
+
+    def reap(self):
+        """
+        Put the shards of workers which stopped renewing their leases back
+        as pending
+        :return: amount of shards put back
+        """
+        now = time.monotonic()
+        reaped = 0
+        seen = {}
+        for name in os.listdir(self.folder(LEASED)):
+            if LEASE_SEPARATOR not in name:
+                continue
+            shard, worker_id = name.split(LEASE_SEPARATOR, 1)
+            if worker_id == self.worker_id:
+                continue
+            path = os.path.join(self.folder(LEASED), name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            last_mtime, since = self.seen.get(name, (None, now))
+            if mtime != last_mtime:
+                since = now
+            seen[name] = (mtime, since)
+            if now - since < self.lease_timeout:
+                continue
+            try:
+                os.rename(path, os.path.join(self.folder(PENDING), shard))
+            except FileNotFoundError:
+                # Released, or reaped by another worker
+                continue
+            print("Took back {} from {}".format(shard, worker_id))
+            del seen[name]
+            reaped += 1
+        self.seen = seen
+        return reaped
+
+    def work(self, shard, manifest, options, executor):
+        """
+        Mark the images of a leased shard and record the results
+        :param shard: name of the shard
+        :param manifest: the batch manifest
+        :param options: apply_watermark options
+        :param executor: executor to run the images on
+        """
+        lease = Lease(self.get_lease_path(shard), self.heartbeat_interval)
+        try:
+            jobs = read_json(lease.path)["jobs"]
+        except FileNotFoundError:
+            lease.release()
+            return
+
+        def live_jobs():
+            # Stop handing out images once another worker has the shard
+            for job in jobs:
+                if lease.lost.is_set() or self.stopped.is_set():
+                    return
+                yield job
+
+        results = []
+        for result in apply_many(manifest["watermark"], live_jobs(),
+                                 ordered=False, executor=executor,
+                                 workers=self.workers,
+                                 overwrite=manifest["overwrite"],
+                                 **options):
+            results.append((result.input_path, result.output_path,
+                            result.status,
+                            repr(result.error) if result.error else None,
+                            result.elapsed))
+            if result.error:
+                print("Failed {}\n".format(result.input_path), result.error)
+
+        if len(results) < len(jobs):
+            # Lost the lease or stopped, the shard goes back as pending
+            # unless someone else has it already
+            lease.released.set()
+            lease.thread.join()
+            try:
+                os.rename(lease.path, os.path.join(self.folder(PENDING), shard))
+            except FileNotFoundError:
+                pass
+            return
+
+        write_json(os.path.join(self.folder(DONE), shard),
+                   {"worker": self.worker_id, "results": results})
+        lease.release()
+        self.shards_done += 1
+        self.images_done += len(results)
@@ -2,4 +2,24 @@ class BadOptionError(Exception):
     """
     当提供的选项无效时抛出的异常
     """
-    pass
\ No newline at end of file
+    pass
+
+class ImageTooLargeError(Exception):
+    """
+    当图像的像素数超过允许的上限时抛出的异常
+    """
+    pass
+
+
+class ImageTimeoutError(TimeoutError):
+    """
+    当处理单张图像的时间超过限制时抛出的异常
+    """
+    pass
+
+
+class WorkerDiedError(Exception):
+    """
+    当工作进程在处理图像时意外退出时抛出的异常
+    """
+    pass
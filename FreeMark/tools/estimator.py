@@ -0,0 +1,158 @@
+import os
+import random
+import tempfile
+import time
+
+from PIL import Image
+
+from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.probe import probe_images
+
+
+class Estimate:
+    """
+    Predicted cost of a batch run
+    """
+    def __init__(self, images, total_time, output_bytes, peak_memory,
+                 sampled, failed):
+        """
+        :param images: amount of images in the batch
+        :param total_time: seconds the batch is expected to take
+        :param output_bytes: expected total size of the output
+        :param peak_memory: expected peak bytes of decoded images in memory
+        :param sampled: amount of images actually processed for the estimate
+        :param failed: amount of probed images that couldn't be read
+        """
+        self.images = images
+        self.total_time = total_time
+        self.output_bytes = output_bytes
+        self.peak_memory = peak_memory
+        self.sampled = sampled
+        self.failed = failed
+
+    @property
+    def seconds_per_image(self):
+        return self.total_time / self.images if self.images else 0.0
+
+    def __str__(self):
+        return ("{} images, about {:.0f} s, {:.1f} MB output, "
+                "{:.1f} MB peak memory (from {} samples)").format(
+            self.images, self.total_time, self.output_bytes / 2**20,
+            self.peak_memory / 2**20, self.sampled)
+
+
+def pick_samples(infos, sample_size):
+    """
+    Split images into equally sized strata by pixel count and pick the
+    median image of each, so small and huge images are both represented
+    :param infos: list of readable ImageInfo objects
+    :param sample_size: amount of strata
+    :return: list of (sample ImageInfo, list of ImageInfo in its stratum)
+    """
+    infos = sorted(infos, key=lambda info: info.pixels)
+    strata_count = min(sample_size, len(infos))
+    strata = []
+    for i in range(strata_count):
+        stratum = infos[i * len(infos) // strata_count:
+                        (i + 1) * len(infos) // strata_count]
+        strata.append((stratum[len(stratum) // 2], stratum))
+    return strata
+
+
+def get_decoded_size(info, output_size=None):
+    """
+    Bytes an image takes decoded, once it's shrunk to the output size
+    :param info: ImageInfo object
+    :param output_size: max long edge or (width, height) box, or None
+    :return: bytes
+    """
+    if not output_size or not info.pixels:
+        return info.decoded_size
+    width, height = WaterMarker.get_output_dimensions(info.oriented_size,
+                                                      output_size)
+    return info.decoded_size * width * height // info.pixels
+
+
+def estimate_batch(watermark_path, input_paths, workers=1, sample_size=8,
+                   max_probe=2000, infos=None, **kwargs):
+    """
+    Estimate time, output size and peak memory of a batch by reading image
+    headers and watermarking a small stratified sample to a scratch folder
+    :param watermark_path: path to the watermark image
+    :param input_paths: list of paths to the images in the batch
+    :param workers: amount of images that will be processed at the same time
+    :param sample_size: amount of images to actually watermark
+    :param max_probe: headers read at most, a random subset is used above it
+    :param infos: ImageInfo objects of input_paths if they're already probed
+    :param kwargs: options passed on to apply_watermark
+    :return: Estimate object
+    """
+    input_paths = list(input_paths)
+    if infos is not None:
+        probe_paths = input_paths
+    elif len(input_paths) > max_probe:
+        probe_paths = random.sample(input_paths, max_probe)
+        infos = probe_images(probe_paths)
+    else:
+        probe_paths = input_paths
+        infos = probe_images(probe_paths)
+    readable = [info for info in infos if not info.error]
+    # Everything is measured on the probed images and scaled up to the batch
+    scale = len(input_paths) / len(probe_paths) if probe_paths else 0
+
+    total_time = 0.0
+    output_bytes = 0
+    prepare_times = []
+    strata = pick_samples(readable, sample_size)
+    watermarker = WaterMarker(watermark_path, overwrite=True)
+    with tempfile.TemporaryDirectory(prefix="freemark-estimate-") as scratch:
+        for i, (sample, stratum) in enumerate(strata):
+            extension = os.path.splitext(sample.path)[1]
+            output_path = os.path.join(scratch, "{}{}".format(i, extension))
+            try:
+                # Scaling the watermark only happens once pr. image size in
+                # a real run, so it's timed on its own and left out here
+                start = time.perf_counter()
+                watermarker.get_scaled_watermark(
+                    Image.new("1", WaterMarker.get_output_dimensions(
+                        sample.oriented_size, kwargs.get("output_size"))),
+                    kwargs.get("opacity", 0.5), kwargs.get("scale_x", 1.0),
+                    kwargs.get("scale_y", 1.0))
+                prepare_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                watermarker.apply_watermark(sample.path, output_path, **kwargs)
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                print("Couldn't estimate with", sample.path, e)
+                continue
+
+            # Cost is assumed to grow with the pixel count within a stratum
+            stratum_pixels = sum(info.pixels for info in stratum)
+            total_time += elapsed / max(sample.pixels, 1) * stratum_pixels
+            output_bytes += os.path.getsize(output_path) \
+                / max(sample.pixels, 1) * stratum_pixels
+            os.remove(output_path)
+
+    # Distinct sizes are counted on the probed images only, so this part
+    # isn't scaled up with the rest
+    prepare_time = 0.0
+    if prepare_times:
+        sizes = len(set(info.oriented_size for info in readable))
+        prepare_time = sum(prepare_times) / len(prepare_times) * sizes
+
+    # An image is held decoded, plus a rotated copy when it has EXIF
+    # orientation, and the largest images could all be in flight at once.
+    # With an output size they're shrunk while decoding, so only the
+    # shrunk image is held.
+    output_size = kwargs.get("output_size")
+    largest = sorted((get_decoded_size(info, output_size)
+                      for info in readable), reverse=True)
+    peak_memory = 2 * sum(largest[:max(workers, 1)])
+
+    return Estimate(len(input_paths),
+                    (total_time * scale + prepare_time) / max(workers, 1),
+                    int(output_bytes * scale),
+                    peak_memory,
+                    len(strata),
+                    int((len(infos) - len(readable)) * scale))
@@ -1,3 +1,9 @@
+import os
+import re
+
+from FreeMark.tools.errors import BadOptionError
+
+
 def clamp(val, _min, _max):
     """Keep a value within a certain limit"""
     if val < _min:
@@ -6,3 +12,80 @@ def clamp(val, _min, _max):
         return _max
     else:
         return val
+
+
+# Where rename_file puts the fix
+NONE = 0
+PRE = 1
+SUFFIX = 2
+
+# File extensions (lower case) of the image formats FreeMark can mark
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.gif', '.webp')
+
+
+def is_image_file(filename):
+    """Check whether a file name has one of the supported image extensions"""
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def parse_padding(value):
+    """
+    Parse a padding string like '20px,5%' into apply_watermark's format
+    :param value: padding as a string, x padding first
+    :return: padding in format ((x_pad, unit), (y_pad, unit))
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*(px|%)\s*,\s*(\d+)\s*(px|%)\s*", value)
+    if not match:
+        raise BadOptionError("Padding must look like '20px,5px'.")
+    return (int(match.group(1)), match.group(2)), \
+           (int(match.group(3)), match.group(4))
+
+
+def parse_size(value):
+    """
+    Parse an output size like '2048' (long edge) or '1920x1080' (box)
+    :param value: size as a string
+    :return: int for a long edge, (width, height) for a box
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*(?:[xX]\s*(\d+)\s*)?", value)
+    if not match or int(match.group(1)) < 1 \
+            or (match.group(2) and int(match.group(2)) < 1):
+        raise BadOptionError("Size must look like '2048' or '1920x1080'.")
+    if match.group(2):
+        return int(match.group(1)), int(match.group(2))
+    return int(match.group(1))
+
+
+def rename_file(filename, fix="", fix_position=NONE):
+    """
+    Extract the file name from a path and apply a prefix or suffix
+    :param filename: file name or path
+    :param fix: text to add to the name
+    :param fix_position: NONE, PRE or SUFFIX
+    :return: new file name
+    """
+    filename = os.path.split(filename)[-1]
+
+    if fix_position == NONE:
+        return filename
+    elif fix_position == PRE:
+        return "{}_{}".format(fix, filename)
+    elif fix_position == SUFFIX:
+        filename = filename.rsplit('.', maxsplit=1)
+        return "{}_{}.{}".format(filename[0], fix, filename[1])
+
+
+# How a watermark can be combined with the image under it, see tools.blend
+BLEND_MODES = ("normal", "multiply", "screen", "overlay", "soft_light")
+
+
+def check_blend(blend):
+    """
+    :param blend: blend mode name
+    :return: the blend mode, lower case
+    """
+    blend = (blend or "normal").lower().strip()
+    if blend not in BLEND_MODES:
+        raise BadOptionError("Blend mode must be one of {}.".format(
+            ", ".join(BLEND_MODES)))
+    return blend
@@ -0,0 +1,145 @@
+from collections import OrderedDict
+
+from PIL import Image
+
+from FreeMark.tools.adaptive import get_adaptive
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import parse_padding
+
+# What a layer uses for anything it doesn't set itself
+LAYER_DEFAULTS = {"watermark": None,
+                  "pos": "SE",
+                  "padding": ((20, "px"), (5, "px")),
+                  "opacity": 1.0,
+                  "scale_x": 1.0,
+                  "scale_y": 1.0}
+
+
+def normalize_layer(layer):
+    """
+    Fill in defaults and check the options of a layer
+    :param layer: dict of layer options, any of LAYER_DEFAULTS' keys,
+                  padding may also be a string like '20px,5px'
+    :return: new dict with every option set
+    """
+    unknown = set(layer) - set(LAYER_DEFAULTS)
+    if unknown:
+        raise BadOptionError("Unknown layer option(s): {}".format(
+            ", ".join(sorted(unknown))))
+    layer = dict(LAYER_DEFAULTS, **layer)
+    # Patches are cached pr. image size, so they can't depend on content
+    if layer["pos"].upper().strip() == "AUTO":
+        raise BadOptionError("Layers can't use the AUTO position.")
+    if get_adaptive(layer["opacity"]):
+        raise BadOptionError("Layers can't use adaptive opacity.")
+    if isinstance(layer["padding"], str):
+        layer["padding"] = parse_padding(layer["padding"])
+    # Padding might come from JSON, which turns tuples into lists
+    layer["padding"] = tuple(tuple(pad) for pad in layer["padding"])
+    return layer
+
+
+def boxes_overlap(a, b):
+    """
+    Check if two (left, top, right, bottom) boxes overlap
+    """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class LayerStack:
+    """
+    Several watermarks applied in one go. For every target image size the
+    layers are scaled once, layers that overlap are flattened into a single
+    RGBA patch, and the patches are cached, so marking an image is one
+    paste pr. group of overlapping layers.
+    """
+    def __init__(self, layers, get_watermarker, cache_size=8):
+        """
+        :param layers: list of layer option dicts, bottom layer first
+        :param get_watermarker: function taking a watermark path (or None for
+                                the default watermark) and returning a
+                                WaterMarker which does the scaling
+        :param cache_size: amount of target sizes to keep patches for
+        """
+        self.layers = [normalize_layer(layer) for layer in layers]
+        self.get_watermarker = get_watermarker
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def get_patches(self, image):
+        """
+        Get the flattened patches for an image's size
+        :param image: PIL image object the layers will be applied to
+        :return: list of ((x, y), RGBA PIL image)
+        """
+        try:
+            self.cache.move_to_end(image.size)
+            return self.cache[image.size]
+        except KeyError:
+            pass
+
+        placed = []
+        for layer in self.layers:
+            watermarker = self.get_watermarker(layer["watermark"])
+            watermark = watermarker.get_scaled_watermark(
+                image, layer["opacity"], layer["scale_x"], layer["scale_y"])
+            x, y = watermarker.get_watermark_position(
+                image, watermark, pos=layer["pos"], padding=layer["padding"])
+            box = (x, y, x + watermark.size[0], y + watermark.size[1])
+            placed.append((box, watermark.convert("RGBA")))
+
+        patches = [self.flatten(group) for group in self.group_overlapping(placed)]
+
+        self.cache[image.size] = patches
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return patches
+
+    @staticmethod
+    def group_overlapping(placed):
+        """
+        Group layers whose boxes overlap, directly or through other layers,
+        keeping the stacking order inside each group
+        :param placed: list of (box, RGBA image), bottom layer first
+        :return: list of groups, each a list of (box, RGBA image)
+        """
+        groups = []  # Lists of indexes into placed
+        for index, (box, _) in enumerate(placed):
+            touching = [group for group in groups
+                        if any(boxes_overlap(box, placed[other][0])
+                               for other in group)]
+            merged = sorted([other for group in touching for other in group]
+                            + [index])
+            groups = [group for group in groups if group not in touching]
+            groups.append(merged)
+        return [[placed[index] for index in group] for group in groups]
+
+    @staticmethod
+    def flatten(group):
+        """
+        Composite a group of layers into one patch covering all of them
+        :param group: list of (box, RGBA image), bottom layer first
+        :return: ((x, y), RGBA PIL image)
+        """
+        if len(group) == 1:
+            box, watermark = group[0]
+            return (box[0], box[1]), watermark
+
+        left = min(box[0] for box, _ in group)
+        top = min(box[1] for box, _ in group)
+        right = max(box[2] for box, _ in group)
+        bottom = max(box[3] for box, _ in group)
+        patch = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        for box, watermark in group:
+            patch.alpha_composite(watermark, dest=(box[0] - left, box[1] - top))
+        return (left, top), patch
+
+    def apply(self, image):
+        """
+        Apply every layer to an image
+        :param image: PIL image object, is modified in place
+        :return: the marked image
+        """
+        for position, patch in self.get_patches(image):
+            image.paste(patch, box=position, mask=patch)
+        return image
@@ -0,0 +1,381 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Seconds, spread to cover both small thumbnails and huge TIFFs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    """Format a number the way the Prometheus text format wants it"""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels):
+    """
+    :param labels: tuple of (name, value) pairs
+    :return: string like '{stage="decode"}', or '' without labels
+    """
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                .replace("\n", "\\n").replace('"', '\\"'))
+               for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric:
+    """
+    A named metric, holding one value pr. combination of label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name, description):
+        """
+        :param name: metric name, like freemark_images_total
+        :param description: help text shown next to it
+        """
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+
+    @staticmethod
+    def key(labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        """
+        :return: list of lines in the Prometheus text format
+        """
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append("{}{} {}".format(self.name, format_labels(labels),
+                                          format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A count that only goes up
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in buckets, plus their sum and count
+    """
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"), )
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # [count pr. bucket..., sum]
+                self.values[key] = [0] * len(self.buckets) + [0.0]
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self.values.items())
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                # Buckets are cumulative in the text format
+                total += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(labels + (("le", format_value(bound)), )),
+                    total))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(labels),
+                                              format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, format_labels(labels),
+                                                total))
+        return lines
+
+
+class Registry:
+    """
+    Set of metrics, rendered together in the Prometheus text format.
+    Metrics are created on first use, asking for an existing name
+    returns the existing metric.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get_metric(self, kind, name, description, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, description, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, kind):
+            raise ValueError("{} is already a {}".format(name, metric.kind))
+        return metric
+
+    def counter(self, name, description):
+        return self.get_metric(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self.get_metric(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.get_metric(Histogram, name, description, buckets=buckets)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text format, as a string
+        """
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the metrics to a file, e.g. for node_exporter's textfile
+        collector. Written to a temporary file and renamed, so a scrape
+        never reads half a file.
+        :param path: path of the .prom file
+        """
+        part_path = path + ".part"
+        with open(part_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(part_path, path)
+
+
+# The registry the engine records into
+REGISTRY = Registry()
+
+
+def record_result(result, registry=REGISTRY):
+    """
+    Count a finished batch job
+    :param result: batch Result object
+    :param registry: Registry to record into
+    """
+    bytes_in = bytes_out = None
+    if result.status == "done":
+        try:
+            bytes_in = os.path.getsize(result.input_path)
+        except OSError:
+            pass
+        # Counted by the job, with variants there's no single output file
+        bytes_out = result.bytes_out
+    record_image(result.status, result.elapsed, timings=result.timings,
+                 error=result.error, bytes_in=bytes_in,
+                 bytes_out=bytes_out, cache_hits=result.cache_hits,
+                 cache_misses=result.cache_misses, registry=registry)
+
+
+def record_image(status, elapsed, timings=None, error=None, bytes_in=None,
+                 bytes_out=None, cache_hits=0, cache_misses=0,
+                 registry=REGISTRY):
+    """
+    Count a finished image
+    :param status: 'done', 'skipped' or 'failed'
+    :param elapsed: seconds spent on the image
+    :param timings: dict of seconds spent in each stage
+    :param error: the exception if the image failed
+    :param bytes_in: size of the encoded input
+    :param bytes_out: size of the encoded output
+    :param cache_hits: scaled watermarks taken from the cache
+    :param cache_misses: watermarks that had to be scaled
+    :param registry: Registry to record into
+    """
+    registry.counter("freemark_images_total",
+                     "Images handled, by outcome").inc(status=status)
+    if error is not None:
+        registry.counter("freemark_errors_total", "Failed images, by error"
+                         ).inc(error=type(error).__name__)
+    if status != "done":
+        return
+
+    registry.histogram("freemark_image_seconds",
+                       "Seconds spent on each image").observe(elapsed)
+    stages = registry.histogram("freemark_stage_seconds",
+                                "Seconds spent in each stage of an image")
+    for stage, seconds in (timings or {}).items():
+        stages.observe(seconds, stage=stage)
+    transferred = registry.counter("freemark_bytes_total",
+                                   "Bytes of images read and written")
+    if bytes_in is not None:
+        transferred.inc(bytes_in, direction="in")
+    if bytes_out is not None:
+        transferred.inc(bytes_out, direction="out")
+    record_cache(cache_hits, cache_misses, registry)
+
+
+def record_cache(hits, misses, registry=REGISTRY):
+    """
+    Count lookups of the scaled watermark cache
+    :param hits: lookups that found a scaled watermark
+    :param misses: lookups that had to scale the watermark
+    :param registry: Registry to record into
+    """
+    hit_counter = registry.counter("freemark_watermark_cache_hits_total",
+                                   "Scaled watermarks reused from the cache")
+    miss_counter = registry.counter("freemark_watermark_cache_misses_total",
+                                    "Watermarks that had to be scaled")
+    hit_counter.inc(hits)
+    miss_counter.inc(misses)
+    lookups = hit_counter.get() + miss_counter.get()
+    if lookups:
+        registry.gauge("freemark_watermark_cache_hit_ratio",
+                       "Share of watermark cache lookups that were hits"
+                       ).set(hit_counter.get() / lookups)
+
+
+def set_in_flight(images, memory, registry=REGISTRY):
+    """
+    Update the gauges of the work in progress
+    :param images: amount of images being worked on or waiting to be taken
+    :param memory: estimated bytes of decoded images being worked on
+    :param registry: Registry to record into
+    """
+    registry.gauge("freemark_in_flight_images",
+                   "Images submitted but not yet finished").set(images)
+    registry.gauge("freemark_in_flight_bytes",
+                   "Estimated memory of the images being worked on"
+                   ).set(memory)
+
+
+def set_queue_depth(depth, registry=REGISTRY):
+    """
+    :param depth: amount of images waiting to be worked on
+    :param registry: Registry to record into
+    """
+    registry.gauge("freemark_queue_depth",
+                   "Images waiting to be worked on").set(depth)
+
+
+class MetricsWriter:
+    """
+    Writes a registry to a file every few seconds, from a daemon thread
+    """
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        """
+        :param path: path of the .prom file
+        :param interval: seconds between writes
+        :param registry: Registry to write
+        """
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            self.registry.write(self.path)
+        except OSError as e:
+            print("Couldn't write metrics\n", e)
+
+    def stop(self):
+        """Stop writing, after writing the final values"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the registry at /metrics
+    """
+    registry = REGISTRY
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes come in every few seconds, don't log them
+        pass
+
+
+def serve_metrics(host="127.0.0.1", port=9464, registry=REGISTRY):
+    """
+    Serve the metrics from a daemon thread
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param registry: Registry to serve
+    :return: ThreadingHTTPServer object, call shutdown() to stop it
+    """
+    handler = type("Handler", (MetricsRequestHandler, ),
+                   {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
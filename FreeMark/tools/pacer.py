@@ -11,6 +11,10 @@ class Pacer:
         self.progress = 0  # Amount of elements processed
         self.pace = 0.0    # Current pace (Operations pr. second)
         self.running = False
+        # Expected seconds pr. step before the process started, e.g. from
+        # an estimate. It counts as prior_weight steps already taken.
+        self.prior = None
+        self.prior_weight = 5
 
     def start(self, start=None):
         """
@@ -35,6 +39,21 @@ class Pacer:
         assert _max > 1, "Max is less than zero (you cannot expect < 1 step)"
         self.max = _max
 
+    def set_prior(self, seconds_per_step, weight=None):
+        """
+        Seed the pacer with an expected pace, so the estimated time remaining
+        is meaningful before the first step and doesn't jump around early on
+        :param seconds_per_step: expected seconds pr. step
+        :param weight: amount of steps the prior counts as, when steps are
+                       weighted (e.g. by pixels) this should be a few
+                       elements worth of steps
+        """
+        if seconds_per_step and seconds_per_step > 0:
+            self.prior = seconds_per_step
+            self.pace = 1 / seconds_per_step
+            if weight:
+                self.prior_weight = weight
+
     def reset(self):
         """
         Shorthand making calling the initializer a bit prettier
@@ -81,7 +100,11 @@ class Pacer:
         Update pace (steps pr. second)
         """
         elapsed = self.get_elapsed()
-        if elapsed <= 0:
+        if self.prior:
+            # Blend in the prior as if it were a few steps already taken
+            self.pace = (self.progress + self.prior_weight) / \
+                        (elapsed + self.prior_weight * self.prior)
+        elif elapsed <= 0:
             self.pace = 0
         else:
             self.pace = self.progress / self.get_elapsed()
@@ -0,0 +1,68 @@
+from PIL import Image, ImageFilter
+
+AUTO = "AUTO"
+# In order of preference when they score the same, SE is the usual default
+CANDIDATES = ("SE", "SW", "NE", "NW")
+# Lookup table squaring 8 bit values
+SQUARES = [value * value for value in range(256)]
+
+
+def box_mean(image, box):
+    """
+    Mean of a float image inside a box, averaged in C by a box filter
+    down to a single pixel, which beats summing a histogram in Python
+    """
+    return image.resize((1, 1), Image.BOX, box).getpixel((0, 0))
+
+
+def score_boxes(image, boxes, proxy_size=96):
+    """
+    Score how busy an image is under each box, using local variance and
+    edge energy measured on a small nearest neighbour proxy of the image
+    :param image: PIL image object
+    :param boxes: list of (left, top, right, bottom) in image coordinates
+    :param proxy_size: long edge of the proxy in pixels
+    :return: list of scores, lower is calmer
+    """
+    scale = proxy_size / max(image.size)
+    width = max(1, round(image.size[0] * scale))
+    height = max(1, round(image.size[1] * scale))
+    # Nearest neighbour only reads the pixels it keeps, so it's close to
+    # free even on huge images
+    proxy = image.resize((width, height), Image.NEAREST).convert("L")
+    edges = proxy.filter(ImageFilter.FIND_EDGES).convert("F")
+    squares = proxy.point(SQUARES, "I").convert("F")
+    proxy = proxy.convert("F")
+
+    scores = []
+    for box in boxes:
+        # Map to proxy pixels, always covering at least one pixel
+        left = min(max(int(box[0] * scale), 0), width - 1)
+        top = min(max(int(box[1] * scale), 0), height - 1)
+        right = min(max(int(box[2] * scale + 0.5), left + 1), width)
+        bottom = min(max(int(box[3] * scale + 0.5), top + 1), height)
+        proxy_box = (left, top, right, bottom)
+
+        mean = box_mean(proxy, proxy_box)
+        variance = box_mean(squares, proxy_box) - mean ** 2
+        edge = box_mean(edges, proxy_box)
+        # Standard deviation and edge energy are both on a 0-255 scale
+        scores.append(max(variance, 0) ** 0.5 + edge)
+    return scores
+
+
+def choose_position(image, watermark, padding, get_position):
+    """
+    Pick the corner where the watermark covers the least detail
+    :param image: PIL image object
+    :param watermark: scaled watermark as a PIL image object
+    :param padding: padding in format ((x_pad, unit), (y_pad, unit))
+    :param get_position: function like WaterMarker.get_watermark_position
+    :return: pos string, e.g. 'SW'
+    """
+    boxes = []
+    for pos in CANDIDATES:
+        x, y = get_position(image, watermark, pos=pos, padding=padding)
+        boxes.append((x, y, x + watermark.size[0], y + watermark.size[1]))
+    scores = score_boxes(image, boxes)
+    return CANDIDATES[scores.index(min(scores))]
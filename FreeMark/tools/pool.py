@@ -0,0 +1,241 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Executor, Future
+from multiprocessing.connection import wait as wait_connections
+
+from FreeMark.tools.errors import ImageTimeoutError, WorkerDiedError
+
+
+def worker_main(connection):
+    """
+    Run tasks sent over a pipe until told to stop, in a worker process
+    :param connection: child end of the worker's pipe
+    """
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        fn, args, kwargs = task
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The result or the exception couldn't be pickled
+            connection.send((False, RuntimeError(repr(e))))
+
+
+class WorkerProcess:
+    """
+    A worker process and the task it's running
+    """
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child,),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.future = None
+        self.deadline = None
+
+    def kill(self):
+        """Stop the process right away, whatever it's doing"""
+        self.process.terminate()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+    def stop(self):
+        """Ask an idle process to exit"""
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.connection.close()
+
+
+class RecyclingPool(Executor):
+    """
+    Process pool whose workers can be killed in the middle of a task.
+    A task running longer than the timeout, or running when the pool is
+    cancelled, has its worker terminated and replaced by a fresh process,
+    so a hung decode can't block a batch and stopping takes at most
+    about poll_interval.
+    """
+    def __init__(self, workers=4, timeout=None, poll_interval=0.1):
+        """
+        :param workers: amount of worker processes
+        :param timeout: seconds a task may run, None for no limit
+        :param poll_interval: seconds between checks of the timeouts
+        """
+        self.context = multiprocessing.get_context()
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.workers = [WorkerProcess(self.context)
+                        for _ in range(max(workers, 1))]
+
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.shutting_down = False
+        self.cancel_requested = False
+        # Wakes the manager up when there's new work
+        self.wakeup_reader, self.wakeup_writer = self.context.Pipe(duplex=False)
+
+        self.manager = threading.Thread(target=self.manage, daemon=True)
+        self.manager.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) in a worker process, fn and its
+        arguments must be picklable
+        :return: Future object
+        """
+        future = Future()
+        with self.lock:
+            if self.shutting_down:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self.pending.append((future, fn, args, kwargs))
+        self.wake()
+        return future
+
+    def cancel(self):
+        """
+        Cancel every task, running tasks have their worker killed and fail
+        with CancelledError. Returns right away, the pool can still be used.
+        """
+        with self.lock:
+            self.cancel_requested = True
+        self.wake()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """
+        Stop the pool, with cancel_futures running tasks are killed as well
+        """
+        with self.lock:
+            self.shutting_down = True
+            if cancel_futures:
+                self.cancel_requested = True
+        self.wake()
+        if wait:
+            self.manager.join()
+
+    def wake(self):
+        try:
+            self.wakeup_writer.send_bytes(b"")
+        except OSError:
+            pass
+
+    def manage(self):
+        """
+        Hand out tasks, collect results and kill overdue workers,
+        all workers are only ever touched by this thread
+        """
+        while True:
+            with self.lock:
+                if self.cancel_requested:
+                    self.cancel_requested = False
+                    self.cancel_all()
+                self.start_pending()
+                busy = [worker for worker in self.workers if worker.future]
+                if self.shutting_down and not busy and not self.pending:
+                    break
+
+            ready = wait_connections([self.wakeup_reader]
+                                     + [worker.connection for worker in busy],
+                                     timeout=self.poll_interval)
+            if self.wakeup_reader in ready:
+                while self.wakeup_reader.poll():
+                    self.wakeup_reader.recv_bytes()
+            for worker in busy:
+                if worker.connection in ready:
+                    self.collect(worker)
+            self.check_deadlines()
+
+        for worker in self.workers:
+            worker.stop()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def start_pending(self):
+        """Give pending tasks to idle workers"""
+        for worker in self.workers:
+            if worker.future:
+                continue
+            while self.pending:
+                future, fn, args, kwargs = self.pending.popleft()
+                # Skips futures that were cancelled while waiting
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    worker.connection.send((fn, args, kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                worker.future = future
+                worker.deadline = (time.monotonic() + self.timeout
+                                   if self.timeout else None)
+                break
+
+    def collect(self, worker):
+        """Hand the result of a finished task to its future"""
+        future = worker.future
+        try:
+            ok, value = worker.connection.recv()
+        except (EOFError, OSError):
+            self.replace(worker)
+            future.set_exception(WorkerDiedError(
+                "Worker process exited with code {}".format(
+                    worker.process.exitcode)))
+            return
+        worker.future = None
+        worker.deadline = None
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def check_deadlines(self):
+        """Kill workers which have been at a task for too long"""
+        now = time.monotonic()
+        for worker in list(self.workers):
+            if worker.future and worker.deadline and now > worker.deadline:
+                future = worker.future
+                self.replace(worker)
+                future.set_exception(ImageTimeoutError(
+                    "Took longer than {} s".format(self.timeout)))
+
+    def cancel_all(self):
+        """Fail pending tasks and kill the workers of running ones"""
+        while self.pending:
+            future = self.pending.popleft()[0]
+            # cancel() alone doesn't wake up wait(), this does
+            if future.cancel():
+                future.set_running_or_notify_cancel()
+        for worker in list(self.workers):
+            if worker.future:
+                future = worker.future
+                self.replace(worker)
+                future.set_exception(CancelledError())
+
+    def replace(self, worker):
+        """Kill a worker and start a fresh one in its place"""
+        worker.kill()
+        index = self.workers.index(worker)
+        if self.shutting_down:
+            # Nothing more will run, so no need for a new process
+            self.workers.pop(index)
+        else:
+            self.workers[index] = WorkerProcess(self.context)
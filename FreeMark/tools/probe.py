@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# EXIF tag of the orientation, 1 is upright, 5-8 are turned on their side
+ORIENTATION = 0x0112
+
+
+class ImageInfo:
+    """
+    What can be learned about an image from its header, without decoding it
+    """
+    def __init__(self, path, width=0, height=0, mode=None, image_format=None,
+                 file_size=0, error=None, orientation=1, animated=False):
+        """
+        :param path: path to image on disk as a string
+        :param width: width in pixels
+        :param height: height in pixels
+        :param mode: PIL mode, e.g. 'RGB'
+        :param image_format: PIL format name, e.g. 'JPEG'
+        :param file_size: size of the file in bytes
+        :param error: error message if the header couldn't be read
+        :param orientation: EXIF orientation, 1 if there is none
+        :param animated: has more than one frame
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.format = image_format
+        self.file_size = file_size
+        self.error = error
+        self.orientation = orientation
+        self.animated = animated
+
+    @property
+    def corrupt(self):
+        return self.error is not None
+
+    @property
+    def oriented_size(self):
+        """
+        Size of the image once it's rotated upright, which is what the
+        free_mark gets scaled against
+        """
+        if self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    @property
+    def decoded_size(self):
+        """
+        Bytes needed to hold the decoded image in memory
+        """
+        if not self.mode:
+            return 0
+        # Pillow keeps single band 8 bit images in a byte a pixel,
+        # 16 bit ones in two bytes and everything else in four
+        if self.mode in ("1", "L", "P"):
+            return self.pixels
+        if self.mode.startswith("I;16"):
+            return self.pixels * 2
+        return self.pixels * 4
+
+    def __repr__(self):
+        return "ImageInfo({!r}, {}x{}, {}, {})".format(
+            self.path, self.width, self.height, self.mode, self.format)
+
+
+def probe_image(path):
+    """
+    Read the header of an image
+    :param path: path to image on disk as a string
+    :return: ImageInfo object, error is set if the file can't be read
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with Image.open(path) as image:
+            width, height = image.size
+            orientation = 1
+            # Only look when the header has EXIF data, looking for it in
+            # other files can mean reading all of them
+            if "exif" in image.info or image.format == "TIFF":
+                orientation = image.getexif().get(ORIENTATION, 1)
+            # Not n_frames, for GIFs that goes through every frame, this
+            # only looks for a second one
+            return ImageInfo(path, width, height, image.mode, image.format,
+                             file_size, orientation=orientation,
+                             animated=getattr(image, "is_animated", False))
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        return ImageInfo(path, error=str(e))
+
+
+def probe_images(paths, workers=8):
+    """
+    Read the headers of many images at once, reading headers is mostly
+    waiting on the disk so threads help
+    :param paths: paths to images on disk
+    :param workers: amount of headers read at the same time
+    :return: list of ImageInfo objects, in the order of paths
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(probe_image, paths))
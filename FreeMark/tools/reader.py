@@ -0,0 +1,217 @@
+import io
+import mmap
+import os
+import threading
+
+# Files at least this big are memory mapped, smaller ones are read in one
+# go into a pooled buffer, mapping a small file costs more than reading it
+MMAP_THRESHOLD = 2**20
+# Buffers are allocated in steps of this, so similar sizes share buffers
+BUFFER_STEP = 2**16
+# Size of each read from a stream of unknown length
+CHUNK_SIZE = 2**16
+
+
+class BufferPool:
+    """
+    Recycles the buffers encoded images are read into, so reading a long
+    stream of images doesn't allocate a fresh buffer for each of them.
+    Thread safe, a process shares one pool between its threads.
+    """
+    def __init__(self, max_buffers=8, max_size=64 * 2**20):
+        """
+        :param max_buffers: max free buffers kept for reuse
+        :param max_size: bigger buffers are dropped instead of kept
+        """
+        self.max_buffers = max_buffers
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.free = []
+        self.allocated = 0
+
+    def get(self, size):
+        """
+        :param size: bytes needed
+        :return: bytearray of at least size bytes
+        """
+        with self.lock:
+            fitting = [buffer for buffer in self.free if len(buffer) >= size]
+            if fitting:
+                buffer = min(fitting, key=len)
+                self.free.remove(buffer)
+                return buffer
+            self.allocated += 1
+        return bytearray(-(-max(size, 1) // BUFFER_STEP) * BUFFER_STEP)
+
+    def put(self, buffer):
+        """
+        Give a buffer back, nothing may use it afterwards
+        :param buffer: bytearray from get()
+        """
+        if len(buffer) > self.max_size:
+            return
+        with self.lock:
+            self.free.append(buffer)
+            if len(self.free) > self.max_buffers:
+                # Keep the biggest, they fit every image the small ones do
+                self.free.remove(min(self.free, key=len))
+
+
+# The pool of this process
+POOL = BufferPool()
+
+
+class BufferStream(io.RawIOBase):
+    """
+    Seekable, read only file object over a memoryview, the bytes of a
+    pooled buffer or a memory mapped file. Closing it hands the memory back,
+    so an image read from it must be loaded first.
+    """
+    def __init__(self, view, release=None, name=None):
+        """
+        :param view: memoryview of the encoded image
+        :param release: function called when the stream is closed
+        :param name: path or member name the bytes came from
+        """
+        super().__init__()
+        self.view = view
+        self.position = 0
+        self.release = release
+        self.name = name
+
+    def __repr__(self):
+        # Pillow puts the stream in its errors, show where it came from
+        if self.name is not None:
+            return repr(self.name)
+        return super().__repr__()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        # Straight from the view, RawIOBase's read would copy twice
+        end = len(self.view) if size is None or size < 0 \
+            else min(self.position + size, len(self.view))
+        data = self.view[self.position:end].tobytes()
+        self.position = max(end, self.position)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        data = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = len(self.view) + offset
+        else:
+            raise ValueError("invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("negative seek position {}".format(position))
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def detach_buffer(self):
+        """
+        Keep the memory when the stream is closed, for images that keep
+        reading from it after they're opened, like animations
+        """
+        self.release = None
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+            if self.release:
+                self.release()
+        super().close()
+
+
+def open_input(path, pool=POOL):
+    """
+    Open an image file for Pillow with as few reads and allocations as
+    possible. Big files are memory mapped and the kernel is told they're
+    read front to back, small ones are read with a single read into a
+    buffer from the pool.
+    :param path: path of the file
+    :param pool: BufferPool for the small files
+    :return: BufferStream, close it once the image is loaded
+    """
+    with open(path, "rb", buffering=0) as input_file:
+        size = os.fstat(input_file.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            # Not on Windows
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            return BufferStream(memoryview(mapped), release=mapped.close,
+                                name=path)
+
+        buffer = pool.get(size)
+        view = memoryview(buffer)
+        filled = 0
+        try:
+            while filled < size:
+                read = input_file.readinto(view[filled:size])
+                if not read:
+                    # Shrunk while it was being read
+                    break
+                filled += read
+        except BaseException:
+            view.release()
+            pool.put(buffer)
+            raise
+        stream = BufferStream(view[:filled], release=lambda: pool.put(buffer),
+                              name=path)
+        view.release()
+        return stream
+
+
+def read_stream(source, pool=POOL, size=None, name=None):
+    """
+    Read a stream which can't be mapped, like an archive member or an
+    upload, into a pooled buffer
+    :param source: file object with readinto
+    :param pool: BufferPool to take the buffer from
+    :param size: size of the stream if it's known up front
+    :param name: name to show in errors, e.g. the member's path
+    :return: BufferStream, close it once the image is loaded
+    """
+    buffer = pool.get(size or CHUNK_SIZE)
+    filled = 0
+    try:
+        while size is None or filled < size:
+            if filled == len(buffer):
+                # Outgrew the buffer, move to one twice as big
+                bigger = pool.get(2 * len(buffer))
+                bigger[:filled] = buffer
+                pool.put(buffer)
+                buffer = bigger
+            with memoryview(buffer) as view:
+                end = len(buffer) if size is None else size
+                read = source.readinto(view[filled:end])
+            if not read:
+                break
+            filled += read
+    except BaseException:
+        pool.put(buffer)
+        raise
+    with memoryview(buffer) as view:
+        return BufferStream(view[:filled], release=lambda: pool.put(buffer),
+                            name=name)
@@ -0,0 +1,264 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.adaptive import AdaptiveOpacity, DEFAULT_CURVE
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import check_blend, parse_padding, parse_size
+from FreeMark.tools import metrics
+from FreeMark.tools.reader import read_stream
+
+
+class WatermarkService:
+    """
+    Watermarks images held in memory on a bounded pool of worker threads.
+    Every worker keeps its own WaterMarker, so the watermark and its scaled
+    copies stay loaded between requests.
+    """
+    def __init__(self, watermark_path, workers=4, max_queued=8):
+        """
+        :param watermark_path: path to the watermark image
+        :param workers: amount of images processed at the same time
+        :param max_queued: amount of images allowed to wait for a worker,
+                           anything beyond that is turned away
+        """
+        self.watermark_path = watermark_path
+        # Load the watermark once up front so a bad path fails immediately
+        WaterMarker(watermark_path)
+
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + max_queued)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queued = 0  # Accepted images that haven't been sent back yet
+
+    def get_watermarker(self):
+        """
+        Get the WaterMarker belonging to the current worker thread
+        :return: WaterMarker object
+        """
+        if not hasattr(self.local, "watermarker"):
+            self.local.watermarker = WaterMarker(self.watermark_path)
+        return self.local.watermarker
+
+    def submit(self, data, output_format=None, **kwargs):
+        """
+        Queue an image for watermarking
+        :param data: encoded image as bytes or a file object
+        :param output_format: PIL format name, defaults to the input format
+        :param kwargs: options passed on to mark_image
+        :return: future resolving to (bytes, mime type),
+                 or None if the service is saturated
+        """
+        if not self.slots.acquire(blocking=False):
+            metrics.record_image("rejected", 0)
+            return None
+        try:
+            future = self.executor.submit(self.process, data, output_format,
+                                          **kwargs)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        self.count_queued(1)
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        """Free the slot of a finished image"""
+        self.count_queued(-1)
+        self.slots.release()
+
+    def count_queued(self, change):
+        with self.lock:
+            self.queued += change
+            metrics.set_in_flight(self.queued, 0)
+            metrics.set_queue_depth(max(0, self.queued - self.workers))
+
+    def process(self, data, output_format=None, **kwargs):
+        """
+        Watermark an encoded image
+        :param data: encoded image as bytes or a file object
+        :param output_format: PIL format name, defaults to the input format
+        :param kwargs: options passed on to mark_image
+        :return: (bytes, mime type)
+        """
+        start = time.perf_counter()
+        watermarker = self.get_watermarker()
+        hits, misses = watermarker.cache_hits, watermarker.cache_misses
+        try:
+            body, mime = self.mark(watermarker, data, output_format, **kwargs)
+        except Exception as e:
+            metrics.record_image("failed", time.perf_counter() - start,
+                                 error=e)
+            raise
+        metrics.record_image("done", time.perf_counter() - start,
+                             bytes_in=len(data), bytes_out=len(body),
+                             cache_hits=watermarker.cache_hits - hits,
+                             cache_misses=watermarker.cache_misses - misses)
+        return body, mime
+
+    @staticmethod
+    def mark(watermarker, data, output_format=None, **kwargs):
+        """
+        Decode, mark and encode an image with a worker's WaterMarker
+        :return: (bytes, mime type)
+        """
+        try:
+            if not hasattr(data, "read"):
+                data = io.BytesIO(data)
+            # Decoded straight at the reduced scale when shrinking
+            image, _ = watermarker.open_image(data, kwargs.get("output_size"))
+        except OSError:
+            raise BadOptionError("Uploaded image is of incompatible type.")
+        output_format = (output_format or image.format or "PNG").upper()
+
+        try:
+            body = watermarker.apply_watermark_data(image,
+                                                    output_format=output_format,
+                                                    **kwargs)
+        except (KeyError, OSError):
+            raise BadOptionError("Can't write images as {}.".format(output_format))
+        mime = Image.MIME.get(output_format, "application/octet-stream")
+        return body, mime
+
+    def shutdown(self):
+        """
+        Stop the worker threads once the queued images are done
+        """
+        self.executor.shutdown(wait=True)
+
+
+def parse_options(query):
+    """
+    Turn a request's query string into watermark options
+    :param query: query string of the request url
+    :return: (output format or None, dict of mark_image kwargs)
+    """
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    kwargs = {"pos": params.get("pos", "SE").upper()}
+    if kwargs["pos"] not in ("NW", "NE", "SW", "SE", "AUTO"):
+        raise BadOptionError("pos must be one of NW, NE, SW, SE or AUTO.")
+    kwargs["padding"] = parse_padding(params.get("padding", "20px,5px"))
+    try:
+        if params.get("opacity", "").lower() == "auto":
+            kwargs["opacity"] = AdaptiveOpacity(
+                params.get("opacity_curve", DEFAULT_CURVE),
+                variants=params.get("opacity_variants", "") in ("1", "true"))
+        else:
+            kwargs["opacity"] = float(params.get("opacity", 1.0))
+            if not 0 <= kwargs["opacity"] <= 1:
+                raise BadOptionError("opacity must be between 0 and 1.")
+        kwargs["scale_x"] = float(params.get("scale_x", 1.0))
+        kwargs["scale_y"] = float(params.get("scale_y", 1.0))
+    except ValueError:
+        raise BadOptionError("opacity, scale_x and scale_y must be numbers.")
+    if kwargs["scale_x"] <= 0 or kwargs["scale_y"] <= 0:
+        raise BadOptionError("scale_x and scale_y must be above 0.")
+    kwargs["blend"] = check_blend(params.get("blend"))
+    if "max_size" in params:
+        kwargs["output_size"] = parse_size(params["max_size"])
+    return params.get("format"), kwargs
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST an image as the raw request body to /watermark, options go in the
+    query string, e.g. /watermark?pos=NW&padding=10px,2%25&opacity=0.5
+    GET /metrics for Prometheus metrics
+    """
+    service = None
+    max_upload = 100 * 1024 * 1024
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self.send_body(200, b"ok", "text/plain")
+        elif path == "/metrics":
+            self.send_body(200, metrics.REGISTRY.render().encode(),
+                           metrics.CONTENT_TYPE)
+        else:
+            self.send_body(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/watermark":
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length < 1 or length > self.max_upload:
+            self.send_body(413 if length else 400,
+                           b"Image must be sent as the request body",
+                           "text/plain")
+            return
+        # Uploads are read into recycled buffers
+        data = read_stream(self.rfile, size=length)
+
+        try:
+            output_format, kwargs = parse_options(url.query)
+            future = self.service.submit(data, output_format, **kwargs)
+            if future is None:
+                self.send_body(503, b"Too busy, try again later", "text/plain",
+                               headers={"Retry-After": "1"})
+                return
+            body, mime = future.result()
+        except BadOptionError as e:
+            self.send_body(400, str(e).encode(), "text/plain")
+            return
+        except Exception as e:
+            self.send_body(500, str(e).encode(), "text/plain")
+            return
+        finally:
+            data.close()
+        self.send_body(200, body, mime)
+
+    def send_body(self, status, body, content_type, headers=None):
+        """
+        Send a complete response
+        :param status: HTTP status code
+        :param body: response body as bytes
+        :param content_type: mime type of the body
+        :param headers: optional dict of extra headers
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Only log failures, rejected requests are expected under load and
+        # would flood stdout just like successful ones
+        status = str(args[1]) if len(args) > 1 else ""
+        if status.startswith(("4", "5")) and status != "503":
+            super().log_message(format, *args)
+
+
+def create_server(watermark_path, host="127.0.0.1", port=8080, workers=4,
+                  max_queued=8):
+    """
+    Create a watermarking HTTP server, call serve_forever() to run it
+    :param watermark_path: path to the watermark image
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param workers: amount of images processed at the same time
+    :param max_queued: amount of images allowed to wait for a worker
+    :return: ThreadingHTTPServer object
+    """
+    service = WatermarkService(watermark_path, workers=workers,
+                               max_queued=max_queued)
+    handler = type("Handler", (WatermarkRequestHandler, ),
+                   {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
@@ -0,0 +1,221 @@
+import os
+import hashlib
+import queue
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+
+def get_default_cache_dir():
+    """
+    Get the folder thumbnails are cached in when nothing else is asked for
+    :return: path as a string
+    """
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "FreeMark", "thumbnails")
+
+
+def make_thumbnail(path, size=(96, 96)):
+    """
+    Create a thumbnail without decoding the image at full size,
+    JPEGs are decoded at a reduced scale straight from the DCT data
+    :param path: path to image on disk as a string
+    :param size: max (width, height) of the thumbnail
+    :return: PIL image object
+    """
+    image = Image.open(path)
+    # draft picks the smallest JPEG scale still at least as big as size,
+    # it's a no-op for other formats. Rotation can swap the sides so ask
+    # for the longest side in both directions.
+    longest = max(size)
+    image.draft("RGB", (longest, longest))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(size, reducing_gap=2.0)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info
+                              or image.mode in ("LA", "PA") else "RGB")
+    return image
+
+
+class ThumbnailCache:
+    """
+    On disk thumbnail cache, entries are keyed by path, file size and mtime
+    so changed files get a new thumbnail. Once the cache grows past max_bytes
+    the least recently used thumbnails are deleted.
+    """
+    def __init__(self, cache_dir=None, max_bytes=64 * 1024 * 1024,
+                 size=(96, 96)):
+        """
+        :param cache_dir: folder to keep thumbnails in
+        :param max_bytes: max size of the cache on disk
+        :param size: max (width, height) of the thumbnails
+        """
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.max_bytes = max_bytes
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # name -> (bytes on disk, last use), read once instead of every put
+        self.entries = {}
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    self.entries[entry.name] = (stat.st_size, stat.st_mtime)
+        self.total_bytes = sum(size for size, _ in self.entries.values())
+        # The cap might have been lowered since the cache was last used
+        with self.lock:
+            self.evict()
+
+    def get_name(self, path):
+        """
+        Get the cache file name of an image
+        :param path: path to image on disk as a string
+        :return: file name as a string
+        """
+        stat = os.stat(path)
+        key = "{}|{}|{}|{}x{}".format(os.path.abspath(path), stat.st_size,
+                                      stat.st_mtime_ns, *self.size)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png"
+
+    def get(self, path):
+        """
+        Get a cached thumbnail
+        :param path: path to image on disk as a string
+        :return: PIL image object, or None if it isn't cached
+        """
+        name = self.get_name(path)
+        cache_path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            # The file mtime doubles as last use, so the LRU order survives
+            # restarts
+            now = time.time()
+            try:
+                os.utime(cache_path, (now, now))
+            except FileNotFoundError:
+                self.total_bytes -= self.entries.pop(name)[0]
+                return None
+            self.entries[name] = (self.entries[name][0], now)
+        try:
+            with Image.open(cache_path) as image:
+                image.load()
+                return image
+        except OSError:
+            return None
+
+    def put(self, path, thumbnail):
+        """
+        Store a thumbnail in the cache
+        :param path: path to image on disk as a string
+        :param thumbnail: PIL image object
+        """
+        name = self.get_name(path)
+        cache_path = os.path.join(self.cache_dir, name)
+        temp_path = "{}.{}.tmp".format(cache_path, threading.get_ident())
+        thumbnail.save(temp_path, format="PNG")
+        os.replace(temp_path, cache_path)
+
+        stat = os.stat(cache_path)
+        with self.lock:
+            old_size = self.entries.get(name, (0, 0))[0]
+            self.entries[name] = (stat.st_size, stat.st_mtime)
+            self.total_bytes += stat.st_size - old_size
+            self.evict()
+
+    def get_or_create(self, path):
+        """
+        Get a thumbnail from the cache, creating it if it isn't there
+        :param path: path to image on disk as a string
+        :return: PIL image object
+        """
+        thumbnail = self.get(path)
+        if thumbnail is None:
+            thumbnail = make_thumbnail(path, self.size)
+            self.put(path, thumbnail)
+        return thumbnail
+
+    def evict(self):
+        """
+        Delete least recently used thumbnails until the cache fits max_bytes,
+        the caller must hold the lock
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        for name, (size, _) in sorted(self.entries.items(),
+                                      key=lambda item: item[1][1]):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            del self.entries[name]
+            self.total_bytes -= size
+            if self.total_bytes <= self.max_bytes:
+                return
+
+
+class ThumbnailLoader:
+    """
+    Loads thumbnails on a background thread, results are put on a queue
+    as (index, PIL image) so the GUI thread can pick them up.
+    Cached thumbnails are delivered first, the rest are made afterwards.
+    """
+    def __init__(self, cache):
+        """
+        :param cache: ThumbnailCache object
+        """
+        self.cache = cache
+        self.results = queue.Queue()
+        self.generation = 0
+        self.thread = None
+
+    def load(self, paths):
+        """
+        Start loading thumbnails for a list of images,
+        work for any previous list is abandoned
+        :param paths: list of paths to images on disk
+        """
+        self.generation += 1
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True,
+                                       args=(list(paths), self.generation,
+                                             self.results))
+        self.thread.start()
+
+    def cancel(self):
+        """
+        Abandon the current list
+        """
+        self.generation += 1
+
+    def work(self, paths, generation, results):
+        """
+        Work instructions for the loader thread
+        """
+        missing = []
+        for index, path in enumerate(paths):
+            if generation != self.generation:
+                return
+            try:
+                thumbnail = self.cache.get(path)
+            except OSError:
+                continue
+            if thumbnail is None:
+                missing.append((index, path))
+            else:
+                results.put((index, thumbnail))
+
+        for index, path in missing:
+            if generation != self.generation:
+                return
+            try:
+                thumbnail = make_thumbnail(path, self.cache.size)
+                self.cache.put(path, thumbnail)
+            except (OSError, ValueError) as e:
+                print("Couldn't create thumbnail for", path, e)
+                continue
+            results.put((index, thumbnail))
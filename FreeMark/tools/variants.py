@@ -0,0 +1,130 @@
+import os
+
+from PIL import Image
+
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import NONE, PRE, SUFFIX, parse_size, rename_file
+
+# Save options pr. format for each encoder profile, formats that aren't
+# listed are saved with Pillow's defaults
+PROFILES = {"default": {},
+            "archive": {"JPEG": {"quality": 95, "subsampling": 0},
+                        "WEBP": {"quality": 95, "method": 6}},
+            "web": {"JPEG": {"quality": 82, "optimize": True,
+                             "progressive": True},
+                    "WEBP": {"quality": 80, "method": 4},
+                    "PNG": {"optimize": True}},
+            "thumbnail": {"JPEG": {"quality": 75, "optimize": True},
+                          "WEBP": {"quality": 70, "method": 4},
+                          "PNG": {"optimize": True}}}
+
+# Extension used for each output format, others use their first registered one
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif",
+              "TIFF": ".tiff", "BMP": ".bmp"}
+
+FIX_POSITIONS = {"none": NONE, "prefix": PRE, "suffix": SUFFIX}
+
+
+def get_extension(output_format):
+    """
+    :param output_format: PIL format name
+    :return: file extension, with the dot
+    """
+    output_format = output_format.upper()
+    if output_format in EXTENSIONS:
+        return EXTENSIONS[output_format]
+    for extension, name in Image.registered_extensions().items():
+        if name == output_format:
+            return extension
+    raise BadOptionError("Unknown output format {}.".format(output_format))
+
+
+class OutputVariant:
+    """
+    One of several outputs written for every input image, e.g. a full size
+    copy, a web version and a thumbnail
+    """
+    def __init__(self, size=None, output_format=None, profile="default",
+                 fix="", fix_position=NONE, subfolder=""):
+        """
+        :param size: max long edge (int) or (width, height) box, also as a
+                     string like '1600' or '400x400', None for full size
+        :param output_format: PIL format name, None keeps the output's format
+        :param profile: name of an encoder profile in PROFILES, or a dict of
+                        save options pr. format
+        :param fix: text added to the file name, see rename_file
+        :param fix_position: NONE, PRE or SUFFIX, or 'none', 'prefix' or
+                             'suffix'
+        :param subfolder: folder next to the output to write the variant to
+        """
+        if isinstance(size, str):
+            size = parse_size(size)
+        if isinstance(size, list):
+            # From JSON
+            size = tuple(size)
+        self.size = size
+        self.output_format = output_format.upper() if output_format else None
+        if self.output_format:
+            get_extension(self.output_format)
+        if isinstance(profile, str) and profile not in PROFILES:
+            raise BadOptionError("Unknown encoder profile {}, use one of {}."
+                                 .format(profile, ", ".join(sorted(PROFILES))))
+        self.profile = profile
+        if isinstance(fix_position, str):
+            if fix_position.lower() not in FIX_POSITIONS:
+                raise BadOptionError("fix_position must be none, prefix "
+                                     "or suffix.")
+            fix_position = FIX_POSITIONS[fix_position.lower()]
+        self.fix = fix
+        self.fix_position = fix_position
+        self.subfolder = subfolder
+
+    def __repr__(self):
+        return "OutputVariant(size={!r}, output_format={!r}, profile={!r}, " \
+               "fix={!r}, fix_position={!r}, subfolder={!r})".format(
+                self.size, self.output_format, self.profile, self.fix,
+                self.fix_position, self.subfolder)
+
+    def get_output_path(self, output_path):
+        """
+        Get where the variant goes
+        :param output_path: the path the image would be saved to without
+                            variants
+        :return: path of the variant
+        """
+        folder, filename = os.path.split(output_path)
+        filename = rename_file(filename, self.fix, self.fix_position)
+        if self.output_format:
+            filename = os.path.splitext(filename)[0] \
+                + get_extension(self.output_format)
+        return os.path.join(folder, self.subfolder, filename)
+
+    def get_save_options(self, output_format):
+        """
+        :param output_format: PIL format name the variant is saved as
+        :return: dict of save options
+        """
+        profile = self.profile
+        if isinstance(profile, str):
+            profile = PROFILES[profile]
+        return dict(profile.get(output_format.upper(), {}))
+
+
+def get_variants(variants):
+    """
+    Turn a list of variant options into OutputVariant objects
+    :param variants: list of OutputVariant objects or dicts of their options
+    :return: list of OutputVariant objects
+    """
+    made = []
+    for variant in variants:
+        if isinstance(variant, OutputVariant):
+            made.append(variant)
+            continue
+        try:
+            made.append(OutputVariant(**variant))
+        except TypeError as e:
+            raise BadOptionError("Bad output variant {!r}: {}".format(variant, e))
+    if not made:
+        raise BadOptionError("Give at least one output variant.")
+    return made
@@ -0,0 +1,245 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+from FreeMark.tools.watermarker import WaterMarker
+from FreeMark.tools.batch import Job, run_job
+from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.help import is_image_file
+from FreeMark.tools.metrics import record_result, set_queue_depth, set_in_flight
+
+
+class FolderWatcher:
+    """
+    Long running 'hot folder' mode, watermarks images as they land in a folder.
+
+    The folder listing is only re-read when the folder itself changes
+    (its mtime moves), otherwise a poll only stats the handful of files
+    that are still being written. A file is considered ready once its size
+    and mtime have been stable for settle_time seconds, it is then pushed
+    through a bounded queue to a pool of worker threads.
+    """
+    def __init__(self, watch_dir, output_dir, watermark_path, workers=2,
+                 queue_size=64, poll_interval=0.2, settle_time=0.3,
+                 overwrite=False, **watermark_kwargs):
+        """
+        :param watch_dir: folder to watch for new images
+        :param output_dir: folder the watermarked images are written to
+        :param watermark_path: path to the watermark image
+        :param workers: amount of worker threads
+        :param queue_size: max amount of ready files waiting for a worker
+        :param poll_interval: seconds between each poll of the folder
+        :param settle_time: seconds a file must be unchanged before it's used
+        :param overwrite: overwrite existing files in the output folder
+        :param watermark_kwargs: options passed on to apply_watermark
+        """
+        if os.path.abspath(watch_dir) == os.path.abspath(output_dir):
+            raise BadOptionError("Output folder can't be the watched folder.")
+        if not os.path.isdir(watch_dir):
+            raise BadOptionError("Watched folder doesn't exist.")
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.watermark_path = watermark_path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.overwrite = overwrite
+        self.watermark_kwargs = watermark_kwargs
+
+        # Load the watermark once up front so a bad path fails immediately
+        WaterMarker(watermark_path)
+
+        self.ready_que = queue.Queue(maxsize=queue_size)
+        self.running = False
+        self.threads = []
+
+        self.seen = set()       # Names already settled, ready or handed on
+        self.pending = {}       # name -> (size, mtime, last change, first seen)
+        self.ready = deque()    # (name, first seen) waiting for a free slot
+        self.dir_mtime = None
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.finished = deque(maxlen=256)  # Finish times, for throughput
+        self.start_time = None
+
+    def start(self):
+        """
+        Start polling and spawn the worker threads
+        """
+        self.running = True
+        self.start_time = time.time()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.watch, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """
+        Stop watching, workers finish the image they're working on
+        :param wait: block until every thread has stopped
+        """
+        self.running = False
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+
+    def watch(self):
+        """
+        Poll loop, run in its own thread
+        """
+        while self.running:
+            self.poll()
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        """
+        Do a single poll of the watched folder
+        """
+        now = time.time()
+        self.scan_if_changed(now)
+
+        # Only the files we haven't accepted yet are checked
+        for name, (size, mtime, changed, first_seen) in list(self.pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.watch_dir, name))
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns,
+                                      now, first_seen)
+            elif stat.st_size > 0 and now - changed >= self.settle_time:
+                del self.pending[name]
+                # Seen from here on, so a rescan while the queue is full
+                # doesn't pick it up again
+                self.seen.add(name)
+                self.ready.append((name, first_seen))
+
+        # Hand ready files to the workers without ever blocking the poll loop
+        while self.ready:
+            try:
+                self.ready_que.put_nowait(self.ready[0])
+            except queue.Full:
+                break
+            self.ready.popleft()
+        set_queue_depth(len(self.pending) + len(self.ready)
+                        + self.ready_que.qsize())
+
+    def scan_if_changed(self, now):
+        """
+        Re-read the folder listing, but only if the folder has changed.
+        :param now: time of the current poll
+        """
+        try:
+            dir_mtime = os.stat(self.watch_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        # Coarse file system timestamps can hide a change made in the same
+        # tick as the last scan, so keep scanning while the mtime is fresh
+        recent = now - dir_mtime / 1e9 < 2
+        if dir_mtime == self.dir_mtime and not recent:
+            return
+        self.dir_mtime = dir_mtime
+
+        names = set()
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not is_image_file(entry.name):
+                    continue
+                names.add(entry.name)
+                if entry.name in self.seen or entry.name in self.pending:
+                    continue
+                stat = entry.stat()
+                self.pending[entry.name] = (stat.st_size, stat.st_mtime_ns,
+                                            now, now)
+
+        # Forget files that were removed so they can be dropped in again
+        self.seen &= names
+
+    def work(self):
+        """
+        Work instructions for the worker threads, every thread gets its own
+        WaterMarker since it caches the scaled watermark between images
+        """
+        watermarker = WaterMarker(self.watermark_path, overwrite=self.overwrite)
+        while self.running:
+            try:
+                name, first_seen = self.ready_que.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            with self.lock:
+                self.in_flight += 1
+                set_in_flight(self.in_flight, 0)
+            job = Job(os.path.join(self.watch_dir, name),
+                      os.path.join(self.output_dir, name))
+            result = run_job(self.watermark_path, self.overwrite, job, 0,
+                             self.watermark_kwargs, watermarker=watermarker)
+            record_result(result)
+            if not result.ok:
+                print("Error!\n", name, type(result.error), "\n", result.error)
+                with self.lock:
+                    self.failed += 1
+            else:
+                latency = time.time() - first_seen
+                with self.lock:
+                    self.processed += 1
+                    self.last_latency = latency
+                    self.total_latency += latency
+                    self.finished.append(time.time())
+            with self.lock:
+                self.in_flight -= 1
+                set_in_flight(self.in_flight, 0)
+
+    def get_throughput(self):
+        """
+        Get images pr. second over the recently finished images
+        :return: images pr. second as a float
+        """
+        with self.lock:
+            finished = list(self.finished)
+        if len(finished) < 2:
+            return 0.0
+        window = time.time() - finished[0]
+        return (len(finished) - 1) / window if window > 0 else 0.0
+
+    def get_backlog(self):
+        """
+        Get the amount of images that have landed but aren't done yet
+        :return: amount of images as an int
+        """
+        return (len(self.pending) + len(self.ready)
+                + self.ready_que.qsize() + self.in_flight)
+
+    def get_stats(self):
+        """
+        Get throughput and backlog statistics
+        :return: dict of statistics
+        """
+        with self.lock:
+            processed = self.processed
+            mean_latency = self.total_latency / processed if processed else 0.0
+            stats = {"processed": processed,
+                     "failed": self.failed,
+                     "in_flight": self.in_flight,
+                     "last_latency": self.last_latency,
+                     "mean_latency": mean_latency}
+        stats["backlog"] = self.get_backlog()
+        stats["throughput"] = self.get_throughput()
+        stats["uptime"] = time.time() - self.start_time if self.start_time else 0
+        return stats
@@ -1,19 +1,58 @@
 from PIL import Image, ImageOps
+from collections import OrderedDict
+import functools
+import io
 import os
-from FreeMark.tools.help import clamp
+import time
+from FreeMark.tools.help import check_blend, clamp
+from FreeMark.tools.adaptive import get_adaptive
 from FreeMark.tools.errors import BadOptionError
+from FreeMark.tools.reader import open_input
+
+# Formats where every frame of an animated image is kept
+ANIMATED_FORMATS = ("GIF", "PNG", "WEBP")
+# EXIF tag of the orientation
+ORIENTATION = 0x0112
+
+
+def get_format(path):
+    """
+    Guess the PIL format name of a path from its extension
+    :param path: path as a string
+    :return: format name, or None if the extension is unknown
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions().get(extension)
 
 
 class WaterMarker:
     """Object for applying a free_mark to images"""
     def __init__(self, watermark_path, overwrite=False):
+        self.watermark_path = watermark_path
         self.overwrite = overwrite
+        # Seconds spent in each stage by the last apply_watermark call
+        self.timings = {}
+        # Files written by the last apply_watermark call, several with variants
+        self.written = []
+        # Corner the last free_mark went in, tells what 'AUTO' picked
+        self.last_position = None
 
         self.watermark_ratio = None
         self.watermark = None
-        self.watermark_copy = None
-        self.previous_size = None
-        self.needs_opacity = None
+        # Scaled free_marks by (image size, opacity, scale_x, scale_y)
+        self.watermark_cache = OrderedDict()
+        self.cache_size = 8
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Reused for every encode by apply_watermark_data
+        self.output_buffer = io.BytesIO()
+        # Layer stacks by repr of their layers, and the WaterMarkers
+        # scaling their extra watermarks, by path
+        self.layer_stacks = OrderedDict()
+        self.layer_watermarkers = {}
+        # Opacity levels for adaptive opacity, by (image size, scale_x,
+        # scale_y, settings)
+        self.opacity_levels = OrderedDict()
 
         self.landscape_scale_factor = 0.15
         self.portrait_scale_factor = 0.30
@@ -37,116 +76,769 @@ class WaterMarker:
         """
         self.watermark_ratio = None
         self.watermark = None
+        self.watermark_cache.clear()
+        self.layer_stacks.clear()
+        self.opacity_levels.clear()
+        self.layer_watermarkers = {}
 
     def apply_watermark(self, input_path, output_path,
                         pos="SE", padding=((20, "px"), (5, "px")),
-                        opacity=0.5, scale_x=1.0, scale_y=1.0):
+                        opacity=0.5, scale_x=1.0, scale_y=1.0, layers=None,
+                        output_size=None, variants=None, decode_cache=None,
+                        blend="normal"):
         """
         Apply a free_mark to an image
         :param input_path: path to image on disk as a string
         :param output_path: save destination (path) as a string
         :param scale: Bool, scale free_mark
-        :param opacity: free_mark opacity (a value between 0 and 1)
+        :param opacity: free_mark opacity (a value between 0 and 1),
+                        or 'auto', see mark_image
         :param pos: Assumes first char is y (N/S) and second is x (E/W)
         :param padding: padding in format ((x_pad, unit), (y_pad, unit))
         :param scale_x: 横向缩放比例
         :param scale_y: 纵向缩放比例
+        :param layers: optional list of layer dicts (see FreeMark.tools.layers),
+                       applied instead of the single free_mark
+        :param output_size: shrink the image to a max long edge (int) or to
+                            fit a (width, height) box before marking it,
+                            JPEGs are decoded straight at a smaller scale
+        :param variants: optional list of OutputVariant objects or dicts of
+                         their options (see FreeMark.tools.variants), every
+                         variant is written from a single decode, relative to
+                         output_path, instead of output_path itself
+        :param decode_cache: optional DecodeCache (see
+                             FreeMark.tools.decode_cache) the decoded image is
+                             taken from, or added to
+        :param blend: how the free_mark is combined with the image, one of
+                      BLEND_MODES (normal, multiply, screen, overlay,
+                      soft_light), see mark_image
+        :return: True if the image was written, False if it already existed
         """
+        self.timings = {}
+        self.written = []
+        kwargs = {"pos": pos, "padding": padding, "opacity": opacity,
+                  "scale_x": scale_x, "scale_y": scale_y, "layers": layers,
+                  "blend": blend}
+        if variants:
+            return self.apply_variants(input_path, output_path, variants,
+                                       output_size=output_size,
+                                       decode_cache=decode_cache, **kwargs)
         # Don't overwrite existing files unless asked to
         if os.path.isfile(output_path) and not self.overwrite:
+            return False
+
+        output_format = get_format(output_path)
+        if output_format is None:
+            raise ValueError("unknown file extension: {}".format(output_path))
+        self.write_part(output_path, functools.partial(
+            self.write_watermarked, input_path, output_format=output_format,
+            output_size=output_size, decode_cache=decode_cache, **kwargs))
+        return True
+
+    def write_part(self, output_path, write):
+        """
+        Write a file next to the output and rename it when done, so a job
+        that's killed half way never leaves a truncated image behind
+        :param output_path: final path of the file
+        :param write: function writing the file to the path it's given
+        """
+        part_path = output_path + ".part"
+        try:
+            write(part_path)
+            os.replace(part_path, output_path)
+        except BaseException:
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+            raise
+        self.written.append(output_path)
+
+    def apply_variants(self, input_path, output_path, variants,
+                       output_size=None, decode_cache=None, **kwargs):
+        """
+        Write several versions of an image, e.g. full size, web and thumbnail,
+        from a single decode. The image is decoded at the size of the
+        largest variant, every smaller variant is shrunk from the one before
+        it, and each gets a free_mark scaled for its own size.
+        :param input_path: path to image on disk as a string
+        :param output_path: path the image would be saved to without
+                            variants, the variants' paths are based on it
+        :param variants: list of OutputVariant objects or dicts of their options
+        :param output_size: size of the variants that don't set one
+        :param decode_cache: optional DecodeCache, see apply_watermark
+        :param kwargs: mark_image options
+        :return: True if any variant was written, False if all of them
+                 already existed
+        """
+        from FreeMark.tools.variants import get_variants
+
+        todo = []
+        for variant in get_variants(variants):
+            path = variant.get_output_path(output_path)
+            if os.path.isfile(path) and not self.overwrite:
+                continue
+            output_format = variant.output_format or get_format(path)
+            if output_format is None:
+                raise ValueError("unknown file extension: {}".format(path))
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            todo.append((variant, path, output_format,
+                         variant.size or output_size))
+        if not todo:
+            return False
+
+        start = time.perf_counter()
+        sizes = [size for _, _, _, size in todo]
+        # A box covering every variant, so nothing is upscaled later
+        covering = None
+        if all(sizes):
+            boxes = [self.get_output_box(size) for size in sizes]
+            covering = (max(box[0] for box in boxes),
+                        max(box[1] for box in boxes))
+        image, exif = self.load_image(input_path, covering, decode_cache)
+        self.timings = {"decode": time.perf_counter() - start,
+                        "mark": 0.0, "encode": 0.0}
+
+        if getattr(image, "is_animated", False):
+            self.write_animated_variants(image, exif, todo, **kwargs)
+            return True
+
+        # Largest first, every variant is shrunk from the one before it
+        todo = sorted(((self.get_output_dimensions(image.size, size),
+                        variant, path, output_format)
+                       for variant, path, output_format, size in todo),
+                      key=lambda item: item[0][0] * item[0][1], reverse=True)
+
+        clean = image
+        for index, (dimensions, variant, path, output_format) in enumerate(todo):
+            started = time.perf_counter()
+            if clean.size != dimensions:
+                clean = self.get_resizable(clean).resize(
+                    dimensions, Image.HAMMING, reducing_gap=1.0)
+            current = clean
+            # Marking pastes into the image, so the next variant is shrunk
+            # from this one before it's marked instead of copying it
+            if index + 1 < len(todo):
+                following = todo[index + 1][0]
+                clean = current.copy() if following == dimensions \
+                    else self.get_resizable(current).resize(
+                        following, Image.HAMMING, reducing_gap=1.0)
+            marked = self.mark_image(current, **kwargs)
+            marked_at = time.perf_counter()
+            self.write_part(path, functools.partial(
+                self.save_image, marked, output_format=output_format,
+                exif=exif, **variant.get_save_options(output_format)))
+            self.timings["mark"] += marked_at - started
+            self.timings["encode"] += time.perf_counter() - marked_at
+        return True
+
+    def write_animated_variants(self, image, exif, todo, **kwargs):
+        """
+        Write the variants of an animated image. Frames are marked one by
+        one while encoding, so the frames are decoded again for every
+        variant, but the image is only opened once.
+        :param image: animated PIL image object
+        :param exif: raw EXIF data to keep, or None
+        :param todo: list of (variant, path, output format, output size)
+        :param kwargs: mark_image options
+        """
+        for variant, path, output_format, size in todo:
+            save_options = variant.get_save_options(output_format)
+            if self.is_animated(image, output_format):
+                # mark_frames adds its own decode and mark time
+                started = time.perf_counter()
+                before = self.timings["decode"] + self.timings["mark"]
+                self.write_part(path, functools.partial(
+                    self.save_animation, image, output_format=output_format,
+                    exif=exif, output_size=size, save_options=save_options,
+                    **kwargs))
+                self.timings["encode"] += time.perf_counter() - started \
+                    - (self.timings["decode"] + self.timings["mark"] - before)
+                continue
+
+            # Formats without animation only get the first frame
+            started = time.perf_counter()
+            image.seek(0)
+            frame = image.copy()
+            dimensions = self.get_output_dimensions(frame.size, size)
+            if frame.size != dimensions:
+                frame = self.get_resizable(frame).resize(dimensions,
+                                                         Image.HAMMING)
+            frame = self.mark_image(frame, **kwargs)
+            marked = time.perf_counter()
+            self.write_part(path, functools.partial(
+                self.save_image, frame, output_format=output_format,
+                exif=exif, **save_options))
+            self.timings["mark"] += marked - started
+            self.timings["encode"] += time.perf_counter() - marked
+
+    @staticmethod
+    def get_resizable(image):
+        """
+        Pillow resizes palette and bilevel images with nearest neighbour
+        whatever filter is asked for, so convert them first
+        :param image: PIL image object
+        :return: the image, or a converted copy of it
+        """
+        if image.mode == "P":
+            return image.convert("RGBA" if "transparency" in image.info
+                                 else "RGB")
+        if image.mode == "1":
+            return image.convert("L")
+        return image
+
+    def write_watermarked(self, input_path, output_path, output_format=None,
+                          output_size=None, decode_cache=None, **kwargs):
+        """
+        Decode, mark and encode an image, filling in self.timings
+        :param input_path: path to image on disk as a string
+        :param output_path: save destination (path) as a string
+        :param output_format: PIL format name to save as
+        :param output_size: see apply_watermark
+        :param decode_cache: optional DecodeCache, see apply_watermark
+        :param kwargs: mark_image options
+        """
+        start = time.perf_counter()
+        image, exif = self.load_image(input_path, output_size, decode_cache)
+        decoded = time.perf_counter()
+
+        if self.is_animated(image, output_format):
+            self.timings = {"decode": decoded - start}
+            self.save_animation(image, output_path, output_format, exif,
+                                output_size=output_size, **kwargs)
+            self.timings["encode"] = time.perf_counter() - start \
+                - self.timings["decode"] - self.timings["mark"]
             return
 
+        image = self.mark_image(image, **kwargs)
+        marked = time.perf_counter()
+
+        self.save_image(image, output_path, output_format, exif=exif)
+        self.timings = {"decode": decoded - start,
+                        "mark": marked - decoded,
+                        "encode": time.perf_counter() - marked}
+
+    def apply_watermark_data(self, source, output=None, output_format=None,
+                             return_image=False, pos="SE",
+                             padding=((20, "px"), (5, "px")), opacity=0.5,
+                             scale_x=1.0, scale_y=1.0, layers=None,
+                             output_size=None, blend="normal"):
+        """
+        Apply a free_mark without touching the disk.
+        Not thread safe, use a WaterMarker pr. thread.
+        :param source: encoded image as bytes, a file object, or a PIL image
+                       (PIL images are marked in place)
+        :param output: optional file object to write the encoded image to
+        :param output_format: PIL format name, defaults to the input format
+        :param return_image: return the marked PIL image instead of encoding it,
+                             only the first frame of an animated image
+        :param pos: Assumes first char is y (N/S) and second is x (E/W)
+        :param padding: padding in format ((x_pad, unit), (y_pad, unit))
+        :param opacity: free_mark opacity (a value between 0 and 1)
+        :param scale_x: 横向缩放比例
+        :param scale_y: 纵向缩放比例
+        :param layers: optional list of layer dicts, see apply_watermark
+        :param output_size: max long edge or (width, height) box to shrink
+                            the image to, see apply_watermark
+        :param blend: blend mode, see apply_watermark
+        :return: the PIL image if return_image, None if output was given,
+                 otherwise the encoded image as bytes
+        """
+        if isinstance(source, Image.Image):
+            image = source
+            exif = image.info.get("exif")
+            if output_size and not getattr(image, "is_animated", False):
+                self.shrink_image(image, output_size)
+        else:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                source = io.BytesIO(source)
+            image, exif = self.open_image(source, output_size)
+        output_format = (output_format or image.format or "PNG").upper()
+
+        if self.is_animated(image, output_format) and not return_image:
+            self.timings = {}
+            save = functools.partial(
+                self.save_animation, image, output_format=output_format,
+                exif=exif, pos=pos, padding=padding, opacity=opacity,
+                scale_x=scale_x, scale_y=scale_y, layers=layers,
+                output_size=output_size, blend=blend)
+        else:
+            image = self.mark_image(image, pos=pos, padding=padding,
+                                    opacity=opacity, scale_x=scale_x,
+                                    scale_y=scale_y, layers=layers,
+                                    blend=blend)
+            if return_image:
+                return image
+            save = functools.partial(self.save_image, image,
+                                     output_format=output_format, exif=exif)
+
+        if output is not None:
+            save(output)
+            return None
+
+        # Write over the previous image instead of truncating, so the buffer
+        # keeps its size and isn't grown chunk by chunk for every image
+        self.output_buffer.seek(0)
+        save(self.output_buffer)
+        size = self.output_buffer.tell()
+        with self.output_buffer.getbuffer() as view:
+            return bytes(view[:size])
+
+    def apply_many(self, jobs, ordered=True, executor="serial", workers=None,
+                   max_in_flight=None, **kwargs):
+        """
+        Apply the free_mark to many images, see FreeMark.tools.batch.apply_many
+        :param jobs: iterable of Job objects or (input_path, output_path) tuples
+        :return: generator of Result objects
+        """
+        from FreeMark.tools.batch import apply_many
+
+        # Serial runs reuse this WaterMarker and its cached free_marks
+        return apply_many(self.watermark_path, jobs, ordered=ordered,
+                          executor=executor, workers=workers,
+                          max_in_flight=max_in_flight,
+                          overwrite=self.overwrite,
+                          watermarker=self if executor == "serial" else None,
+                          **kwargs)
+
+    def load_image(self, path, output_size=None, decode_cache=None):
+        """
+        Open an image from disk, through the decode cache if there is one
+        :param path: path of the image
+        :param output_size: see open_image
+        :param decode_cache: DecodeCache object or None
+        :return: (PIL image object, raw EXIF data or None)
+        """
+        if decode_cache is not None:
+            return decode_cache.open_image(path, output_size)
+        return self.open_file(path, output_size)
+
+    @staticmethod
+    def open_file(path, output_size=None):
+        """
+        Open an image file like open_image, reading it through
+        FreeMark.tools.reader, so it's memory mapped or read into a
+        recycled buffer instead of through lots of small reads
+        :param path: path of the image
+        :param output_size: see open_image
+        :return: (PIL image object, raw EXIF data or None)
+        """
+        stream = open_input(path)
+        try:
+            image, exif = WaterMarker.open_image(stream, output_size)
+        except BaseException:
+            stream.close()
+            raise
+        if getattr(image, "is_animated", False):
+            # Frames are decoded from the stream as they're asked for
+            stream.detach_buffer()
+        else:
+            # Still images are loaded by now
+            stream.close()
+        return image, exif
+
+    @staticmethod
+    def open_image(source, output_size=None):
+        """
+        Open an image and rotate it according to its EXIF orientation
+        :param source: path or file object of the image
+        :param output_size: max long edge or (width, height) box to shrink
+                            the image to while decoding it
+        :return: (PIL image object, raw EXIF data or None)
+        """
         # 打开图像并保留EXIF数据
-        image = Image.open(input_path)
+        image = Image.open(source)
+        image_format = image.format
+        if getattr(image, "is_animated", False):
+            # Rotating would only keep the first frame
+            return image, image.info.get("exif")
+        if output_size:
+            WaterMarker.shrink_image(image, output_size, rotated_after=True)
         # 根据EXIF方向信息自动旋转图像
         image = ImageOps.exif_transpose(image)
+        # The rotated copy forgets which format it came from
+        image.format = image_format
         # 检查图像是否有EXIF数据
         exif = None
         if hasattr(image, '_getexif') and image._getexif() is not None:
             exif = image.info.get('exif')
+        return image, exif
 
-        if (not self.previous_size or self.previous_size != image.size):
-            self.watermark_copy = self.scale_watermark(image, scale_x, scale_y)
-            if opacity < 1:
-                self.needs_opacity = True
-            else:
-                self.needs_opacity = False
+    @staticmethod
+    def get_output_box(output_size):
+        """
+        :param output_size: max long edge (int) or (width, height) box
+        :return: (width, height) box
+        """
+        if isinstance(output_size, int):
+            return output_size, output_size
+        return tuple(output_size)
 
-        self.previous_size = image.size
+    @staticmethod
+    def get_output_dimensions(size, output_size):
+        """
+        Get the size an image is shrunk to
+        :param size: (width, height) of the image
+        :param output_size: max long edge (int) or (width, height) box,
+                            None keeps the size
+        :return: (width, height), never bigger than size
+        """
+        if not output_size:
+            return size
+        box = WaterMarker.get_output_box(output_size)
+        scale = min(box[0] / size[0], box[1] / size[1], 1.0)
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
 
-        # Change free_mark opacity
-        if self.needs_opacity:
-            self.watermark_copy = self.change_opacity(self.watermark_copy,
-                                                      opacity)
-            self.needs_opacity = False
+    @staticmethod
+    def shrink_image(image, output_size, rotated_after=False):
+        """
+        Shrink an image in place to fit an output size, keeping its aspect
+        ratio. Before the image is loaded JPEGs are decoded straight at the
+        1/2, 1/4 or 1/8 scale just above the output size, other formats are
+        reduced by a whole factor before the final resize, so the cost drops
+        with the square of the scale.
+        :param image: PIL image object, preferably not loaded yet
+        :param output_size: max long edge (int) or (width, height) box
+        :param rotated_after: the image is rotated by its EXIF orientation
+                              afterwards, so the box is for the upright image
+        """
+        box = WaterMarker.get_output_box(output_size)
+        # The image isn't rotated yet, turn the box the same way instead
+        if rotated_after and "exif" in image.info \
+                and image.getexif().get(ORIENTATION, 1) in (5, 6, 7, 8):
+            box = box[::-1]
+        # Hamming is about as fast as bilinear, but nearly as sharp as
+        # Lanczos for the less than 2x left after draft and reduce
+        image.thumbnail(box, Image.HAMMING, reducing_gap=1.0)
+
+    @staticmethod
+    def save_image(image, destination, output_format=None, exif=None,
+                   **options):
+        """
+        Encode an image to a path or file object
+        :param image: PIL image object
+        :param destination: path or file object to save to
+        :param output_format: PIL format name, required for file objects
+                              if the format can't be guessed
+        :param exif: raw EXIF data to keep, or None
+        :param options: encoder options, e.g. quality for JPEG
+        """
+        output_format = output_format.upper() if output_format else None
+        if output_format is None and isinstance(destination, str):
+            output_format = get_format(destination)
+
+        # Formats without an alpha channel can't store RGBA or palette images
+        if output_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+
+        # 保存图像时保留EXIF数据
+        if exif:
+            image.save(destination, format=output_format, exif=exif, **options)
+        else:
+            image.save(destination, format=output_format, **options)
+
+    def mark_image(self, image, pos="SE", padding=((20, "px"), (5, "px")),
+                   opacity=0.5, scale_x=1.0, scale_y=1.0, layers=None,
+                   blend="normal"):
+        """
+        Apply the free_mark to an already opened image, the scaled free_mark
+        is cached so images of the same size reuse it
+        :param image: PIL image object, is modified in place
+        :param pos: Assumes first char is y (N/S) and second is x (E/W),
+                    or 'AUTO' to pick the corner with the least detail
+        :param padding: padding in format ((x_pad, unit), (y_pad, unit))
+        :param opacity: free_mark opacity (a value between 0 and 1), or
+                        'auto' or an AdaptiveOpacity object to pick it
+                        from the area the free_mark covers
+        :param scale_x: 横向缩放比例
+        :param scale_y: 纵向缩放比例
+        :param layers: optional list of layer dicts, see apply_watermark
+        :param blend: 'normal' pastes the free_mark over the image, multiply,
+                      screen, overlay and soft_light blend it with the image
+                      under it, see FreeMark.tools.blend
+        :return: the marked image, a converted copy for palette images
+        """
+        blend = check_blend(blend)
+        if image.mode in ("P", "1"):
+            # Pasting into a palette image would force the free_mark onto
+            # the image's palette
+            image = image.convert("RGBA" if "transparency" in image.info
+                                  else "RGB")
+
+        if layers:
+            if blend != "normal":
+                raise BadOptionError("Layers can't use blend modes.")
+            self.last_position = None
+            return self.get_layer_stack(layers).apply(image)
 
-        position = self.get_watermark_position(image, self.watermark_copy,
+        watermark, position = self.place_watermark(image, pos, padding,
+                                                   opacity, scale_x, scale_y)
+        return self.paste_watermark(image, watermark, position, blend)
+
+    def place_watermark(self, image, pos="SE", padding=((20, "px"), (5, "px")),
+                        opacity=0.5, scale_x=1.0, scale_y=1.0):
+        """
+        Get the free_mark to paste on an image, and where to paste it
+        :param image: PIL image object that free_mark will be applied to
+        :return: (PIL image object of the free_mark, (x, y))
+        """
+        watermark = self.get_scaled_watermark(image, opacity, scale_x, scale_y)
+
+        pos = self.resolve_position(image, watermark, pos, padding)
+        self.last_position = pos
+        position = self.get_watermark_position(image, watermark,
                                                pos=pos, padding=padding)
 
+        adaptive = get_adaptive(opacity)
+        if adaptive:
+            watermark = self.get_adaptive_watermark(
+                image, watermark, position, adaptive, scale_x, scale_y)
+        return watermark, position
+
+    @staticmethod
+    def paste_watermark(image, watermark, position, blend="normal"):
+        """
+        Paste a free_mark, only the area it covers is touched
+        :param image: PIL image object, is modified in place
+        :param watermark: PIL image object of the free_mark
+        :param position: (x, y) of the free_mark's top left corner
+        :param blend: blend mode, see mark_image
+        :return: the marked image
+        """
+        if blend != "normal":
+            from FreeMark.tools.blend import blend_watermark
+            return blend_watermark(image, watermark, position, blend)
         try:
-            image.paste(self.watermark_copy, box=position,
-                        mask=self.watermark_copy)
+            image.paste(watermark, box=position, mask=watermark)
         except ValueError:
-            image.paste(self.watermark_copy, box=position)
-        
-        # 保存图像时保留EXIF数据
+            image.paste(watermark, box=position)
+        return image
+
+    def mark_frames(self, image, pos="SE", padding=((20, "px"), (5, "px")),
+                    opacity=0.5, scale_x=1.0, scale_y=1.0, layers=None,
+                    output_size=None, blend="normal"):
+        """
+        Apply the free_mark to every frame of an animated image. Frames are
+        decoded and marked one at a time as they're asked for, and the
+        free_mark is scaled and placed once for the whole sequence so it
+        doesn't jump around. Adds to self.timings as it goes.
+        :param image: animated PIL image object
+        :param output_size: max long edge or (width, height) box to shrink
+                            every frame to
+        :param blend: blend mode, see mark_image
+        :return: generator of marked RGBA frames
+        """
+        blend = check_blend(blend)
+        if layers and blend != "normal":
+            raise BadOptionError("Layers can't use blend modes.")
+        placed = None
+        size = self.get_output_dimensions(image.size, output_size)
+        for index in range(image.n_frames):
+            start = time.perf_counter()
+            image.seek(index)
+            # Frames come out composited onto the ones before them
+            frame = image.convert("RGBA")
+            if frame.size != size:
+                frame = frame.resize(size, Image.HAMMING)
+            decoded = time.perf_counter()
+
+            if layers:
+                self.last_position = None
+                self.get_layer_stack(layers).apply(frame)
+            else:
+                if placed is None:
+                    placed = self.place_watermark(frame, pos, padding, opacity,
+                                                  scale_x, scale_y)
+                self.paste_watermark(frame, *placed, blend)
+
+            self.timings["decode"] = self.timings.get("decode", 0.0) \
+                + decoded - start
+            self.timings["mark"] = self.timings.get("mark", 0.0) \
+                + time.perf_counter() - decoded
+            yield frame
+
+    def save_animation(self, image, destination, output_format, exif=None,
+                       save_options=None, **kwargs):
+        """
+        Mark and encode every frame of an animated image, keeping frame
+        durations, disposal and loop count. Frames stream from the decoder
+        through mark_frames into the encoder.
+        :param image: animated PIL image object
+        :param destination: path or file object to save to
+        :param output_format: 'GIF', 'PNG' or 'WEBP'
+        :param exif: raw EXIF data to keep, or None
+        :param save_options: encoder options, e.g. quality for WebP
+        :param kwargs: options passed on to mark_frames
+        """
+        # Filled in as frames are read, the encoders only look up a frame's
+        # duration and disposal after getting the frame itself
+        durations = []
+        disposals = []
+
+        def frames():
+            for frame in self.mark_frames(image, **kwargs):
+                durations.append(image.info.get("duration", 0))
+                disposals.append(self.get_disposal(image, output_format))
+                yield frame
+
+        frames = frames()
+        first = next(frames)
+        if output_format == "PNG":
+            # The PNG encoder goes over the frames twice, and holds them
+            # all while encoding anyway
+            frames = list(frames)
+        params = {"save_all": True, "append_images": frames,
+                  "duration": durations}
+        if output_format in ("GIF", "PNG"):
+            params["disposal"] = disposals
+        if "loop" in image.info:
+            params["loop"] = image.info["loop"]
         if exif:
-            image.save(output_path, exif=exif)
+            params["exif"] = exif
+        params.update(save_options or {})
+        first.save(destination, format=output_format, **params)
+
+    @staticmethod
+    def get_disposal(image, output_format):
+        """
+        Get the disposal of the current frame in the output format's numbering.
+        Frames are written whole, so any disposal draws them correctly, but
+        keeping the original lets the encoder store the same small deltas.
+        :param image: animated PIL image object, at the frame to look at
+        :param output_format: 'GIF' or 'PNG'
+        :return: disposal number
+        """
+        if image.format == "GIF":
+            disposal = {2: "background", 3: "previous"}.get(
+                image.disposal_method, "keep")
+        elif image.format == "PNG":
+            disposal = {1: "background", 2: "previous"}.get(
+                image.info.get("disposal"), "keep")
         else:
-            image.save(output_path)
+            # Clearing is always right for whole frames
+            disposal = "background"
+
+        if output_format == "GIF":
+            return {"keep": 1, "background": 2, "previous": 3}[disposal]
+        return {"keep": 0, "background": 1, "previous": 2}[disposal]
 
-    def apply_watermark_preview(self, input_path, pos="SE", padding=((20, "px"), (5, "px")),
-                               opacity=0.5, scale_x=1.0, scale_y=1.0):
+    @staticmethod
+    def is_animated(image, output_format):
+        """
+        Check if an image has several frames which can all be saved
+        :param image: PIL image object
+        :param output_format: PIL format name of the output
         """
-        应用水印到图像并返回预览图像，但不保存
-        :param input_path: 输入图像路径
-        :param pos: 水印位置，第一个字符是y轴(N/S)，第二个是x轴(E/W)
-        :param padding: 填充格式 ((x_pad, unit), (y_pad, unit))
-        :param scale: 是否缩放水印
-        :param opacity: 水印不透明度(0到1之间的值)
+        return (getattr(image, "is_animated", False)
+                and output_format in ANIMATED_FORMATS)
+
+    def resolve_position(self, image, watermark, pos, padding):
+        """
+        Turn 'AUTO' into the corner covering the least detail
+        :param image: PIL image object
+        :param watermark: scaled free_mark as a PIL image object
+        :param pos: pos string, returned as is unless it's 'AUTO'
+        :param padding: padding in format ((x_pad, unit), (y_pad, unit))
+        :return: pos string
+        """
+        from FreeMark.tools.placement import AUTO, choose_position
+
+        if pos.upper().strip() != AUTO:
+            return pos
+        return choose_position(image, watermark, padding,
+                               self.get_watermark_position)
+
+    def get_adaptive_watermark(self, image, watermark, position, adaptive,
+                               scale_x=1.0, scale_y=1.0):
+        """
+        Get the free_mark with its opacity picked from what it will cover,
+        the opacity levels are only made once pr. image size
+        :param image: PIL image object that free_mark will be applied to
+        :param watermark: scaled free_mark at full opacity
+        :param position: (x, y) the free_mark will be pasted at
+        :param adaptive: AdaptiveOpacity settings
         :param scale_x: 横向缩放比例
         :param scale_y: 纵向缩放比例
-        :return: 带有水印的PIL图像对象
+        :return: PIL image object of the free_mark
         """
+        key = (image.size, scale_x, scale_y, adaptive.key)
         try:
-            # 打开图像并保留EXIF数据
-            image = Image.open(input_path)
-            # 根据EXIF方向信息自动旋转图像
-            image = ImageOps.exif_transpose(image)
-            # 检查图像是否有EXIF数据
-            exif = None
-            if hasattr(image, '_getexif') and image._getexif() is not None:
-                exif = image.info.get('exif')
-        except FileNotFoundError:
-            raise BadOptionError("找不到输入图像文件")
-        except OSError:
-            raise BadOptionError("输入图像格式不兼容")
+            self.opacity_levels.move_to_end(key)
+            levels = self.opacity_levels[key]
+        except KeyError:
+            levels = adaptive.make_levels(watermark)
+            self.opacity_levels[key] = levels
+            if len(self.opacity_levels) > self.cache_size:
+                self.opacity_levels.popitem(last=False)
 
-        watermark_copy = None
-        watermark_copy = self.scale_watermark(image, scale_x, scale_y)
+        box = (position[0], position[1],
+               position[0] + watermark.size[0], position[1] + watermark.size[1])
+        return adaptive.choose(levels, image.crop(box))
+
+    def get_layer_stack(self, layers):
+        """
+        Get the (cached) LayerStack for a list of layers
+        :param layers: list of layer dicts, layers without a watermark
+                       use this WaterMarker's free_mark
+        :return: LayerStack object
+        """
+        from FreeMark.tools.layers import LayerStack
 
+        key = repr(layers)
+        try:
+            self.layer_stacks.move_to_end(key)
+            return self.layer_stacks[key]
+        except KeyError:
+            pass
 
-        # 改变水印不透明度
-        if opacity < 1:
-            watermark_copy = self.change_opacity(watermark_copy, opacity)
+        stack = LayerStack(layers, self.get_layer_watermarker,
+                           cache_size=self.cache_size)
+        self.layer_stacks[key] = stack
+        if len(self.layer_stacks) > self.cache_size:
+            self.layer_stacks.popitem(last=False)
+        return stack
 
-        position = self.get_watermark_position(image, watermark_copy,
-                                              pos=pos, padding=padding)
+    def get_layer_watermarker(self, watermark_path):
+        """
+        Get the WaterMarker scaling a layer's free_mark
+        :param watermark_path: path to the layer's free_mark, or None
+        :return: WaterMarker object
+        """
+        if watermark_path is None or watermark_path == self.watermark_path:
+            return self
+        if watermark_path not in self.layer_watermarkers:
+            self.layer_watermarkers[watermark_path] = WaterMarker(watermark_path)
+        return self.layer_watermarkers[watermark_path]
 
+    def get_scaled_watermark(self, image, opacity=1.0, scale_x=1.0, scale_y=1.0):
+        """
+        Get the free_mark scaled for an image with opacity applied,
+        recently used free_marks are kept so they only get created once
+        :param image: PIL image object that free_mark will be applied to
+        :param opacity: free_mark opacity (a value between 0 and 1)
+        :param scale_x: 横向缩放比例
+        :param scale_y: 纵向缩放比例
+        :return: PIL image object of the free_mark
+        """
+        if get_adaptive(opacity):
+            # Adaptive levels are made from the full opacity free_mark
+            opacity = 1.0
+        key = (image.size, opacity, scale_x, scale_y)
         try:
-            # 创建一个新的图像副本，以免修改原始图像
-            preview_image = image.copy()
-            preview_image.paste(watermark_copy, box=position,
-                              mask=watermark_copy)
-        except ValueError:
-            preview_image = image.copy()
-            preview_image.paste(watermark_copy, box=position)
-        
-        # 确保预览图像保留EXIF数据
-        if exif:
-            preview_image.info['exif'] = exif
-        
-        return preview_image
+            self.watermark_cache.move_to_end(key)
+            watermark = self.watermark_cache[key]
+            self.cache_hits += 1
+            return watermark
+        except KeyError:
+            self.cache_misses += 1
+
+        watermark = self.scale_watermark(image, scale_x, scale_y)
+        # Change free_mark opacity
+        if opacity < 1:
+            watermark = self.change_opacity(watermark, opacity)
+
+        self.watermark_cache[key] = watermark
+        if len(self.watermark_cache) > self.cache_size:
+            self.watermark_cache.popitem(last=False)
+        return watermark
 
     @staticmethod
     def change_opacity(image, opacity):
@@ -158,21 +850,10 @@ class WaterMarker:
         """
         assert 0.0 <= opacity <= 1.0, "opacity must be between 0 and 1"
         image = image.convert("RGBA")
-        img_data = image.load()
-        new_data = []
-
-        width, height = image.size
-        for y in range(height):
-            for x in range(width):
-                if img_data[x, y][3] > 5:
-                    new_data.append((img_data[x, y][0],
-                                     img_data[x, y][1],
-                                     img_data[x, y][2],
-                                     int(img_data[x, y][3]*opacity)))
-                else:
-                    new_data.append(img_data[x, y])
-
-        image.putdata(new_data)
+        # Nearly transparent pixels are left alone
+        alpha = image.getchannel("A").point(
+            lambda value: int(value * opacity) if value > 5 else value)
+        image.putalpha(alpha)
         return image
 
     def scale_watermark(self, image, scale_x=1.0, scale_y=1.0):
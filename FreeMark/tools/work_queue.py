@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+URGENT = 0
+NORMAL = 1
+
+# Marks heap entries that were taken out or moved
+_REMOVED = object()
+
+
+class PriorityWorkQueue:
+    """
+    Thread safe work queue where queued items can be moved ahead of the
+    rest while it's being worked through. Lower priorities come first,
+    items of the same priority in the order they were put or bumped.
+    Has the put/get/qsize/empty of queue.Queue so it can stand in for one,
+    and consume() turns it into a job iterable for apply_many.
+    """
+    def __init__(self, key=None):
+        """
+        :param key: function giving the key bump() finds an item by,
+                    defaults to the item itself
+        """
+        self.key = key or (lambda item: item)
+        self.heap = []      # [priority, order, item] entries
+        self.entries = {}   # key -> the entry of a queued item
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+    def put(self, item, priority=NORMAL):
+        """
+        Queue an item, an item already queued under the same key is replaced
+        :param item: the work item
+        :param priority: URGENT, NORMAL or any other number, lower is sooner
+        """
+        with self.lock:
+            self.push(item, priority)
+            self.not_empty.notify()
+
+    def push(self, item, priority):
+        key = self.key(item)
+        if key in self.entries:
+            self.entries[key][2] = _REMOVED
+        entry = [priority, next(self.order), item]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def get(self, block=True, timeout=None):
+        """
+        Take the most urgent item
+        :param block: wait for an item if the queue is empty
+        :param timeout: max seconds to wait
+        :return: the item
+        :raises queue.Empty: if there's no item
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.not_empty:
+            while not self.entries:
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.not_empty.wait(remaining)
+            while True:
+                _, _, item = heapq.heappop(self.heap)
+                if item is not _REMOVED:
+                    del self.entries[self.key(item)]
+                    if not self.entries:
+                        # Only removed entries can be left, drop them
+                        self.heap.clear()
+                    return item
+
+    def bump(self, keys, priority=URGENT):
+        """
+        Move queued items ahead of everything with a lower priority, in the
+        order given. Items that aren't queued (anymore) are ignored.
+        :param keys: keys of the items to move
+        :param priority: the items' new priority
+        :return: amount of items moved
+        """
+        moved = 0
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None or entry[0] <= priority:
+                    continue
+                item = entry[2]
+                entry[2] = _REMOVED
+                self.push(item, priority)
+                moved += 1
+        return moved
+
+    def qsize(self):
+        with self.lock:
+            return len(self.entries)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def consume(self):
+        """
+        Take items until the queue is empty, bumps made while it's being
+        consumed still apply to the items not taken yet
+        :return: generator of items
+        """
+        while True:
+            try:
+                yield self.get(block=False)
+            except queue.Empty:
+                return
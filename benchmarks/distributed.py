@@ -0,0 +1,104 @@
+"""
+Benchmark and smoke test of the distributed mode (python -m FreeMark
+distribute), runs a batch through a queue in a temp folder with 1 up to
+--nodes local worker processes standing in for machines, and reports
+images pr. second for each. With --kill one worker is killed halfway
+through to check its shard is taken back and every image still gets marked.
+
+usage: python benchmarks/distributed.py images/ logo.png --nodes 4 --kill
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from FreeMark.tools.distributed import get_status, submit_batch
+from FreeMark.tools.help import is_image_file
+
+
+def start_worker(queue_dir, worker_id, lease_timeout):
+    """
+    Start a worker in its own interpreter, like one on another machine.
+    It marks in its own process, a pool's children would outlive a kill.
+    :return: Popen object
+    """
+    return subprocess.Popen([sys.executable, "-m", "FreeMark", "distribute",
+                             "work", queue_dir, "--executor", "serial",
+                             "--worker-id", worker_id,
+                             "--lease-timeout", str(lease_timeout)],
+                            stdout=subprocess.DEVNULL)
+
+
+def run(input_dir, watermark, nodes, shard_size, kill, lease_timeout):
+    """
+    Mark a folder through a fresh queue
+    :param input_dir: folder of images
+    :param watermark: path to the watermark image
+    :param nodes: amount of worker processes
+    :param shard_size: images pr. shard
+    :param kill: kill the first worker halfway through
+    :param lease_timeout: seconds before a dead worker's shard is taken back
+    :return: (amount of images written, amount of images, elapsed seconds)
+    """
+    temp_dir = tempfile.mkdtemp(prefix="FreeMark-distributed-")
+    try:
+        queue_dir = os.path.join(temp_dir, "queue")
+        output_dir = os.path.join(temp_dir, "out")
+        os.makedirs(output_dir)
+        names = sorted(name for name in os.listdir(input_dir)
+                       if is_image_file(name))
+        submit_batch(queue_dir, watermark,
+                     [(os.path.join(input_dir, name),
+                       os.path.join(output_dir, name)) for name in names],
+                     shard_size=shard_size)
+
+        start = time.perf_counter()
+        workers = [start_worker(queue_dir, "node{}".format(i), lease_timeout)
+                   for i in range(nodes)]
+        if kill:
+            while True:
+                status = get_status(queue_dir)
+                if status["done"] >= status["shards"] // 2:
+                    break
+                time.sleep(0.1)
+            workers[0].kill()
+        for worker in workers:
+            worker.wait()
+        elapsed = time.perf_counter() - start
+        written = len([name for name in os.listdir(output_dir)
+                       if not name.endswith(".part")])
+        return written, len(names), elapsed
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreeMark distributed "
+                                                 "mode benchmark")
+    parser.add_argument("input_dir", help="folder of images to mark")
+    parser.add_argument("watermark", help="watermark image")
+    parser.add_argument("--nodes", type=int, default=4,
+                        help="max amount of worker processes")
+    parser.add_argument("--shard-size", type=int, default=4)
+    parser.add_argument("--kill", action="store_true",
+                        help="kill a worker halfway through every run")
+    parser.add_argument("--lease-timeout", type=float, default=3)
+    args = parser.parse_args()
+
+    base = None
+    for nodes in range(1, args.nodes + 1):
+        written, total, elapsed = run(args.input_dir, args.watermark, nodes,
+                                      args.shard_size,
+                                      args.kill and nodes > 1,
+                                      args.lease_timeout)
+        rate = written / elapsed
+        base = base or rate
+        print("nodes: {} images: {}/{} images/s: {:.2f} speedup: {:.2f}"
+              .format(nodes, written, total, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Load generator for the FreeMark HTTP service (python -m FreeMark serve),
+posts the same image over and over from several threads and reports
+latency percentiles and requests pr. second.
+
+usage: python benchmarks/loadgen.py image.jpg --concurrency 8 --requests 200
+"""
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+
+def percentile(values, percent):
+    """
+    Get a percentile from a list of values (nearest rank)
+    :param values: sorted list of numbers
+    :param percent: percentile to get, between 0 and 100
+    :return: the percentile value
+    """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def run(url, data, concurrency, requests):
+    """
+    Fire requests at the service
+    :param url: full url of the watermark endpoint, including options
+    :param data: image to upload as bytes
+    :param concurrency: amount of threads sending requests
+    :param requests: total amount of requests to send
+    :return: (list of latencies of successful requests, Counter of statuses,
+              elapsed seconds)
+    """
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] < 1:
+                    return
+                remaining[0] -= 1
+            request = urllib.request.Request(url, data=data, method="POST")
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except OSError:
+                status = "error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), statuses, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreeMark service load test")
+    parser.add_argument("image", help="image to upload")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/watermark")
+    parser.add_argument("--options", default="",
+                        help="query string, e.g. 'pos=NW&opacity=0.5'")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as image_file:
+        data = image_file.read()
+    url = args.url + ("?" + args.options if args.options else "")
+
+    latencies, statuses, elapsed = run(url, data, args.concurrency,
+                                       args.requests)
+    print("requests:", sum(statuses.values()), dict(statuses))
+    print("requests/s: {:.1f}".format(sum(statuses.values()) / elapsed))
+    print("p50: {:.1f} ms".format(percentile(latencies, 50) * 1000))
+    print("p99: {:.1f} ms".format(percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Startup benchmark for the FreeMark GUI, starts the app in a fresh
+interpreter a number of times and reports time to first window and RSS.
+Needs a display.
+
+usage: python benchmarks/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Run in a child interpreter so every run pays the full import cost
+CHILD = r"""
+import json, resource, sys, time
+start = time.perf_counter()
+from tkinter import Tk
+from FreeMark.FreeMark_app import FreeMarkApp
+
+root = Tk()
+app = FreeMarkApp(master=root)
+# The window is on screen once it's been mapped and drawn
+root.update()
+root.wait_visibility(root)
+first_window = time.perf_counter() - start
+
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform != "darwin":
+    rss *= 1024  # Linux reports kilobytes, mac reports bytes
+print(json.dumps({"first_window": first_window, "rss": rss,
+                  "pil_loaded": "PIL" in sys.modules,
+                  "toplevels": sum(1 for widget in root.winfo_children()
+                                   if widget.winfo_class() == "Toplevel")}))
+root.destroy()
+"""
+
+
+def run_once(repo_dir):
+    """
+    Start the app once in a child interpreter
+    :param repo_dir: folder containing the FreeMark package
+    :return: dict of measurements
+    """
+    output = subprocess.run([sys.executable, "-c", CHILD], cwd=repo_dir,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreeMark startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [run_once(repo_dir) for _ in range(args.runs)]
+
+    times = [result["first_window"] for result in results]
+    rss = [result["rss"] for result in results]
+    print("time to first window: median {:.0f} ms, min {:.0f} ms".format(
+        statistics.median(times) * 1000, min(times) * 1000))
+    print("max RSS: median {:.1f} MB".format(statistics.median(rss) / 2**20))
+    print("PIL loaded at startup:", results[0]["pil_loaded"])
+    print("preview windows at startup:", results[0]["toplevels"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+from PIL import Image
+
+
+def make_image(path, size=(64, 48), color=(200, 120, 40), mode="RGB"):
+    """
+    Write a plain image to disk
+    :param path: where to save it, the extension picks the format
+    :return: the path
+    """
+    Image.new(mode, size, color).save(path)
+    return path
+
+
+@pytest.fixture
+def watermark(tmp_path):
+    """Path to a small half transparent watermark"""
+    return make_image(str(tmp_path / "watermark.png"), (16, 8),
+                      (255, 255, 255, 128), "RGBA")
+
+
+@pytest.fixture
+def images(tmp_path):
+    """Folder holding a handful of small jpgs"""
+    folder = tmp_path / "in"
+    folder.mkdir()
+    for i in range(6):
+        make_image(str(folder / "img{}.jpg".format(i)), (40 + 8 * i, 30))
+    return str(folder)
+
+
+@pytest.fixture
+def out_dir(tmp_path):
+    folder = tmp_path / "out"
+    folder.mkdir()
+    return str(folder)
+
+
+def list_outputs(folder):
+    return sorted(os.listdir(folder))
@@ -0,0 +1,70 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+from PIL import Image
+
+from FreeMark.tools.archive import mark_archive
+
+BROKEN = b"not really a jpeg"
+NOTES = b"shot on a rainy day"
+
+
+def image_bytes(size=(64, 48)):
+    output = io.BytesIO()
+    Image.new("RGB", size, (30, 90, 160)).save(output, "JPEG")
+    return output.getvalue()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "photos.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("a.jpg", image_bytes())
+        archive.writestr("sub/bad.jpg", BROKEN)
+        archive.writestr("notes.txt", NOTES)
+        archive.writestr("sub/b.jpg", image_bytes((48, 64)))
+    return path
+
+
+def read_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_every_member_is_kept(source, tmp_path, watermark):
+    destination = str(tmp_path / "marked.zip")
+    marked, failed = mark_archive(watermark, source, destination)
+    assert marked == 2
+    assert [name for name, _ in failed] == ["sub/bad.jpg"]
+
+    members = read_zip(destination)
+    # Same members in the same order
+    assert list(members) == ["a.jpg", "sub/bad.jpg", "notes.txt", "sub/b.jpg"]
+    assert members["sub/bad.jpg"] == BROKEN
+    assert members["notes.txt"] == NOTES
+    assert Image.open(io.BytesIO(members["sub/b.jpg"])).size == (48, 64)
+
+
+def test_tar_output(source, tmp_path, watermark):
+    destination = str(tmp_path / "marked.tar")
+    mark_archive(watermark, source, destination)
+    with tarfile.open(destination) as archive:
+        assert archive.getnames() == ["a.jpg", "sub/bad.jpg", "notes.txt",
+                                      "sub/b.jpg"]
+        assert archive.extractfile("sub/bad.jpg").read() == BROKEN
+
+
+def test_command_fails_when_a_member_fails(source, tmp_path, watermark):
+    destination = str(tmp_path / "marked.zip")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    finished = subprocess.run([sys.executable, "-m", "FreeMark", "archive",
+                               source, destination, "--watermark", watermark],
+                              cwd=root, capture_output=True, text=True)
+    assert finished.returncode == 1
+    assert "sub/bad.jpg" in finished.stderr
+    assert "sub/bad.jpg" in read_zip(destination)
@@ -0,0 +1,33 @@
+import pytest
+
+from FreeMark.tools.autotune import (ConcurrencyTuner, get_section,
+                                     load_tuning, save_tuning)
+from FreeMark.tools.config import Config
+
+
+@pytest.fixture
+def config(tmp_path):
+    return Config(str(tmp_path / "options.ini"))
+
+
+def test_saved_setting_is_remembered(config, tmp_path):
+    save_tuning(config, str(tmp_path / "out"), "threads", 3)
+    assert load_tuning(Config(config.config_location),
+                       str(tmp_path / "out")) == ("threads", 3)
+
+
+@pytest.mark.parametrize("options", [{"workers": "3"},
+                                     {"workers_kind": "threads"},
+                                     {"workers_kind": "threads",
+                                      "workers": "many"},
+                                     {"workers_kind": "fibers",
+                                      "workers": "3"}])
+def test_broken_section_starts_from_scratch(config, tmp_path, options):
+    section = get_section(str(tmp_path / "out"))
+    config.config.add_section(section)
+    for key, value in options.items():
+        config.config.set(section, key, value)
+    assert load_tuning(config, str(tmp_path / "out")) is None
+    tuner = ConcurrencyTuner.remembered(config, str(tmp_path / "out"),
+                                        max_workers=4)
+    assert tuner.get_config() == ("processes", 2)
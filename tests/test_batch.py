@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from FreeMark.tools.batch import DONE, FAILED, SKIPPED, apply_many
+from conftest import list_outputs
+
+
+def make_jobs(images, out_dir, pulled=None):
+    """
+    Jobs for every image in a folder, counting how many were pulled
+    :param pulled: list every job is appended to as it's taken
+    """
+    for name in sorted(os.listdir(images)):
+        job = (os.path.join(images, name), os.path.join(out_dir, name))
+        if pulled is not None:
+            pulled.append(job)
+        yield job
+
+
+@pytest.mark.parametrize("executor", ["serial", "threads"])
+def test_ordered_results_follow_the_jobs(images, out_dir, watermark, executor):
+    jobs = list(make_jobs(images, out_dir))
+    results = list(apply_many(watermark, jobs, executor=executor, workers=3))
+    assert [result.index for result in results] == list(range(len(jobs)))
+    assert [result.input_path for result in results] == [j[0] for j in jobs]
+    assert all(result.status == DONE for result in results)
+    assert list_outputs(out_dir) == sorted(os.listdir(images))
+
+
+def test_unordered_results_cover_every_job(images, out_dir, watermark):
+    results = list(apply_many(watermark, make_jobs(images, out_dir),
+                              ordered=False, executor="threads", workers=3))
+    assert sorted(result.index for result in results) == list(range(6))
+    assert list_outputs(out_dir) == sorted(os.listdir(images))
+
+
+def test_serial_pulls_one_job_pr_result(images, out_dir, watermark):
+    pulled = []
+    results = apply_many(watermark, make_jobs(images, out_dir, pulled))
+    assert pulled == []
+    next(results)
+    assert len(pulled) == 1
+    next(results)
+    assert len(pulled) == 2
+    results.close()
+    assert len(list_outputs(out_dir)) == 2
+
+
+def test_jobs_are_pulled_up_to_max_in_flight(images, out_dir, watermark):
+    pulled = []
+    results = apply_many(watermark, make_jobs(images, out_dir, pulled),
+                         executor="threads", workers=2, max_in_flight=2)
+    next(results)
+    # The first result is yielded once two jobs are in flight
+    assert len(pulled) == 2
+    results.close()
+    # Jobs never pulled are never run
+    assert len(list_outputs(out_dir)) <= 2
+
+
+def test_existing_outputs_are_skipped(images, out_dir, watermark):
+    list(apply_many(watermark, make_jobs(images, out_dir)))
+    results = list(apply_many(watermark, make_jobs(images, out_dir)))
+    assert all(result.status == SKIPPED for result in results)
+
+
+def test_bad_image_fails_without_stopping_the_batch(images, out_dir, watermark):
+    with open(os.path.join(images, "broken.jpg"), "wb") as broken:
+        broken.write(b"not an image")
+    results = list(apply_many(watermark, make_jobs(images, out_dir),
+                              executor="threads", workers=2))
+    failed = [result for result in results if result.status == FAILED]
+    assert [result.input_path for result in failed] == \
+        [os.path.join(images, "broken.jpg")]
+    assert "broken.jpg" in str(failed[0].error)
+    assert len(list_outputs(out_dir)) == 6
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import time
+
+from PIL import Image
+
+from FreeMark.tools.distributed import (DONE, LEASED, LEASE_SEPARATOR,
+                                        ShardWorker, get_status, read_json,
+                                        submit_batch)
+
+SHARDS = 4
+SHARD_SIZE = 4
+
+
+def run_worker(queue_dir, worker_id):
+    """Stands in for a worker on another machine"""
+    worker = ShardWorker(queue_dir, worker_id=worker_id, executor="serial",
+                         lease_timeout=1.0, heartbeat_interval=0.2,
+                         poll_interval=0.05)
+    worker.run()
+
+
+def holds_lease(queue_dir, worker_id):
+    return any(name.endswith(LEASE_SEPARATOR + worker_id)
+               for name in os.listdir(os.path.join(queue_dir, LEASED)))
+
+
+def test_killed_worker_shard_is_taken_over(tmp_path, watermark):
+    input_dir = tmp_path / "in"
+    output_dir = tmp_path / "out"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    jobs = []
+    for i in range(SHARDS * SHARD_SIZE):
+        # Big enough that a shard takes a while to mark
+        name = "img{:02d}.jpg".format(i)
+        Image.effect_noise((1600, 1200), 50).convert("RGB").save(
+            str(input_dir / name))
+        jobs.append((str(input_dir / name), str(output_dir / name)))
+    queue_dir = str(tmp_path / "queue")
+    assert submit_batch(queue_dir, watermark, jobs,
+                        shard_size=SHARD_SIZE) == SHARDS
+
+    context = multiprocessing.get_context()
+    doomed = context.Process(target=run_worker, args=(queue_dir, "doomed"))
+    survivor = context.Process(target=run_worker,
+                               args=(queue_dir, "survivor"))
+    doomed.start()
+    try:
+        # Killed in the middle of a shard, with its lease still held
+        deadline = time.monotonic() + 30
+        while not holds_lease(queue_dir, "doomed"):
+            assert time.monotonic() < deadline, "worker never took a shard"
+            time.sleep(0.01)
+        survivor.start()
+        time.sleep(0.1)
+        doomed.kill()
+        doomed.join()
+        # Its lease stays behind until the survivor takes it back
+        orphaned = [name.split(LEASE_SEPARATOR)[0] for name
+                    in os.listdir(os.path.join(queue_dir, LEASED))
+                    if name.endswith(LEASE_SEPARATOR + "doomed")]
+        assert len(orphaned) == 1
+
+        survivor.join(120)
+        assert survivor.exitcode == 0
+    finally:
+        for process in (doomed, survivor):
+            if process.is_alive():
+                process.kill()
+
+    status = get_status(queue_dir)
+    assert (status["done"], status["pending"], status["leased"],
+            status["failed"]) == (SHARDS, 0, 0, 0)
+    assert sorted(os.listdir(str(output_dir))) == \
+        sorted(os.path.basename(output) for _, output in jobs)
+
+    # Every shard was recorded once, and every image in exactly one of them
+    done = {name: read_json(os.path.join(queue_dir, DONE, name))
+            for name in os.listdir(os.path.join(queue_dir, DONE))}
+    assert len(done) == SHARDS
+    recorded = sorted(result[0] for shard in done.values()
+                      for result in shard["results"])
+    assert recorded == sorted(input_path for input_path, _ in jobs)
+    assert done[orphaned[0]]["worker"] == "survivor"
+    assert status["workers"] == {}
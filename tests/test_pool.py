@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from FreeMark.tools.batch import FAILED, apply_many
+from FreeMark.tools.errors import ImageTimeoutError
+from FreeMark.tools.pool import RecyclingPool
+from FreeMark.tools.watermarker import WaterMarker
+
+# The hanging save below is patched in before the workers are forked
+needs_fork = pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                                reason="workers must inherit the patch")
+
+
+def double(value):
+    return 2 * value
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+@pytest.fixture
+def pool():
+    pool = RecyclingPool(2, timeout=0.5, poll_interval=0.05)
+    yield pool
+    pool.shutdown(wait=True, cancel_futures=True)
+
+
+def test_runs_tasks(pool):
+    assert [pool.submit(double, i).result(5) for i in range(4)] == [0, 2, 4, 6]
+
+
+def test_overdue_task_is_killed_and_pool_keeps_working(pool):
+    start = time.monotonic()
+    hung = pool.submit(sleep, 30)
+    with pytest.raises(ImageTimeoutError):
+        hung.result(10)
+    assert time.monotonic() - start < 5
+    # Its worker was replaced
+    assert pool.submit(double, 21).result(5) == 42
+
+
+def test_cancel_kills_running_tasks(pool):
+    running = [pool.submit(sleep, 30) for _ in range(3)]
+    time.sleep(0.2)
+    start = time.monotonic()
+    pool.cancel()
+    for future in running:
+        with pytest.raises(CancelledError):
+            future.result(5)
+    assert time.monotonic() - start < 5
+    assert pool.submit(double, 1).result(5) == 2
+
+
+def hanging_save(image, destination, output_format=None, exif=None,
+                 **options):
+    # Leaves a half written file behind, like a slow encoder
+    with open(destination, "wb") as output:
+        output.write(b"half an image")
+    time.sleep(30)
+
+
+@needs_fork
+def test_timed_out_job_leaves_no_part_file(images, out_dir, watermark,
+                                           monkeypatch):
+    monkeypatch.setattr(WaterMarker, "save_image", staticmethod(hanging_save))
+    jobs = [(os.path.join(images, name), os.path.join(out_dir, name))
+            for name in sorted(os.listdir(images))[:2]]
+    results = list(apply_many(watermark, jobs, executor="processes",
+                              workers=2, timeout=0.5))
+    assert [result.status for result in results] == [FAILED, FAILED]
+    assert all(isinstance(result.error, ImageTimeoutError)
+               for result in results)
+    assert os.listdir(out_dir) == []
+
+
+@needs_fork
+def test_cancelled_batch_leaves_no_part_file(images, out_dir, watermark,
+                                             monkeypatch):
+    monkeypatch.setattr(WaterMarker, "save_image", staticmethod(hanging_save))
+    pool = RecyclingPool(2, poll_interval=0.05)
+    try:
+        jobs = [(os.path.join(images, name), os.path.join(out_dir, name))
+                for name in sorted(os.listdir(images))]
+        results = []
+        # Like the GUI, the batch is taken in a thread and stopped from outside
+        batch = threading.Thread(target=lambda: results.extend(apply_many(
+            watermark, jobs, ordered=False, executor=pool)), daemon=True)
+        batch.start()
+        # Wait until both workers are stuck writing
+        deadline = time.monotonic() + 10
+        while len(os.listdir(out_dir)) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert all(name.endswith(".part") for name in os.listdir(out_dir))
+        assert os.listdir(out_dir)
+        pool.cancel()
+        batch.join(10)
+        assert not batch.is_alive()
+        assert [result.status for result in results] == [FAILED] * len(jobs)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    assert os.listdir(out_dir) == []
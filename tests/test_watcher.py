@@ -0,0 +1,74 @@
+import os
+import queue
+
+from FreeMark.tools.watcher import FolderWatcher
+from conftest import make_image
+
+
+def queued_names(watcher):
+    names = [name for name, _ in watcher.ready]
+    while True:
+        try:
+            names.append(watcher.ready_que.get_nowait()[0])
+        except queue.Empty:
+            return names
+
+
+def test_full_queue_hands_every_file_on_once(tmp_path, watermark, out_dir):
+    watch_dir = tmp_path / "watch"
+    watch_dir.mkdir()
+    # No workers are started, so the queue fills up and stays full
+    watcher = FolderWatcher(str(watch_dir), out_dir, watermark, queue_size=1,
+                            settle_time=0)
+    for i in range(6):
+        make_image(str(watch_dir / "a{}.jpg".format(i)))
+
+    for _ in range(10):
+        watcher.poll()
+    assert watcher.get_backlog() == 6
+
+    # A file arriving while the queue is full isn't lost either
+    make_image(str(watch_dir / "late.jpg"))
+    for _ in range(10):
+        watcher.poll()
+    assert watcher.get_backlog() == 7
+
+    names = queued_names(watcher)
+    assert sorted(names) == sorted(os.listdir(str(watch_dir)))
+
+
+def test_queue_drains_without_duplicates(tmp_path, watermark, out_dir):
+    watch_dir = tmp_path / "watch"
+    watch_dir.mkdir()
+    watcher = FolderWatcher(str(watch_dir), out_dir, watermark, queue_size=2,
+                            settle_time=0)
+    for i in range(5):
+        make_image(str(watch_dir / "a{}.jpg".format(i)))
+
+    handed_on = []
+    for _ in range(20):
+        watcher.poll()
+        # Take one at a time, like a slow worker
+        try:
+            handed_on.append(watcher.ready_que.get_nowait()[0])
+        except queue.Empty:
+            pass
+    assert sorted(handed_on) == ["a{}.jpg".format(i) for i in range(5)]
+    assert not watcher.pending and not watcher.ready
+
+
+def test_removed_file_can_be_dropped_in_again(tmp_path, watermark, out_dir):
+    watch_dir = tmp_path / "watch"
+    watch_dir.mkdir()
+    watcher = FolderWatcher(str(watch_dir), out_dir, watermark, settle_time=0)
+    path = make_image(str(watch_dir / "a.jpg"))
+    for _ in range(3):
+        watcher.poll()
+    assert queued_names(watcher) == ["a.jpg"]
+
+    os.remove(path)
+    watcher.poll()
+    make_image(path)
+    for _ in range(3):
+        watcher.poll()
+    assert queued_names(watcher) == ["a.jpg"]
@@ -0,0 +1,100 @@
+import os
+import queue
+import threading
+
+import pytest
+
+from FreeMark.tools.batch import Job, apply_many
+from FreeMark.tools.work_queue import URGENT, PriorityWorkQueue
+
+
+def filled(items):
+    work_queue = PriorityWorkQueue()
+    for item in items:
+        work_queue.put(item)
+    return work_queue
+
+
+def test_items_come_out_in_the_order_they_were_put():
+    assert list(filled("abcde").consume()) == list("abcde")
+
+
+def test_bump_moves_items_ahead_in_the_order_given():
+    work_queue = filled("abcde")
+    assert work_queue.bump(["d", "b"]) == 2
+    assert list(work_queue.consume()) == list("dbace")
+
+
+def test_bumped_items_are_only_taken_once():
+    work_queue = filled("abcde")
+    work_queue.bump(["c"])
+    work_queue.bump(["e", "c"])
+    # The moved entries are left in the heap, marked as removed
+    assert len(work_queue.heap) > work_queue.qsize() == 5
+    assert list(work_queue.consume()) == list("ceabd")
+    assert work_queue.empty()
+    assert work_queue.heap == []
+
+
+def test_bumping_taken_or_unknown_items_does_nothing():
+    work_queue = filled("abc")
+    assert work_queue.get() == "a"
+    assert work_queue.bump(["a", "x"]) == 0
+    assert "a" not in work_queue
+    assert list(work_queue.consume()) == list("bc")
+
+
+def test_bumping_an_urgent_item_again_keeps_its_place():
+    work_queue = filled("abcd")
+    work_queue.bump(["c", "d"])
+    assert work_queue.bump(["d"]) == 0
+    assert list(work_queue.consume()) == list("cdab")
+
+
+def test_bump_while_consuming_applies_to_the_rest():
+    work_queue = filled("abcdef")
+    taken = []
+    for item in work_queue.consume():
+        taken.append(item)
+        if item == "b":
+            work_queue.bump(["f", "a"])
+    assert taken == list("abfcde")
+
+
+def test_put_replaces_a_queued_item_with_the_same_key():
+    work_queue = PriorityWorkQueue(key=lambda job: job[0])
+    work_queue.put(("a", 1))
+    work_queue.put(("b", 1))
+    work_queue.put(("a", 2))
+    assert work_queue.qsize() == 2
+    assert list(work_queue.consume()) == [("b", 1), ("a", 2)]
+
+
+def test_put_with_priority():
+    work_queue = filled("ab")
+    work_queue.put("c", priority=URGENT)
+    assert list(work_queue.consume()) == list("cab")
+
+
+def test_get_waits_for_an_item():
+    work_queue = PriorityWorkQueue()
+    with pytest.raises(queue.Empty):
+        work_queue.get(block=False)
+    with pytest.raises(queue.Empty):
+        work_queue.get(timeout=0.05)
+    threading.Timer(0.05, work_queue.put, args=("a", )).start()
+    assert work_queue.get(timeout=5) == "a"
+
+
+def test_consume_feeds_apply_many_bumps_included(images, out_dir, watermark):
+    names = sorted(os.listdir(images))
+    work_queue = PriorityWorkQueue(key=lambda job: job.input_path)
+    for name in names:
+        work_queue.put(Job(os.path.join(images, name),
+                           os.path.join(out_dir, name)))
+    done = []
+    for result in apply_many(watermark, work_queue.consume()):
+        done.append(os.path.basename(result.input_path))
+        if len(done) == 1:
+            work_queue.bump([os.path.join(images, names[-1])])
+    assert done == [names[0], names[-1]] + names[1:-1]